@@ -1,18 +1,1303 @@
+import bisect
+import json
+import os
+import queue
+import re
 import sqlite3
+import sys
+import threading
+import time
 import tkinter as tk
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from tkinter import ttk, messagebox
-from datetime import datetime
+from datetime import datetime, timedelta
 
 DB_NAME = "medicare.db"
 
+# --------------------- Patient Search Index ---------------------
+# External-content FTS5 table over patients, keyed by the patients rowid.
+# Prefix indexes on 1-3 characters keep short type-ahead prefixes cheap.
+# Note: VACUUM may renumber the implicit rowid of patients; run
+# DB.rebuild_search_index() afterwards.
+PATIENT_FTS_COLUMNS = ("pid", "name", "phone", "disease", "address")
+# bm25 column weights, same order as PATIENT_FTS_COLUMNS
+PATIENT_FTS_WEIGHTS = (10.0, 8.0, 6.0, 1.0, 1.0)
+# Prefixes shorter than this match too many rows to rank cheaply; they are
+# returned newest first instead.
+FTS_RANK_MIN_CHARS = 3
+
+def _create_patient_search_index(conn):
+    cols = ", ".join(PATIENT_FTS_COLUMNS)
+    new = ", ".join(f"new.{c}" for c in PATIENT_FTS_COLUMNS)
+    old = ", ".join(f"old.{c}" for c in PATIENT_FTS_COLUMNS)
+    try:
+        conn.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5({cols}, "
+            "content='patients', content_rowid='rowid', prefix='1 2 3')"
+        )
+    except sqlite3.OperationalError:
+        # sqlite built without FTS5: list_patients keeps using LIKE
+        return
+    conn.execute(
+        f"""CREATE TRIGGER IF NOT EXISTS patients_fts_ai AFTER INSERT ON patients BEGIN
+            INSERT INTO patients_fts(rowid, {cols}) VALUES (new.rowid, {new});
+        END"""
+    )
+    conn.execute(
+        f"""CREATE TRIGGER IF NOT EXISTS patients_fts_ad AFTER DELETE ON patients BEGIN
+            INSERT INTO patients_fts(patients_fts, rowid, {cols}) VALUES ('delete', old.rowid, {old});
+        END"""
+    )
+    conn.execute(
+        f"""CREATE TRIGGER IF NOT EXISTS patients_fts_au AFTER UPDATE ON patients BEGIN
+            INSERT INTO patients_fts(patients_fts, rowid, {cols}) VALUES ('delete', old.rowid, {old});
+            INSERT INTO patients_fts(rowid, {cols}) VALUES (new.rowid, {new});
+        END"""
+    )
+    conn.execute("INSERT INTO patients_fts(patients_fts) VALUES ('rebuild')")
+
+def search_terms(search: str):
+    return re.findall(r"\w+", (search or "").lower())
+
+def fts_prefix_query(search: str) -> str:
+    # "ram 98" -> '"ram"* "98"*' : every term must prefix-match some column
+    return " ".join(f'"{term}"*' for term in search_terms(search))
+
+# --------------------- Summary Tables ---------------------
+# Report tables kept current by triggers on bills and appointments, so every
+# write path (forms, import, service, cascading deletes) maintains them and
+# reports read O(result) rows. rebuild_summaries() recomputes them from the
+# base tables if they ever drift. typed=False gives the text/float layout
+# the tables had before migration 8 (see Stored Types), for the older
+# migrations.
+_REVENUE_COLUMNS = ("consultation", "medicine", "room", "other", "total")
+
+def _bill_day_sql(created_at, typed=True):
+    return f"{created_at} / 86400" if typed else f"substr({created_at}, 1, 10)"
+
+def _bill_summary_sql(row, sign, typed=True):
+    # Statements applying one bill row (new/old) to the summaries; sign is +1 or -1
+    cols = ", ".join(_REVENUE_COLUMNS)
+    vals = ", ".join(f"{sign} * COALESCE({row}.{c}, 0)" for c in _REVENUE_COLUMNS)
+    sets = ", ".join(f"{c} = {c} + excluded.{c}" for c in _REVENUE_COLUMNS)
+    day = _bill_day_sql(f"{row}.created_at", typed)
+    stmts = [
+        f"INSERT INTO daily_revenue(day, bills, {cols}) VALUES ({day}, {sign}, {vals}) "
+        f"ON CONFLICT(day) DO UPDATE SET bills = bills + excluded.bills, {sets};",
+        f"INSERT INTO patient_spend(pid, bills, total) VALUES ({row}.pid, {sign}, {sign} * COALESCE({row}.total, 0)) "
+        "ON CONFLICT(pid) DO UPDATE SET bills = bills + excluded.bills, total = total + excluded.total;",
+    ]
+    if sign < 0:
+        stmts += [
+            f"DELETE FROM daily_revenue WHERE day = {day} AND bills <= 0;",
+            f"DELETE FROM patient_spend WHERE pid = {row}.pid AND bills <= 0;",
+        ]
+    return "\n".join(stmts)
+
+def _visit_summary_sql(row, sign):
+    key = f"{row}.appt_date, {row}.doctor, COALESCE({row}.dept, '')"
+    stmts = [
+        f"INSERT INTO doctor_visits(day, doctor, dept, visits) VALUES ({key}, {sign}) "
+        "ON CONFLICT(day, doctor, dept) DO UPDATE SET visits = visits + excluded.visits;",
+    ]
+    if sign < 0:
+        stmts.append(f"DELETE FROM doctor_visits WHERE (day, doctor, dept) = ({key}) AND visits <= 0;")
+    return "\n".join(stmts)
+
+def _summary_tables(typed=True):
+    # name -> table definition; typed: days since 1970 and amounts in cents
+    day, money = ("INTEGER", "INTEGER") if typed else ("TEXT", "REAL")
+    return {
+        "daily_revenue": f"""(
+            day {day} PRIMARY KEY,
+            bills INTEGER NOT NULL DEFAULT 0,
+            consultation {money} NOT NULL DEFAULT 0,
+            medicine {money} NOT NULL DEFAULT 0,
+            room {money} NOT NULL DEFAULT 0,
+            other {money} NOT NULL DEFAULT 0,
+            total {money} NOT NULL DEFAULT 0
+        ) WITHOUT ROWID""",
+        "doctor_visits": f"""(
+            day {day} NOT NULL,
+            doctor TEXT NOT NULL,
+            dept TEXT NOT NULL,
+            visits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(day, doctor, dept)
+        ) WITHOUT ROWID""",
+        "patient_spend": f"""(
+            pid TEXT PRIMARY KEY,
+            bills INTEGER NOT NULL DEFAULT 0,
+            total {money} NOT NULL DEFAULT 0
+        ) WITHOUT ROWID""",
+    }
+
+def _create_summary_triggers(conn, typed=True):
+    bill = lambda row, sign: _bill_summary_sql(row, sign, typed)
+    triggers = {
+        "bills_summary_ai": ("AFTER INSERT ON bills", bill("new", 1)),
+        "bills_summary_ad": ("AFTER DELETE ON bills", bill("old", -1)),
+        "bills_summary_au": ("AFTER UPDATE ON bills", bill("old", -1) + "\n" + bill("new", 1)),
+        "appointments_summary_ai": ("AFTER INSERT ON appointments", _visit_summary_sql("new", 1)),
+        "appointments_summary_ad": ("AFTER DELETE ON appointments", _visit_summary_sql("old", -1)),
+        "appointments_summary_au": ("AFTER UPDATE ON appointments",
+                                    _visit_summary_sql("old", -1) + "\n" + _visit_summary_sql("new", 1)),
+    }
+    for name, (event, body) in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN\n{body}\nEND")
+
+def _create_summary_tables(conn, typed=True):
+    for name, definition in _summary_tables(typed).items():
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {name} {definition}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patient_spend_total ON patient_spend(total)")
+    _create_summary_triggers(conn, typed)
+    _rebuild_summaries(conn, typed=typed)
+
+def _rebuild_summaries(conn, archived=False, typed=True):
+    # archived: also count the rows in the attached archive file
+    cols = ", ".join(_REVENUE_COLUMNS)
+    sums = ", ".join(f"SUM(COALESCE({c}, 0))" for c in _REVENUE_COLUMNS)
+    bills, appointments = "bills", "appointments"
+    if archived:
+        bills = f"(SELECT pid, {cols}, created_at FROM main.bills UNION ALL SELECT pid, {cols}, created_at FROM archive.bills)"
+        appointments = ("(SELECT appt_date, doctor, dept FROM main.appointments "
+                        "UNION ALL SELECT appt_date, doctor, dept FROM archive.appointments)")
+    conn.execute("DELETE FROM daily_revenue")
+    conn.execute(
+        f"INSERT INTO daily_revenue(day, bills, {cols}) "
+        f"SELECT {_bill_day_sql('created_at', typed)}, COUNT(*), {sums} FROM {bills} GROUP BY 1"
+    )
+    conn.execute("DELETE FROM doctor_visits")
+    conn.execute(
+        "INSERT INTO doctor_visits(day, doctor, dept, visits) "
+        f"SELECT appt_date, doctor, COALESCE(dept, ''), COUNT(*) FROM {appointments} GROUP BY 1, 2, 3"
+    )
+    conn.execute("DELETE FROM patient_spend")
+    conn.execute(
+        "INSERT INTO patient_spend(pid, bills, total) "
+        f"SELECT pid, COUNT(*), SUM(COALESCE(total, 0)) FROM {bills} GROUP BY pid"
+    )
+
+def _guard_summary_deletes(conn, typed=True):
+    # Archiving deletes rows from the hot tables without changing the history
+    # the summaries describe, so the delete triggers skip while summary_guard
+    # has a row. DB.archive() fills it only inside its own transactions.
+    conn.execute("CREATE TABLE IF NOT EXISTS summary_guard (reason TEXT NOT NULL)")
+    for name, table, body in (("bills_summary_ad", "bills", _bill_summary_sql("old", -1, typed)),
+                              ("appointments_summary_ad", "appointments", _visit_summary_sql("old", -1))):
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(f"CREATE TRIGGER {name} AFTER DELETE ON {table} "
+                     f"WHEN NOT EXISTS (SELECT 1 FROM summary_guard) BEGIN\n{body}\nEND")
+
+# --------------------- Change Log ---------------------
+# Triggers append (table, key, op) for every row written to the base tables,
+# whichever connection wrote it, so a workstation can find out what others
+# changed since it last looked (DB.poll_changes) without reloading its views.
+# Only the newest CHANGE_LOG_KEEP entries are kept; a reader that falls
+# further behind than that reloads instead.
+CHANGE_LOG_TABLES = {"patients": "pid", "appointments": "id", "bills": "id"}
+CHANGE_LOG_KEEP = 20000
+CHANGE_LOG_PRUNE_EVERY = 1000
+CHANGE_FETCH_LIMIT = 500  # more entries than this per poll: reload instead
+CHANGE_POLL_MS = 1000
+
+def _create_change_log(conn):
+    # AUTOINCREMENT: seq never goes back, even after the log was pruned empty
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tbl TEXT NOT NULL,
+            key NOT NULL,
+            op TEXT NOT NULL
+        )"""
+    )
+    for table, key in CHANGE_LOG_TABLES.items():
+        for suffix, op, row in (("ai", "insert", "new"), ("au", "update", "new"), ("ad", "delete", "old")):
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_log_{suffix} AFTER {op.upper()} ON {table} BEGIN\n"
+                         f"INSERT INTO change_log(tbl, key, op) VALUES ('{table}', {row}.{key}, '{op}');\nEND")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS change_log_prune AFTER INSERT ON change_log "
+                 f"WHEN new.seq % {CHANGE_LOG_PRUNE_EVERY} = 0 BEGIN\n"
+                 f"DELETE FROM change_log WHERE seq <= new.seq - {CHANGE_LOG_KEEP};\nEND")
+
+# --------------------- Stored Types ---------------------
+# Since migration 8 the tables hold integers: amounts in cents, dates as days
+# since 1970-01-01, times as minutes after midnight (NO_TIME when there is
+# none) and timestamps as seconds since 1970, the local wall-clock time read
+# as UTC so it converts back unchanged. Sums of cents are exact, and the
+# rows and indexes are smaller. The DB methods still take and return ISO
+# text and float amounts: statements write through _WRITE_SQL and read
+# through _READ_SQL, and values compared with stored columns go through
+# _stored().
+NO_TIME = -1
+_EPOCH = datetime(1970, 1, 1)
+
+def _epoch_seconds(value):
+    # Any UTC offset is dropped: the wall-clock time is what was stored
+    return int((datetime.fromisoformat(value).replace(tzinfo=None) - _EPOCH).total_seconds())
+
+def _epoch_day(value):
+    return (datetime.strptime(value[:10], "%Y-%m-%d") - _EPOCH).days
+
+def _day_minutes(value):
+    if not value:
+        return NO_TIME
+    t = datetime.strptime(value, "%H:%M")
+    return t.hour * 60 + t.minute
+
+def _cents(value):
+    # Rounds exactly as ROUND(? * 100) in _WRITE_SQL, half away from zero
+    # on the scaled double, so totals agree with the amounts written
+    if value is None:
+        return None
+    scaled = float(value) * 100
+    return int(scaled - 0.5) if scaled < 0 else int(scaled + 0.5)
+
+def _money(value):
+    # An amount as it reads back once stored
+    return None if value is None else _cents(value) / 100
+
+def bill_total(*amounts):
+    # Summed in cents, so 0.1 + 0.2 comes to 0.3
+    return sum(_cents(a or 0) for a in amounts) / 100
+
+_STORED = {"created_at": _epoch_seconds, "appt_date": _epoch_day, "appt_time": _day_minutes,
+           **{c: _cents for c in _REVENUE_COLUMNS}}
+_WRITE_SQL = {
+    "created_at": "CAST(strftime('%s', substr(?, 1, 19)) AS INTEGER)",
+    "appt_date": "CAST(strftime('%s', ?) / 86400 AS INTEGER)",
+    "appt_time": f"COALESCE((strftime('%s', ?) - 946684800) / 60, {NO_TIME})",  # time-only is 2000-01-01
+    **{c: "CAST(ROUND(? * 100) AS INTEGER)" for c in _REVENUE_COLUMNS},
+}
+_READ_SQL = {
+    "created_at": "strftime('%Y-%m-%dT%H:%M:%S', {0}, 'unixepoch')",
+    "appt_date": "date({0} * 86400, 'unixepoch')",
+    "appt_time": "CASE WHEN {0} < 0 THEN '' ELSE printf('%02d:%02d', {0} / 60, {0} % 60) END",
+    **{c: "{0} / 100.0" for c in _REVENUE_COLUMNS},
+}
+
+def _stored(column, value):
+    return _STORED[column](value) if column in _STORED else value
+
+def _read_columns(columns, prefix="", named=False):
+    # SELECT list giving columns in their API form. named: alias them to the
+    # column names, which compound SELECTs need for ORDER BY. Plain queries
+    # must not, or ORDER BY would sort the text instead of using an index.
+    out = []
+    for c in columns:
+        if c in _READ_SQL:
+            c = _READ_SQL[c].format(prefix + c) + (f" AS {c}" if named else "")
+        else:
+            c = prefix + c
+        out.append(c)
+    return ", ".join(out)
+
+def _read_day(column):
+    return _READ_SQL["appt_date"].format(column)
+
+def _write_values(columns):
+    return ", ".join(_WRITE_SQL.get(c, "?") for c in columns)
+
+def _write_set(columns):
+    return ", ".join(f"{c}={_WRITE_SQL.get(c, '?')}" for c in columns)
+
+# name -> definition with the stored types
+TYPED_TABLES = {
+    "patients": """(
+        pid TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        age INTEGER CHECK(age >= 0),
+        gender TEXT CHECK(gender IN ('M','F','O')),
+        phone TEXT,
+        disease TEXT,
+        address TEXT,
+        created_at INTEGER NOT NULL
+    )""",
+    "appointments": f"""(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pid TEXT NOT NULL,
+        doctor TEXT NOT NULL,
+        dept TEXT,
+        appt_date INTEGER NOT NULL,
+        appt_time INTEGER NOT NULL DEFAULT {NO_TIME},
+        notes TEXT,
+        created_at INTEGER NOT NULL,
+        FOREIGN KEY(pid) REFERENCES patients(pid) ON DELETE CASCADE
+    )""",
+    "bills": """(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pid TEXT NOT NULL,
+        consultation INTEGER DEFAULT 0,
+        medicine INTEGER DEFAULT 0,
+        room INTEGER DEFAULT 0,
+        other INTEGER DEFAULT 0,
+        total INTEGER NOT NULL,
+        created_at INTEGER NOT NULL,
+        FOREIGN KEY(pid) REFERENCES patients(pid) ON DELETE CASCADE
+    )""",
+}
+
+def _legacy_converters(conn):
+    # SQL functions reading the pre-migration-8 text, as leniently as the
+    # forms of the time validated it (strptime accepts "9:5"); a time that
+    # does not parse becomes NO_TIME
+    def minutes(value):
+        try:
+            return _day_minutes(value)
+        except (TypeError, ValueError):
+            return NO_TIME
+    conn.create_function("legacy_seconds", 1, _epoch_seconds, deterministic=True)
+    conn.create_function("legacy_day", 1, _epoch_day, deterministic=True)
+    conn.create_function("legacy_minutes", 1, minutes, deterministic=True)
+
+def _legacy_select(columns):
+    legacy = {"created_at": "legacy_seconds(created_at)", "appt_date": "legacy_day(appt_date)",
+              "appt_time": "legacy_minutes(appt_time)",
+              **{c: f"CAST(ROUND({c} * 100) AS INTEGER)" for c in _REVENUE_COLUMNS}}
+    return ", ".join(legacy.get(c, c) for c in columns)
+
+def _retype_table(conn, table, definition, columns, source=None, schema="main", restore=True):
+    # SQLite cannot change a column's type in place: copy the rows, converted
+    # (or as selected by source), into a table with the new definition, drop
+    # the old one and rename. Its indexes and triggers are recreated unless
+    # restore=False; the summary triggers are left to the caller, since their
+    # SQL depends on the types.
+    objects = conn.execute(
+        f"SELECT name, sql FROM {schema}.sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') "
+        "AND sql IS NOT NULL", (table,)).fetchall()
+    seq = None
+    if schema == "main":
+        seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+    new = f"{table}_typed"
+    conn.execute(f"CREATE TABLE {schema}.{new} {definition}")
+    source = source or f"SELECT {_legacy_select(columns)} FROM {schema}.{table}"
+    conn.execute(f"INSERT INTO {schema}.{new}({', '.join(columns)}) {source}")
+    conn.execute(f"DROP TABLE {schema}.{table}")
+    conn.execute(f"ALTER TABLE {schema}.{new} RENAME TO {table}")
+    if seq is not None:
+        # AUTOINCREMENT: ids of deleted rows stay used
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (seq[0], table))
+    if restore:
+        for name, sql in objects:
+            if "_summary_" not in name:
+                conn.execute(sql)
+
+def _typed_storage(conn):
+    # Migration 8. DB.migrate() turns foreign keys off around it, so dropping
+    # the old patients table does not cascade. Patients keep their rowids,
+    # which the search index refers to.
+    _legacy_converters(conn)
+    _retype_table(conn, "patients", TYPED_TABLES["patients"], ("rowid",) + PATIENT_COLUMNS)
+    _retype_table(conn, "appointments", TYPED_TABLES["appointments"], APPOINTMENT_COLUMNS)
+    _retype_table(conn, "bills", TYPED_TABLES["bills"], BILL_COLUMNS)
+    # The summaries are converted rather than rebuilt: they also cover
+    # archived rows, and the archive file may not be at hand. Days are
+    # regrouped since two spellings ("2024-1-5") can name the same day.
+    cents = ", ".join(f"CAST(ROUND(SUM({c}) * 100) AS INTEGER)" for c in _REVENUE_COLUMNS)
+    sources = {
+        "daily_revenue": (("day", "bills") + _REVENUE_COLUMNS,
+                          f"SELECT legacy_day(day), SUM(bills), {cents} FROM daily_revenue GROUP BY 1"),
+        "doctor_visits": (("day", "doctor", "dept", "visits"),
+                          "SELECT legacy_day(day), doctor, dept, SUM(visits) FROM doctor_visits GROUP BY 1, 2, 3"),
+        "patient_spend": (("pid", "bills", "total"),
+                          "SELECT pid, bills, CAST(ROUND(total * 100) AS INTEGER) FROM patient_spend"),
+    }
+    for name, definition in _summary_tables().items():
+        _retype_table(conn, name, definition, *sources[name])
+    _create_summary_triggers(conn)
+    _guard_summary_deletes(conn)
+
+# --------------------- Schema Migrations ---------------------
+# Each entry upgrades the schema from (version - 1) to version. The current
+# version is stored in PRAGMA user_version, so existing medicare.db files are
+# upgraded in place the next time they are opened. Never edit a shipped
+# migration; append a new one instead.
+MIGRATIONS = [
+    (1, "indexes for pid filters, date ordering and created_at", [
+        "CREATE INDEX IF NOT EXISTS idx_patients_created_at ON patients(created_at)",
+        # (pid, ...) prefixes also serve the ON DELETE CASCADE child lookups
+        "CREATE INDEX IF NOT EXISTS idx_appointments_pid_date ON appointments(pid, appt_date, appt_time)",
+        "CREATE INDEX IF NOT EXISTS idx_appointments_date ON appointments(appt_date, appt_time)",
+        "CREATE INDEX IF NOT EXISTS idx_bills_pid_created ON bills(pid, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_bills_created_at ON bills(created_at)",
+    ]),
+    (2, "FTS5 patient search index with sync triggers", [
+        _create_patient_search_index,
+    ]),
+    (3, "revenue, visit and patient spend summary tables", [
+        lambda conn: _create_summary_tables(conn, typed=False),
+    ]),
+    (4, "doctor schedule index", [
+        "CREATE INDEX IF NOT EXISTS idx_appointments_doctor_slot ON appointments(doctor, appt_date, appt_time)",
+    ]),
+    (5, "keyset pagination indexes", [
+        # Keyset pages compare (appt_date, appt_time, id) as a row value, which
+        # a NULL time would drop out of; the forms have always stored ''.
+        "UPDATE appointments SET appt_time = '' WHERE appt_time IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_appointments_dept_date ON appointments(dept, appt_date, appt_time)",
+        "CREATE INDEX IF NOT EXISTS idx_patients_created_pid ON patients(created_at, pid)",
+        "DROP INDEX IF EXISTS idx_patients_created_at",
+    ]),
+    (6, "summaries survive archiving", [lambda conn: _guard_summary_deletes(conn, typed=False)]),
+    (7, "change log for other workstations", [_create_change_log]),
+    (8, "integer cents, epoch days and seconds, minutes", [_typed_storage]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# --------------------- Validation ---------------------
+# Shared by the forms and by bulk import; each returns an error message or None.
+def patient_error(pid, name, age, gender):
+    if not pid:
+        return "Patient ID is required"
+    if not name:
+        return "Name is required"
+    try:
+        if age and int(age) < 0:
+            return "Age cannot be negative"
+    except ValueError:
+        return "Age must be a number"
+    if gender not in ("M", "F", "O"):
+        return "Invalid gender"
+    return None
+
+_ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_ISO_TIME = re.compile(r"(\d{2}):(\d{2})")
+
+def appointment_slot(date, time_):
+    # (date, time) as YYYY-MM-DD and HH:MM, the only forms the stored-type
+    # conversion accepts, so "2024-1-5" and "9:05" are padded here; raises
+    # ValueError. strptime is slow enough to dominate bulk imports, so the
+    # canonical forms are checked directly and anything else falls back to it.
+    if not date:
+        raise ValueError("Date is required (YYYY-MM-DD)")
+    try:
+        if _ISO_DATE.fullmatch(date):
+            datetime.fromisoformat(date)
+        else:
+            date = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d")
+        if time_:
+            m = _ISO_TIME.fullmatch(time_)
+            if m is None:
+                time_ = datetime.strptime(time_, "%H:%M").strftime("%H:%M")
+            elif int(m.group(1)) > 23 or int(m.group(2)) > 59:
+                raise ValueError(time_)
+    except ValueError:
+        raise ValueError("Invalid date/time format") from None
+    return date, time_ or ""
+
+def appointment_error(date, time_):
+    try:
+        appointment_slot(date, time_)
+    except ValueError as e:
+        return str(e)
+    return None
+
+def amount_error(label, value):
+    try:
+        if float(value or 0) < 0:
+            return f"{label} cannot be negative"
+    except ValueError:
+        return f"{label} must be a number"
+    return None
+
+# --------------------- Bulk Import ---------------------
+IMPORT_CHUNK_SIZE = 20000
+IMPORT_CACHE_KIB = 64 * 1024
+
+def _field(record, name):
+    value = record.get(name)
+    if value is None:
+        return ""
+    return value.strip() if isinstance(value, str) else str(value)
+
+def _created_at(record):
+    value = _field(record, "created_at")
+    if not value:
+        return datetime.now().isoformat(timespec="seconds")
+    try:
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError("Invalid created_at") from None
+    if when.tzinfo is not None:
+        # Stored timestamps are local wall-clock time; keep the instant
+        when = when.astimezone().replace(tzinfo=None)
+    return when.isoformat(timespec="seconds")
+
+def _patient_values(record):
+    pid, name, age = _field(record, "pid"), _field(record, "name"), _field(record, "age")
+    gender = _field(record, "gender").upper()
+    error = patient_error(pid, name, age, gender)
+    if error:
+        raise ValueError(error)
+    return (pid, name, int(age or 0), gender, _field(record, "phone"), _field(record, "disease"),
+            _field(record, "address"), _created_at(record))
+
+def _appointment_values(record):
+    pid, doctor = _field(record, "pid"), _field(record, "doctor")
+    date, time_ = _field(record, "appt_date"), _field(record, "appt_time")
+    if not pid:
+        raise ValueError("Patient ID is required")
+    if not doctor:
+        raise ValueError("Doctor is required")
+    date, time_ = appointment_slot(date, time_)
+    return (pid, doctor, _field(record, "dept"), date, time_, _field(record, "notes"), _created_at(record))
+
+def _bill_amounts(record):
+    # [consultation, medicine, room, other] as floats
+    amounts = []
+    for name in ("consultation", "medicine", "room", "other"):
+        value = _field(record, name)
+        error = amount_error(name.capitalize(), value)
+        if error:
+            raise ValueError(error)
+        amounts.append(float(value or 0))
+    return amounts
+
+def _bill_values(record):
+    pid = _field(record, "pid")
+    if not pid:
+        raise ValueError("Patient ID is required")
+    amounts = _bill_amounts(record)
+    return (pid, *amounts, bill_total(*amounts), _created_at(record))
+
+# table -> (insert statement, record -> values)
+_INSERT_COLUMNS = {
+    "patients": ("pid", "name", "age", "gender", "phone", "disease", "address", "created_at"),
+    "appointments": ("pid", "doctor", "dept", "appt_date", "appt_time", "notes", "created_at"),
+    "bills": ("pid", "consultation", "medicine", "room", "other", "total", "created_at"),
+}
+INSERT_SQL = {table: f"INSERT INTO {table}({', '.join(cols)}) VALUES ({_write_values(cols)})"
+              for table, cols in _INSERT_COLUMNS.items()}
+IMPORT_TABLES = {
+    "patients": (INSERT_SQL["patients"], _patient_values),
+    "appointments": (INSERT_SQL["appointments"], _appointment_values),
+    "bills": (INSERT_SQL["bills"], _bill_values),
+}
+
+def _file_format(path, fmt=None):
+    fmt = fmt or ("jsonl" if str(path).lower().endswith((".jsonl", ".ndjson", ".json")) else "csv")
+    if fmt not in ("csv", "jsonl"):
+        raise ValueError(f"unsupported format {fmt!r}")
+    return fmt
+
+def read_records(path, fmt=None):
+    # Stream (line number, record dict or None, error) from a CSV or JSONL file
+    import csv
+
+    fmt = _file_format(path, fmt)
+    with open(path, newline="", encoding="utf-8") as f:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record, None
+        else:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield line_no, {"raw": line.rstrip("\n")}, f"Invalid JSON: {e}"
+                    continue
+                if isinstance(record, dict):
+                    yield line_no, record, None
+                else:
+                    yield line_no, {"raw": line.rstrip("\n")}, "Expected a JSON object"
+
+class RejectWriter:
+    # Writes rejected records with their line number and error, in the
+    # format of the input file. Opened lazily so clean imports leave no file.
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self._file = None
+        self._csv = None
+
+    def write(self, line_no, record, error):
+        if self.path is None:
+            return
+        if self._file is None:
+            self._file = open(self.path, "w", newline="", encoding="utf-8")
+        row = {"line": line_no, "error": error, **record}
+        if self.fmt == "jsonl":
+            self._file.write(json.dumps(row) + "\n")
+            return
+        if self._csv is None:
+            import csv
+
+            self._csv = csv.DictWriter(self._file, fieldnames=list(row), extrasaction="ignore")
+            self._csv.writeheader()
+        self._csv.writerow(row)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+# --------------------- Query Metrics ---------------------
+# Opt-in instrumentation. Once instrument() is called, every new DB times its
+# public methods and, through set_trace_callback on each of its connections,
+# the statements they run. sqlite only reports when a statement starts, so a
+# statement is taken to last until the next one starts on that thread or the
+# enclosing DB call returns; statements run outside any DB call (callers
+# using db.conn directly) are only counted. Statements slower than slow_ms
+# are kept with the method that ran them; their EXPLAIN QUERY PLAN is
+# computed when a snapshot is taken, so the hot path never pays for it.
+SLOW_QUERY_MS = 50
+SLOW_LOG_SIZE = 200
+TOP_STATEMENTS = 25
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+_UNTIMED_METHODS = {"transaction", "close", "explain", "query_plans", "schema_version", "metrics_snapshot",
+                    "cache_stats", "poll_changes"}
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_LIST = re.compile(r"\(\?(?:\s*,\s*\?)+\)")
+
+def _normalize_sql(sql):
+    # Literals to ?, so the same statement with other values aggregates together
+    return _SQL_LIST.sub("(?, ...)", _SQL_LITERAL.sub("?", " ".join(sql.split())))
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+
+    def add(self, ms, rows=None):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.calls += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        if rows:
+            self.rows += rows
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th call (max for the overflow bucket)
+        target, seen = p * self.calls, 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= target:
+                return round(min(bound, self.max_ms), 3)
+        return round(self.max_ms, 3)
+
+    def as_dict(self):
+        labels = [f"<={b}" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}"]
+        return {"calls": self.calls, "total_ms": round(self.total_ms, 3),
+                "mean_ms": round(self.total_ms / self.calls, 3) if self.calls else 0.0,
+                "p50_ms": self.percentile(0.5), "p95_ms": self.percentile(0.95),
+                "p99_ms": self.percentile(0.99), "max_ms": round(self.max_ms, 3), "rows": self.rows,
+                "histogram": {l: c for l, c in zip(labels, self.counts) if c}}
+
+class QueryMetrics:
+    def __init__(self, slow_ms=SLOW_QUERY_MS):
+        self.slow_ms = slow_ms
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._plans = {}   # (db_name, sql) -> plan lines
+        self.reset()
+
+    def reset(self):
+        from collections import deque
+
+        with self._lock:
+            self.methods = {}      # DB method -> LatencyHistogram
+            self.statements = {}   # normalized sql -> LatencyHistogram
+            self.untimed = {}      # normalized sql -> count, run outside DB calls
+            self.slow = deque(maxlen=SLOW_LOG_SIZE)
+            self.commits = 0
+            self.rollbacks = 0
+            self.started = datetime.now().isoformat(timespec="seconds")
+
+    # -------- statements (trace callback) --------
+    def tracer(self, db_name):
+        def trace(sql):
+            local = self._local
+            current = getattr(local, "stmt", None)
+            if sql.startswith("--") or (current is not None and current[0] == sql):
+                return  # trigger and FTS sub-programs of the running statement
+            now = time.perf_counter()
+            self._end_statement(now)
+            word = sql.lstrip()[:8].upper()
+            if word.startswith(("COMMIT", "END", "ROLLBACK")):
+                with self._lock:
+                    if word[0] != "R":
+                        self.commits += 1
+                    elif " TO " not in sql.upper():
+                        self.rollbacks += 1
+            if getattr(local, "calls", None):
+                local.stmt = (sql, now, db_name)
+            else:
+                key = _normalize_sql(sql)
+                with self._lock:
+                    self.untimed[key] = self.untimed.get(key, 0) + 1
+        return trace
+
+    def _end_statement(self, now):
+        current = getattr(self._local, "stmt", None)
+        if current is None:
+            return
+        self._local.stmt = None
+        sql, started, db_name = current
+        ms = (now - started) * 1000
+        stack = getattr(self._local, "calls", None)
+        method = stack[-1] if stack else "-"
+        with self._lock:
+            key = _normalize_sql(sql)
+            hist = self.statements.get(key)
+            if hist is None:
+                hist = self.statements[key] = LatencyHistogram()
+            hist.add(ms)
+            if ms >= self.slow_ms:
+                self.slow.append({"at": datetime.now().isoformat(timespec="milliseconds"), "ms": round(ms, 3),
+                                  "method": method, "db": db_name, "sql": sql[:4000]})
+
+    # -------- DB methods --------
+    def wrap(self, name, fn):
+        def timed(*args, **kwargs):
+            stack = self._local.__dict__.setdefault("calls", [])
+            stack.append(name)
+            started = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                now = time.perf_counter()
+                self._end_statement(now)
+                stack.pop()
+            if hasattr(result, "__next__"):
+                return self._timed_iter(name, result, started)
+            self._record(name, (now - started) * 1000, len(result) if isinstance(result, list) else None)
+            return result
+        timed.__name__ = name
+        timed.__wrapped__ = fn
+        return timed
+
+    def _timed_iter(self, name, rows, started):
+        # Generators (export, statements) are timed until they are exhausted
+        count = 0
+        stack = self._local.__dict__.setdefault("calls", [])
+        try:
+            while True:
+                stack.append(name)
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    return
+                finally:
+                    self._end_statement(time.perf_counter())
+                    stack.pop()
+                count += 1
+                yield row
+        finally:
+            self._record(name, (time.perf_counter() - started) * 1000, count)
+
+    def _record(self, name, ms, rows):
+        with self._lock:
+            hist = self.methods.get(name)
+            if hist is None:
+                hist = self.methods[name] = LatencyHistogram()
+            hist.add(ms, rows)
+
+    # -------- reporting --------
+    def _plan(self, db_name, sql):
+        if not re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE|WITH|REPLACE)\b", sql, re.I):
+            return []
+        key = (db_name, sql)
+        if key not in self._plans:
+            from urllib.request import pathname2url
+
+            try:
+                conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(db_name))}?mode=ro", uri=True)
+                try:
+                    self._plans[key] = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                self._plans[key] = [f"n/a ({e})"]
+        return self._plans[key]
+
+    def snapshot(self, db=None):
+        with self._lock:
+            methods = {n: h.as_dict() for n, h in sorted(self.methods.items())}
+            top = sorted(self.statements.items(), key=lambda kv: kv[1].total_ms, reverse=True)[:TOP_STATEMENTS]
+            statements = [{"sql": sql, **h.as_dict()} for sql, h in top]
+            untimed = sorted(self.untimed.items(), key=lambda kv: kv[1], reverse=True)[:TOP_STATEMENTS]
+            slow = [dict(entry) for entry in self.slow]
+            snap = {"since": self.started, "taken": datetime.now().isoformat(timespec="seconds"),
+                    "slow_ms": self.slow_ms, "commits": self.commits, "rollbacks": self.rollbacks}
+        if db is not None:
+            # Every commit is an fsync with a rollback journal; WAL with
+            # synchronous=NORMAL only syncs at checkpoints.
+            snap["journal_mode"] = "wal" if db.wal else "rollback"
+            snap["group_commit_ms"] = db.group_commit_ms
+            snap["record_cache"] = db.cache.stats()
+        for entry in slow:
+            entry["plan"] = self._plan(entry["db"], entry["sql"])
+        snap.update(methods=methods, statements=statements, slow=slow,
+                    untimed_statements=[{"sql": sql, "calls": n} for sql, n in untimed])
+        return snap
+
+    def dump(self, path, db=None):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(db), f, indent=2)
+
+def instrument(slow_ms=SLOW_QUERY_MS):
+    # Turn on metrics for every DB opened from now on and return the collector
+    DB.metrics = QueryMetrics(slow_ms)
+    return DB.metrics
+
 # --------------------- Database Layer ---------------------
+PATIENT_COLUMNS = ("pid", "name", "age", "gender", "phone", "disease", "address", "created_at")
+APPOINTMENT_COLUMNS = ("id", "pid", "doctor", "dept", "appt_date", "appt_time", "notes", "created_at")
+BILL_COLUMNS = ("id", "pid", "consultation", "medicine", "room", "other", "total", "created_at")
+EXPORT_CHUNK_SIZE = 1000
+# table -> (columns, column the date range filters on)
+EXPORT_TABLES = {
+    "patients": (PATIENT_COLUMNS, "created_at"),
+    "appointments": (APPOINTMENT_COLUMNS, "appt_date"),
+    "bills": (BILL_COLUMNS, "created_at"),
+}
+
+# What a mutation did to one row: op is "insert", "update" or "delete", key
+# is the primary key and row the new values (None for deletes). Mutations
+# return a list of these so views can patch themselves instead of reloading.
+Change = namedtuple("Change", "table op key row")
+
+# -------- Row records --------
+# The read methods return rows as these record types rather than bare
+# tuples. They are namedtuples (no per-row __dict__), so indexing, unpacking
+# and Treeview values=row keep working, and fields can be read by name.
+# Nothing is decoded lazily: every column arrives in its API form (ISO
+# text, float amounts), converted in SQL for each row (see Stored Types).
+# Only the datetime objects behind .created and Appointment.when are built
+# on demand, from that text.
+class _Record:
+    __slots__ = ()
+    # Columns whose values repeat across rows; a result set keeps one copy
+    # of each distinct value instead of one string per row.
+    _shared = ()
+
+    @property
+    def created(self):
+        return datetime.fromisoformat(self.created_at)
+
+class Patient(_Record, namedtuple("Patient", PATIENT_COLUMNS)):
+    __slots__ = ()
+    _shared = (3, 5)  # gender, disease
+
+class Appointment(_Record, namedtuple("Appointment", APPOINTMENT_COLUMNS)):
+    __slots__ = ()
+    _shared = (1, 2, 3, 4, 5)  # pid, doctor, dept, appt_date, appt_time
+
+    @property
+    def when(self):
+        return datetime.strptime(f"{self.appt_date} {self.appt_time or '00:00'}", "%Y-%m-%d %H:%M")
+
+class Bill(_Record, namedtuple("Bill", BILL_COLUMNS)):
+    __slots__ = ()
+    # pid and the amounts, which come from short fee schedules; the memo of
+    # distinct pids alone would outweigh what sharing them saves
+    _shared = (1, 2, 3, 4, 5, 6)
+
+RECORD_TYPES = {"patients": Patient, "appointments": Appointment, "bills": Bill}
+# Each table's columns in their API form (see Stored Types)
+SELECT_COLUMNS = {table: _read_columns(cls._fields) for table, cls in RECORD_TYPES.items()}
+
+def _record_factory(cls, share_values=True):
+    # Cursor row_factory for one query; the memo of shared values lives as
+    # long as the query's rows do. Sharing costs about a microsecond a row,
+    # which only pays off for result sets bigger than a page.
+    new = tuple.__new__
+    if not share_values:
+        return lambda cursor, row: new(cls, row)
+    memo = {}
+    share, shared = memo.setdefault, cls._shared
+
+    def factory(cursor, row):
+        row = list(row)
+        for i in shared:
+            row[i] = share(row[i], row[i])
+        return new(cls, row)
+    return factory
+
+def _order_clause(columns, order_by, descending, default, tiebreak):
+    # Column sorts come from Treeview headings, so only known names are allowed
+    if order_by is None:
+        return default
+    if order_by not in columns:
+        raise ValueError(f"cannot sort by {order_by!r}")
+    direction = "DESC" if descending else "ASC"
+    if order_by == tiebreak:
+        return f"ORDER BY {order_by} {direction}"
+    return f"ORDER BY {order_by} {direction}, {tiebreak} {direction}"
+
+def _patient_rows(conn, search, limit, offset, order_by, descending, fts):
+    # list_patients() on a given connection; fts: patients_fts exists
+    cur = conn.cursor()
+    cur.row_factory = _record_factory(Patient, limit is None or limit > PAGE_SIZE)
+    query = fts_prefix_query(search) if search and fts else ""
+    if query:
+        # Ranked prefix search; short prefixes are returned newest first
+        # because ranking every match would cost a full sort.
+        if max(len(t) for t in search_terms(search)) >= FTS_RANK_MIN_CHARS:
+            order = "bm25(patients_fts, {})".format(", ".join(map(str, PATIENT_FTS_WEIGHTS)))
+        else:
+            order = "patients_fts.rowid DESC"
+        cur.execute(
+            f"SELECT {_read_columns(PATIENT_COLUMNS, 'p.')} "
+            "FROM patients_fts JOIN patients p ON p.rowid = patients_fts.rowid "
+            f"WHERE patients_fts MATCH ? ORDER BY {order} LIMIT ?",
+            (query, -1 if limit is None else limit),
+        )
+        return cur.fetchall()
+    order = _order_clause(PATIENT_COLUMNS, order_by, descending, "ORDER BY created_at DESC", "pid")
+    page = (-1 if limit is None else limit, offset)
+    if search:
+        like = f"%{search}%"
+        cur.execute(
+            f"SELECT {SELECT_COLUMNS['patients']} FROM patients "
+            f"WHERE pid LIKE ? OR name LIKE ? OR phone LIKE ? {order} LIMIT ? OFFSET ?",
+            (like, like, like) + page,
+        )
+    else:
+        cur.execute(
+            f"SELECT {SELECT_COLUMNS['patients']} FROM patients {order} LIMIT ? OFFSET ?",
+            page,
+        )
+    return cur.fetchall()
+
+# -------- Filtered keyset pages (query_patients/appointments/bills) --------
+PAGE_SIZE = 100
+
+def _day(value):
+    return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+
+def _day_after(value):
+    return (datetime.strptime(value, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+
+# table -> filter name -> (column, operator, value conversion). Date bounds
+# are inclusive YYYY-MM-DD; timestamp columns compare against the next day.
+QUERY_FILTERS = {
+    "patients": {
+        "created_from": ("created_at", ">=", _day),
+        "created_to": ("created_at", "<", _day_after),
+    },
+    "appointments": {
+        "pid": ("pid", "=", str),
+        "doctor": ("doctor", "=", str),
+        "dept": ("dept", "=", str),
+        "date_from": ("appt_date", ">=", _day),
+        "date_to": ("appt_date", "<=", _day),
+        "created_from": ("created_at", ">=", _day),
+        "created_to": ("created_at", "<", _day_after),
+    },
+    "bills": {
+        "pid": ("pid", "=", str),
+        "date_from": ("created_at", ">=", _day),
+        "date_to": ("created_at", "<", _day_after),
+        "amount_min": ("total", ">=", float),
+        "amount_max": ("total", "<=", float),
+    },
+}
+_FILTER_OPS = {"=": lambda a, b: a == b, ">=": lambda a, b: a >= b,
+               "<=": lambda a, b: a <= b, "<": lambda a, b: a < b}
+
+# table -> (columns, default sort, unique tiebreak, nullable columns). The
+# default sort is always descending, like the list_* methods.
+KEYSET_TABLES = {
+    "patients": (PATIENT_COLUMNS, ("created_at",), "pid", {"age", "gender", "phone", "disease", "address"}),
+    "appointments": (APPOINTMENT_COLUMNS, ("appt_date", "appt_time"), "id", {"dept", "notes"}),
+    "bills": (BILL_COLUMNS, ("created_at",), "id", {"consultation", "medicine", "room", "other"}),
+}
+
+def normalize_filters(table, filters):
+    # Drop empty values and convert the rest; raises ValueError on bad input
+    spec, clean = QUERY_FILTERS[table], {}
+    for name, value in (filters or {}).items():
+        if name not in spec:
+            raise ValueError(f"unknown {table} filter {name!r}")
+        if value is None or (isinstance(value, str) and not value.strip()):
+            continue
+        try:
+            clean[name] = spec[name][2](value.strip() if isinstance(value, str) else value)
+        except ValueError:
+            kind = "a number" if spec[name][2] is float else "YYYY-MM-DD" if spec[name][2] is not str else "text"
+            raise ValueError(f"{name} must be {kind}") from None
+    return clean
+
+def filter_matches(table, filters, row):
+    # Python twin of the SQL filter, for rows that change while a page is shown
+    columns = KEYSET_TABLES[table][0]
+    for name, value in filters.items():
+        column, op, _ = QUERY_FILTERS[table][name]
+        have = row[columns.index(column)]
+        if have is None:
+            return False
+        try:
+            if not _FILTER_OPS[op](float(have) if isinstance(value, float) else str(have), value):
+                return False
+        except ValueError:
+            return False
+    return True
+
+def _encode_cursor(order_by, descending, key):
+    import base64
+
+    raw = json.dumps([order_by, descending, key], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(token, order_by, descending, size):
+    import base64
+
+    try:
+        sort, desc, key = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor") from None
+    if sort != order_by or desc != descending or not isinstance(key, list) or len(key) != size:
+        raise ValueError("cursor belongs to a different sort order")
+    return key
+
+# -------- Hot/cold archive (DB.archive, include_archived) --------
+# Appointments and bills older than a cutoff move to a second SQLite file,
+# attached as "archive", so the hot tables and their indexes stay small.
+# Archived rows are read-only: list_appointments/list_bills include them on
+# request and delete_patient removes them together with the patient.
+ARCHIVE_BATCH_SIZE = 5000
+# table -> (columns, column the cutoff applies to)
+ARCHIVE_TABLES = {
+    "appointments": (APPOINTMENT_COLUMNS, "appt_date"),
+    "bills": (BILL_COLUMNS, "created_at"),
+}
+
+def default_archive_name(db_name):
+    # medicare.db -> medicare.archive.db
+    if db_name == ":memory:":
+        return None
+    root, ext = os.path.splitext(db_name)
+    return f"{root}.archive{ext or '.db'}"
+
+# Same columns and stored types as the hot tables; no foreign keys, since
+# the patients live in the other file.
+ARCHIVE_TABLE_SQL = {
+    "appointments": f"""(
+        id INTEGER PRIMARY KEY,
+        pid TEXT NOT NULL,
+        doctor TEXT NOT NULL,
+        dept TEXT,
+        appt_date INTEGER NOT NULL,
+        appt_time INTEGER NOT NULL DEFAULT {NO_TIME},
+        notes TEXT,
+        created_at INTEGER NOT NULL
+    )""",
+    "bills": """(
+        id INTEGER PRIMARY KEY,
+        pid TEXT NOT NULL,
+        consultation INTEGER DEFAULT 0,
+        medicine INTEGER DEFAULT 0,
+        room INTEGER DEFAULT 0,
+        other INTEGER DEFAULT 0,
+        total INTEGER NOT NULL,
+        created_at INTEGER NOT NULL
+    )""",
+}
+ARCHIVE_VERSION = 1  # PRAGMA archive.user_version; 0: text and float columns
+
+def _create_archive_schema(conn):
+    # Files archived before migration 8 are converted in place first
+    legacy = conn.execute("PRAGMA archive.user_version").fetchone()[0] < ARCHIVE_VERSION
+    for table, definition in ARCHIVE_TABLE_SQL.items():
+        exists = conn.execute("SELECT 1 FROM archive.sqlite_master WHERE name = ?", (table,)).fetchone()
+        if exists and legacy:
+            _legacy_converters(conn)
+            _retype_table(conn, table, definition, ARCHIVE_TABLES[table][0], schema="archive", restore=False)
+        else:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS archive.{table} {definition}")
+    conn.execute(f"PRAGMA archive.user_version = {ARCHIVE_VERSION}")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_appointments_pid ON appointments(pid)")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_appointments_date ON appointments(appt_date, appt_time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_bills_pid ON bills(pid)")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_bills_created_at ON bills(created_at)")
+
+def _archive_summary_triggers(conn):
+    # The summaries cover archived history too, so deleting archived rows
+    # (delete_patient) must take them out again. Triggers on an attached
+    # file can only be TEMP, i.e. per connection; the writer creates them.
+    for table, body in (("bills", _bill_summary_sql("old", -1)), ("appointments", _visit_summary_sql("old", -1))):
+        conn.execute(f"CREATE TEMP TRIGGER IF NOT EXISTS archive_{table}_summary_ad "
+                     f"AFTER DELETE ON archive.{table} BEGIN\n{body}\nEND")
+
+# Online backup (DB.backup): pages copied per step, and the pause after each
+# step that leaves the disk (and, without WAL, the database lock) to the app.
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_PAUSE_MS = 5
+
+# Prepared statements kept per connection. Keyset pages, sort orders and
+# filter combinations add up to a few hundred distinct statements, more
+# than sqlite3's default of 128.
+STATEMENT_CACHE_SIZE = 512
+
+# -------- Record cache (DB.get_patient/get_appointment/get_bill) --------
+RECORD_CACHE_SIZE = 4096
+
+class RecordCache:
+    # Size-bounded LRU of records by (table, primary key). Only rows that
+    # exist are cached, so inserts never leave anything stale; every other
+    # mutation invalidates its keys. A lookup that raced with an
+    # invalidation is not stored: put() only succeeds if no invalidation
+    # happened since the caller read `generation` before its query.
+    def __init__(self, size=RECORD_CACHE_SIZE):
+        self.size = size
+        self.generation = 0
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(key)
+            self.hits += 1
+            return row
+
+    def put(self, key, row, generation):
+        with self._lock:
+            if generation != self.generation or self.size <= 0:
+                return
+            self._rows[key] = row
+            self._rows.move_to_end(key)
+            if len(self._rows) > self.size:
+                self._rows.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                if self._rows.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self, table=None):
+        with self._lock:
+            self.generation += 1
+            for key in [k for k in self._rows if table is None or k[0] == table]:
+                del self._rows[key]
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._rows), "capacity": self.size, "hits": self.hits, "misses": self.misses,
+                    "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+                    "evictions": self.evictions, "invalidations": self.invalidations}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+BUSY_TIMEOUT_MS = 5000
+READ_POOL_SIZE = 4
+CACHE_KIB = 16 * 1024
+
 class DB:
-    def __init__(self, db_name: str = DB_NAME):
-        self.conn = sqlite3.connect(db_name)
+    # Representative statements behind each list method, used by query_plans()
+    PLAN_QUERIES = [
+        ("list_patients()", "SELECT pid, name, age, gender, phone, disease, address, created_at FROM patients ORDER BY created_at DESC", ()),
+        ("list_patients(search)", "SELECT p.pid FROM patients_fts JOIN patients p ON p.rowid = patients_fts.rowid WHERE patients_fts MATCH ? ORDER BY patients_fts.rowid DESC LIMIT 200", ('"ra"*',)),
+        ("list_appointments()", "SELECT id, pid, doctor, dept, appt_date, appt_time, notes, created_at FROM appointments ORDER BY appt_date DESC, appt_time DESC", ()),
+        ("list_appointments(pid)", "SELECT id, pid, doctor, dept, appt_date, appt_time, notes, created_at FROM appointments WHERE pid=? ORDER BY appt_date DESC, appt_time DESC", ("P001",)),
+        ("list_bills()", "SELECT id, pid, consultation, medicine, room, other, total, created_at FROM bills ORDER BY created_at DESC", ()),
+        ("list_bills(pid)", "SELECT id, pid, consultation, medicine, room, other, total, created_at FROM bills WHERE pid=? ORDER BY created_at DESC", ("P001",)),
+        ("query_patients(cursor)", "SELECT pid FROM patients WHERE (created_at, pid) < (?, ?) ORDER BY created_at DESC, pid DESC LIMIT 101", (1717200000, "P001")),
+        ("query_appointments(doctor, dates, cursor)", "SELECT id FROM appointments WHERE doctor = ? AND appt_date >= ? AND appt_date <= ? AND (appt_date, appt_time, id) < (?, ?, ?) ORDER BY appt_date DESC, appt_time DESC, id DESC LIMIT 101", ("Dr. Gupta", 19723, 19729, 19727, 600, 99)),
+        ("query_appointments(dept, cursor)", "SELECT id FROM appointments WHERE dept = ? AND (appt_date, appt_time, id) < (?, ?, ?) ORDER BY appt_date DESC, appt_time DESC, id DESC LIMIT 101", ("Cardiologist", 19727, 600, 99)),
+        ("query_bills(amount, cursor)", "SELECT id FROM bills WHERE total >= ? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 101", (100000, 1717200000, 99)),
+        # delete_patient: the cascade looks up child rows by pid
+        ("delete_patient -> appointments", "SELECT id FROM appointments WHERE pid=?", ("P001",)),
+        ("delete_patient -> bills", "SELECT id FROM bills WHERE pid=?", ("P001",)),
+        ("delete_patient -> archived bills", "SELECT id FROM archive.bills WHERE pid=?", ("P001",)),
+        ("revenue_by_day()", "SELECT day, total FROM daily_revenue WHERE day >= ? AND day <= ? ORDER BY day", (19723, 19753)),
+        ("top_patients()", "SELECT pid, total FROM patient_spend ORDER BY total DESC LIMIT 20", ()),
+        ("poll_changes()", "SELECT seq, tbl, key, op FROM change_log WHERE seq > ? ORDER BY seq LIMIT 501", (0,)),
+        ("Schedule occupancy", "SELECT appt_date, appt_time, id FROM appointments WHERE doctor=? AND appt_date BETWEEN ? AND ?", ("Dr. Roy", 19723, 19729)),
+    ]
+
+    # Process-wide QueryMetrics that new instances report to; see instrument()
+    metrics = None
+
+    def __init__(self, db_name: str = DB_NAME, migrate: bool = True, group_commit_ms: int = None,
+                 wal: bool = True, busy_timeout_ms: int = BUSY_TIMEOUT_MS, readers: int = READ_POOL_SIZE,
+                 cache_kib: int = CACHE_KIB, metrics: "QueryMetrics" = None, archive_name: str = None,
+                 record_cache_size: int = RECORD_CACHE_SIZE):
+        # group_commit_ms: coalesce the commits of a burst of writes into one,
+        # issued at most this many ms after the first write of the burst.
+        # Writes are visible on this connection at once, but others (and the
+        # disk) see them only after the group commit.
+        #
+        # self.conn is the single, serialized writer. Reads go through a pool
+        # of up to `readers` query-only connections which, in WAL mode, never
+        # wait for the writer. WAL needs shared memory, so the database must
+        # not live on a network share.
+        #
+        # archive_name: file that archive() moves old rows to; default
+        # medicare.archive.db next to the database.
+        self.db_name = db_name
+        self.archive_name = archive_name or default_archive_name(db_name)
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_kib = cache_kib
+        self.metrics = metrics or DB.metrics
+        self.conn = self._connect()
         self.conn.execute("PRAGMA foreign_keys = ON")
+        self.wal = False
+        if wal and db_name != ":memory:":
+            mode = self.conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            self.wal = mode.lower() == "wal"
+            if self.wal:
+                # Durable at checkpoints; a power cut can only lose the last commits
+                self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.group_commit_ms = group_commit_ms
+        self._lock = threading.RLock()
+        self._tx_depth = 0
+        self._flush_timer = None
+        # Bumped by every patient mutation so caches (PatientDirectory) can
+        # tell when they are stale.
+        self.generation = 0
+        # Point lookups by primary key. Keys written inside a transaction are
+        # invalidated again when it ends, since until then pooled readers
+        # still see (and may cache) the old row.
+        self.cache = RecordCache(record_cache_size)
+        self._uncommitted = set()
+        self._pool = queue.LifoQueue() if readers and db_name != ":memory:" else None
+        self._pool_size = readers
+        self._pool_open = 0
         self.init_schema()
+        if migrate:
+            self.migrate()
+        self.has_search_index = self._table_exists("patients_fts")
+        self.has_change_log = self._table_exists("change_log")
+        # poll_changes() reports change_log entries after change_seq
+        self.change_seq = self._change_log_head()
+        self._data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self._cache_version = self._data_version  # see _cache_current()
+        self._attach_archive(self.conn)
+        if self.metrics is not None:
+            self._instrument_methods()
+
+    def _instrument_methods(self):
+        # Shadow the public methods on this instance with timed versions
+        for name, fn in vars(DB).items():
+            if callable(fn) and not name.startswith("_") and name not in _UNTIMED_METHODS and name.islower():
+                setattr(self, name, self.metrics.wrap(name, getattr(self, name)))
+        # so the COMMIT that ends a unit of work is timed too
+        self._commit = self.metrics.wrap("commit", self._commit)
+
+    def metrics_snapshot(self):
+        return self.metrics.snapshot(self) if self.metrics is not None else None
 
     def init_schema(self):
+        # The original layout; the migrations take it from there (stored
+        # types: see TYPED_TABLES)
         cur = self.conn.cursor()
         # Patients
         cur.execute(
@@ -63,86 +1348,1717 @@ class DB:
         )
         self.conn.commit()
 
-    # -------- Patients --------
-    def add_patient(self, pid, name, age, gender, phone, disease, address):
+    # -------- Connections --------
+    def _connect(self):
+        conn = sqlite3.connect(self.db_name, timeout=self.busy_timeout_ms / 1000, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA cache_size = {-int(self.cache_kib)}")
+        if self.metrics is not None:
+            conn.set_trace_callback(self.metrics.tracer(self.db_name))
+        return conn
+
+    def _open_reader(self):
+        conn = self._connect()
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def _records(self, conn, table, sql, params=(), many=False):
+        # A cursor on conn that returns table's record type; many: a large
+        # result, worth sharing repeated values
+        cur = conn.cursor()
+        cur.row_factory = _record_factory(RECORD_TYPES[table], many)
+        return cur.execute(sql, params)
+
+    @contextmanager
+    def _reading(self):
+        # A pooled read connection. While this connection has uncommitted
+        # writes (a unit of work or pending group commit) reads use the writer
+        # instead so they see them.
+        if self._pool is None or self.conn.in_transaction:
+            with self._lock:
+                yield self.conn
+            return
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                grow = self._pool_open < self._pool_size
+                if grow:
+                    self._pool_open += 1
+            conn = self._open_reader() if grow else self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    # -------- Transactions --------
+    @contextmanager
+    def transaction(self):
+        # Unit of work: the mutations inside commit together (once) or not at
+        # all. Nested units become savepoints, so an inner failure that the
+        # caller handles only undoes the inner unit.
+        with self._lock:
+            savepoint = None
+            if self.conn.in_transaction:
+                # nested, or joining a pending group commit
+                savepoint = f"uow_{self._tx_depth}"
+                self.conn.execute(f"SAVEPOINT {savepoint}")
+            else:
+                # IMMEDIATE takes the write lock up front (waiting up to
+                # busy_timeout). A deferred BEGIN that reads first cannot
+                # upgrade once another connection has committed, and fails
+                # at once with "database is locked".
+                self.conn.execute("BEGIN IMMEDIATE")
+            self._tx_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._tx_depth -= 1
+                if savepoint:
+                    self.conn.execute(f"ROLLBACK TO {savepoint}")
+                    self.conn.execute(f"RELEASE {savepoint}")
+                else:
+                    self.conn.rollback()
+                    self._settle()
+                raise
+            self._tx_depth -= 1
+            if savepoint:
+                self.conn.execute(f"RELEASE {savepoint}")
+            self._commit()
+
+    def _commit(self):
+        if self._tx_depth:
+            return  # the enclosing unit of work commits
+        if self.group_commit_ms is None:
+            self.conn.commit()
+            self._settle()
+        elif self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.group_commit_ms / 1000, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        # Commit a pending group commit now
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self._tx_depth == 0 and self.conn.in_transaction:
+                self.conn.commit()
+                self._settle()
+
+    def _changed(self, changes):
+        # Every mutation reports its Change list here before returning it
+        keys = [(c.table, c.key) for c in changes]
+        self.cache.invalidate(keys)
+        if self.conn.in_transaction:
+            self._uncommitted.update(keys)
+        return changes
+
+    def _settle(self):
+        # The writer's transaction ended (commit or rollback)
+        if self._uncommitted:
+            self.cache.invalidate(self._uncommitted)
+            self._uncommitted.clear()
+
+    def close(self):
+        self.flush()
+        while self._pool is not None and not self._pool.empty():
+            self._pool.get_nowait().close()
+        self.conn.close()
+
+    def schema_version(self) -> int:
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self):
+        # Apply pending migrations, one transaction each, and return the
+        # (version, description) pairs that were applied. Foreign keys are
+        # off meanwhile, as table rebuilds (migration 8) must not cascade;
+        # the pragma only takes effect outside a transaction.
+        if self.schema_version() > SCHEMA_VERSION:
+            # Written by a newer build, whose stored types this one would misread
+            raise ValueError(f"{self.db_name} has schema version {self.schema_version()}; "
+                             f"this program knows up to {SCHEMA_VERSION}")
+        applied = []
+        for version, description, steps in MIGRATIONS:
+            if version <= self.schema_version():
+                continue
+            self.conn.execute("PRAGMA foreign_keys = OFF")
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for step in steps:
+                    if callable(step):
+                        step(self.conn)
+                    else:
+                        self.conn.execute(step)
+                self.conn.execute(f"PRAGMA user_version = {int(version)}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                self.conn.execute("PRAGMA foreign_keys = ON")
+            applied.append((version, description))
+        return applied
+
+    def _table_exists(self, name) -> bool:
+        row = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name=?", (name,)).fetchone()
+        return row is not None
+
+    def rebuild_search_index(self):
+        if self.has_search_index:
+            with self.transaction():
+                self.conn.execute("INSERT INTO patients_fts(patients_fts) VALUES ('rebuild')")
+
+    def explain(self, sql, params=()):
+        return [row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+    def query_plans(self):
+        plans = []
+        for label, sql, params in self.PLAN_QUERIES:
+            try:
+                plans.append((label, self.explain(sql, params)))
+            except sqlite3.OperationalError as e:
+                # e.g. the search index does not exist before migration 2
+                plans.append((label, [f"n/a ({e})"]))
+        return plans
+
+    # -------- Bulk import --------
+    def import_file(self, table, path, fmt=None, rejects=None, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+        # Stream records from a CSV/JSONL file into table. Records are
+        # validated with the form rules and inserted with executemany, one
+        # transaction per chunk. Rejected records go to the rejects file;
+        # progress(stats) is called after every chunk. Rejects are held until
+        # their chunk is checked against the table and written in line order.
+        if table not in IMPORT_TABLES:
+            raise ValueError(f"cannot import into {table!r}")
+        fmt = _file_format(path, fmt)
+        stats = {"table": table, "read": 0, "imported": 0, "rejected": 0, "seconds": 0.0}
+        writer = RejectWriter(rejects, fmt)
+        started = time.perf_counter()
+        chunk, rejected = [], []
+        # A bigger page cache keeps index maintenance in memory for the chunk
+        cache_size = self.conn.execute("PRAGMA cache_size").fetchone()[0]
+        self.conn.execute(f"PRAGMA cache_size = {-IMPORT_CACHE_KIB}")
+        try:
+            for line_no, record, error in read_records(path, fmt):
+                stats["read"] += 1
+                if error is None:
+                    try:
+                        chunk.append((line_no, record, IMPORT_TABLES[table][1](record)))
+                    except ValueError as e:
+                        error = str(e)
+                if error is not None:
+                    rejected.append((line_no, record, error))
+                if len(chunk) >= chunk_size:
+                    self._import_chunk(table, chunk, rejected, stats)
+                    self._write_rejects(writer, rejected, stats)
+                    chunk, rejected = [], []
+                    stats["seconds"] = time.perf_counter() - started
+                    if progress:
+                        progress(stats)
+            if chunk:
+                self._import_chunk(table, chunk, rejected, stats)
+            self._write_rejects(writer, rejected, stats)
+        finally:
+            writer.close()
+            self.conn.execute(f"PRAGMA cache_size = {int(cache_size)}")
+        stats["seconds"] = time.perf_counter() - started
+        if progress:
+            progress(stats)
+        return stats
+
+    def _existing_pids(self, pids):
+        found = set()
+        pids = list(pids)
+        for i in range(0, len(pids), 500):
+            part = pids[i:i + 500]
+            found.update(r[0] for r in self.conn.execute(
+                f"SELECT pid FROM patients WHERE pid IN ({','.join('?' * len(part))})", part))
+        return found
+
+    @staticmethod
+    def _write_rejects(writer, rejected, stats):
+        rejected.sort(key=lambda r: r[0])
+        for line_no, record, error in rejected:
+            writer.write(line_no, record, error)
+        stats["rejected"] += len(rejected)
+
+    def _import_chunk(self, table, chunk, rejected, stats):
+        # Reject what would violate a constraint so one bad row cannot abort the batch
+        existing = self._existing_pids({values[0] for _, _, values in chunk})
+        rows, seen = [], set()
+        for line_no, record, values in chunk:
+            pid = values[0]
+            if table == "patients":
+                error = "Patient ID already exists" if pid in existing or pid in seen else None
+                seen.add(pid)
+            else:
+                error = None if pid in existing else "Unknown patient ID"
+            if error:
+                rejected.append((line_no, record, error))
+            else:
+                rows.append(values)
+        if rows:
+            self.insert_rows(table, rows)
+        stats["imported"] += len(rows)
+
+    def insert_rows(self, table, rows):
+        # Unchecked bulk insert of IMPORT_TABLES value tuples, one unit of work.
+        # Plain inserts of new keys, so the record cache has nothing to drop.
+        with self.transaction():
+            if table == "patients" and self.has_search_index:
+                self._insert_patients_indexed(rows)
+            else:
+                self.conn.executemany(IMPORT_TABLES[table][0], rows)
+        if table == "patients":
+            self.generation += 1
+
+    def _insert_patients_indexed(self, rows):
+        # Indexing row by row through the FTS trigger is several times slower
+        # than one INSERT ... SELECT, so the trigger is lifted for the chunk.
+        # This all happens inside the caller's transaction.
+        trigger_sql = self.conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type='trigger' AND name='patients_fts_ai'").fetchone()[0]
+        start = self.conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM patients").fetchone()[0]
+        self.conn.execute("DROP TRIGGER patients_fts_ai")
+        self.conn.executemany(IMPORT_TABLES["patients"][0], rows)
+        cols = ", ".join(PATIENT_FTS_COLUMNS)
         self.conn.execute(
-            "INSERT INTO patients(pid, name, age, gender, phone, disease, address, created_at) VALUES (?,?,?,?,?,?,?,?)",
-            (pid, name, age, gender, phone, disease, address, datetime.now().isoformat(timespec="seconds")),
+            f"INSERT INTO patients_fts(rowid, {cols}) SELECT rowid, {cols} FROM patients WHERE rowid > ?", (start,))
+        self.conn.execute(trigger_sql)
+
+    # -------- Reports --------
+    def rebuild_summaries(self):
+        archived = self._attach_archive(self.conn)
+        with self.transaction():
+            _rebuild_summaries(self.conn, archived)
+
+    @staticmethod
+    def _day_range(date_from, date_to):
+        # Inclusive YYYY-MM-DD bounds as stored days; None is open-ended
+        return (_epoch_day(date_from) if date_from else -(1 << 31),
+                _epoch_day(date_to) if date_to else 1 << 31)
+
+    def revenue_by_day(self, date_from=None, date_to=None):
+        # (day, bills, consultation, medicine, room, other, total), oldest first
+        with self._reading() as conn:
+            return conn.execute(
+                f"SELECT {_read_day('day')}, bills, "
+                f"{_read_columns(_REVENUE_COLUMNS)} FROM daily_revenue WHERE day >= ? AND day <= ? ORDER BY day",
+                self._day_range(date_from, date_to),
+            ).fetchall()
+
+    def visits_by_doctor(self, date_from=None, date_to=None):
+        # (doctor, dept, visits) over the range, busiest first
+        with self._reading() as conn:
+            return conn.execute(
+                "SELECT doctor, dept, SUM(visits) FROM doctor_visits WHERE day >= ? AND day <= ? "
+                "GROUP BY doctor, dept ORDER BY 3 DESC, doctor",
+                self._day_range(date_from, date_to),
+            ).fetchall()
+
+    def visits_by_day(self, date_from=None, date_to=None):
+        # (day, doctor, dept, visits)
+        with self._reading() as conn:
+            return conn.execute(
+                f"SELECT {_read_day('day')}, doctor, dept, visits "
+                "FROM doctor_visits WHERE day >= ? AND day <= ? ORDER BY day, doctor",
+                self._day_range(date_from, date_to),
+            ).fetchall()
+
+    def top_patients(self, limit=20):
+        # (pid, name, bills, lifetime total), biggest spenders first
+        with self._reading() as conn:
+            return conn.execute(
+                f"SELECT s.pid, p.name, s.bills, {_read_columns(('total',), 's.')} FROM patient_spend s "
+                "LEFT JOIN patients p ON p.pid = s.pid ORDER BY s.total DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+
+    def patient_spend(self, pid):
+        with self._reading() as conn:
+            row = conn.execute(f"SELECT bills, {_read_columns(('total',))} FROM patient_spend WHERE pid=?",
+                               (pid,)).fetchone()
+        return row or (0, 0.0)
+
+    # -------- Streaming export --------
+    def iter_rows(self, sql, params=(), chunk_size=EXPORT_CHUNK_SIZE):
+        # Yield rows from a dedicated cursor in fetchmany() chunks, so only one
+        # chunk is ever held in memory.
+        with self._reading() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(sql, params)
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                cur.close()
+
+    def export_query(self, table, pid=None, date_from=None, date_to=None, doctor=None):
+        # Build the SELECT behind export(); date_to is inclusive. Dates are
+        # compared in their stored form so the date indexes are used.
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"cannot export {table!r}")
+        columns, date_col = EXPORT_TABLES[table]
+        where, params = [], []
+        if pid:
+            where.append("pid = ?")
+            params.append(pid)
+        if doctor:
+            if table != "appointments":
+                raise ValueError("doctor filter only applies to appointments")
+            where.append("doctor = ?")
+            params.append(doctor)
+        if date_from:
+            where.append(f"{date_col} >= ?")
+            params.append(_stored(date_col, _day(date_from)))
+        if date_to:
+            where.append(f"{date_col} < ?")
+            params.append(_stored(date_col, _day_after(date_to)))
+        sql = f"SELECT {_read_columns(columns)} FROM {table}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        # Follow an index when filtering by date, otherwise table order is cheapest
+        sql += f" ORDER BY {date_col}" if (date_from or date_to) else f" ORDER BY {columns[0]}"
+        return columns, sql, params
+
+    def export(self, table, out, fmt="csv", chunk_size=EXPORT_CHUNK_SIZE, **filters):
+        # Stream table (optionally filtered by pid, date_from, date_to or
+        # doctor) to the text stream out as CSV or JSONL. Returns the row count.
+        columns, sql, params = self.export_query(table, **filters)
+        count = 0
+        if fmt == "csv":
+            import csv
+
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            for row in self.iter_rows(sql, params, chunk_size):
+                writer.writerow(row)
+                count += 1
+        elif fmt == "jsonl":
+            for row in self.iter_rows(sql, params, chunk_size):
+                out.write(json.dumps(dict(zip(columns, row))) + "\n")
+                count += 1
+        else:
+            raise ValueError(f"unsupported format {fmt!r}")
+        return count
+
+    # -------- Statements --------
+    def bill_statement_rows(self, date_from=None, date_to=None, bill_ids=None, by_patient=False):
+        # Bills joined to their patient's name in one indexed query, streamed.
+        # by_patient orders rows so each patient's bills are contiguous.
+        where, params = [], []
+        if date_from:
+            where.append("b.created_at >= ?")
+            params.append(_epoch_seconds(_day(date_from)))
+        if date_to:
+            where.append("b.created_at < ?")
+            params.append(_epoch_seconds(_day_after(date_to)))
+        if bill_ids is not None:
+            bill_ids = [int(i) for i in bill_ids]
+            if not bill_ids:
+                return iter(())
+            # json_each keeps the statement to one parameter however many ids
+            where.append("b.id IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(bill_ids))
+        sql = (
+            f"SELECT {_read_columns(BILL_COLUMNS, 'b.')}, p.name FROM bills b LEFT JOIN patients p ON p.pid = b.pid"
         )
-        self.conn.commit()
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY b.pid, b.created_at, b.id" if by_patient else " ORDER BY b.id"
+        return self.iter_rows(sql, params)
+
+    # -------- Patients --------
+    def _cache_current(self):
+        # The record cache only hears of this DB's own writes, so it is
+        # dropped once another connection has committed: the writer's
+        # data_version moves for foreign commits only. poll_changes() keeps
+        # its own marker. While the writer is busy the check is skipped and
+        # the caller reads through instead of waiting.
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        finally:
+            self._lock.release()
+        if version != self._cache_version:
+            self.cache.clear()
+            self._cache_version = version
+        return True
+
+    def _lookup(self, table, key, sql):
+        # Primary-key read through the record cache
+        if self._cache_current():
+            row = self.cache.get((table, key))
+            if row is not None:
+                return row
+        generation = self.cache.generation
+        with self._reading() as conn:
+            row = self._records(conn, table, sql, (key,)).fetchone()
+            # Not while the writer's own transaction is pending: that row may
+            # still roll back
+            committed = not (conn is self.conn and conn.in_transaction)
+        if row is not None and committed:
+            self.cache.put((table, key), row, generation)
+        return row
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def get_patient(self, pid):
+        return self._lookup("patients", pid, f"SELECT {SELECT_COLUMNS['patients']} FROM patients WHERE pid=?")
+
+    def add_patient(self, pid, name, age, gender, phone, disease, address):
+        row = (pid, name, age, gender, phone, disease, address, datetime.now().isoformat(timespec="seconds"))
+        with self.transaction():
+            self.conn.execute(INSERT_SQL["patients"], row)
+        self.generation += 1
+        return self._changed([Change("patients", "insert", pid, row)])
 
     def update_patient(self, pid, name, age, gender, phone, disease, address):
-        self.conn.execute(
-            "UPDATE patients SET name=?, age=?, gender=?, phone=?, disease=?, address=? WHERE pid=?",
-            (name, age, gender, phone, disease, address, pid),
-        )
-        self.conn.commit()
+        with self.transaction():
+            cur = self.conn.execute(
+                "UPDATE patients SET name=?, age=?, gender=?, phone=?, disease=?, address=? WHERE pid=?",
+                (name, age, gender, phone, disease, address, pid),
+            )
+            if not cur.rowcount:
+                return []
+            row = self.conn.execute(f"SELECT {SELECT_COLUMNS['patients']} FROM patients WHERE pid=?", (pid,)).fetchone()
+        self.generation += 1
+        return self._changed([Change("patients", "update", pid, row)])
 
     def delete_patient(self, pid):
-        self.conn.execute("DELETE FROM patients WHERE pid=?", (pid,))
-        self.conn.commit()
+        # Collect the rows ON DELETE CASCADE will remove so views can drop them too.
+        # The cascade cannot reach the archive file, so archived rows are
+        # deleted explicitly in the same transaction.
+        archived = self._attach_archive(self.conn)
+        with self.transaction():
+            changes = [Change("appointments", "delete", r[0], None)
+                       for r in self.conn.execute("SELECT id FROM appointments WHERE pid=?", (pid,))]
+            changes += [Change("bills", "delete", r[0], None)
+                        for r in self.conn.execute("SELECT id FROM bills WHERE pid=?", (pid,))]
+            cur = self.conn.execute("DELETE FROM patients WHERE pid=?", (pid,))
+            if cur.rowcount and archived:
+                for table in ARCHIVE_TABLES:
+                    changes += [Change(table, "delete", r[0], None)
+                                for r in self.conn.execute(f"SELECT id FROM archive.{table} WHERE pid=?", (pid,))]
+                    self.conn.execute(f"DELETE FROM archive.{table} WHERE pid=?", (pid,))
+        if not cur.rowcount:
+            return []
+        self.generation += 1
+        return self._changed(changes + [Change("patients", "delete", pid, None)])
 
-    def list_patients(self, search: str = ""):
-        cur = self.conn.cursor()
-        if search:
-            like = f"%{search}%"
-            cur.execute(
-                "SELECT pid, name, age, gender, phone, disease, address, created_at FROM patients "
-                "WHERE pid LIKE ? OR name LIKE ? OR phone LIKE ? ORDER BY created_at DESC",
-                (like, like, like),
-            )
+    def list_patients(self, search: str = "", limit: int = None, offset: int = 0,
+                      order_by: str = None, descending: bool = True):
+        with self._reading() as conn:
+            return _patient_rows(conn, search, limit, offset, order_by, descending, self.has_search_index)
+
+    # -------- Filtered keyset pages --------
+    def _query_page(self, table, filters, order_by, descending, limit, cursor):
+        # One page of rows and the cursor of the next page (None at the end).
+        # The page seeks past the previous page's last sort key instead of
+        # using OFFSET, so every page costs the same, and rows inserted or
+        # deleted meanwhile do not shift it.
+        columns, default, tiebreak, nullable = KEYSET_TABLES[table]
+        if order_by is None:
+            keys, descending = list(default), True
+        elif order_by not in columns:
+            raise ValueError(f"cannot sort by {order_by!r}")
         else:
-            cur.execute(
-                "SELECT pid, name, age, gender, phone, disease, address, created_at FROM patients ORDER BY created_at DESC"
+            keys = [order_by]
+        if tiebreak not in keys:
+            keys.append(tiebreak)
+        exprs = [f"COALESCE({k}, '')" if k in nullable else k for k in keys]
+        where, params = [], []
+        for name, value in normalize_filters(table, filters).items():
+            column, op, _ = QUERY_FILTERS[table][name]
+            where.append(f"{column} {op} ?")
+            params.append(_stored(column, value))
+        if cursor:
+            where.append(f"({', '.join(exprs)}) {'<' if descending else '>'} ({', '.join('?' * len(keys))})")
+            params.extend(_decode_cursor(cursor, order_by, descending, len(keys)))
+        direction = "DESC" if descending else "ASC"
+        sql = f"SELECT {SELECT_COLUMNS[table]} FROM {table}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY " + ", ".join(f"{e} {direction}" for e in exprs) + " LIMIT ?"
+        with self._reading() as conn:
+            rows = self._records(conn, table, sql, params + [limit + 1], many=limit > PAGE_SIZE).fetchall()
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        last = rows[-1]
+        # The cursor holds the key as stored, ready to compare
+        key = [last[columns.index(k)] for k in keys]
+        key = ["" if v is None else _stored(k, v) for k, v in zip(keys, key)]
+        return rows, _encode_cursor(order_by, descending, key)
+
+    def query_patients(self, filters=None, order_by=None, descending=True, limit=PAGE_SIZE, cursor=None):
+        return self._query_page("patients", filters, order_by, descending, limit, cursor)
+
+    def query_appointments(self, filters=None, order_by=None, descending=True, limit=PAGE_SIZE, cursor=None):
+        # filters: pid, doctor, dept, date_from/date_to (appointment date),
+        # created_from/created_to (booked on); see QUERY_FILTERS
+        return self._query_page("appointments", filters, order_by, descending, limit, cursor)
+
+    def query_bills(self, filters=None, order_by=None, descending=True, limit=PAGE_SIZE, cursor=None):
+        # filters: pid, date_from/date_to (bill date), amount_min/amount_max (total)
+        return self._query_page("bills", filters, order_by, descending, limit, cursor)
+
+    # -------- Appointments --------
+    def add_appointment(self, pid, doctor, dept, appt_date, appt_time,notes):
+        appt_date, appt_time = appointment_slot(appt_date, appt_time)
+        values = (pid, doctor, dept, appt_date, appt_time, notes, datetime.now().isoformat(timespec="seconds"))
+        with self.transaction():
+            cur = self.conn.execute(INSERT_SQL["appointments"], values)
+        return self._changed([Change("appointments", "insert", cur.lastrowid, (cur.lastrowid,) + values)])
+
+    def add_appointments(self, rows):
+        # rows: (pid, doctor, dept, appt_date, appt_time, notes); one unit of work
+        created = datetime.now().isoformat(timespec="seconds")
+        changes = []
+        with self.transaction():
+            for pid, doctor, dept, appt_date, appt_time, notes in rows:
+                values = (pid, doctor, dept, *appointment_slot(appt_date, appt_time), notes, created)
+                cur = self.conn.execute(INSERT_SQL["appointments"], values)
+                changes.append(Change("appointments", "insert", cur.lastrowid, (cur.lastrowid,) + values))
+        return self._changed(changes)
+
+    def get_appointment(self, appt_id):
+        return self._lookup("appointments", int(appt_id),
+                            f"SELECT {SELECT_COLUMNS['appointments']} FROM appointments WHERE id=?")
+
+    def update_appointment(self, appt_id, pid, doctor, dept, appt_date, appt_time, notes):
+        appt_date, appt_time = appointment_slot(appt_date, appt_time)
+        with self.transaction():
+            cur = self.conn.execute(
+                f"UPDATE appointments SET {_write_set(('pid', 'doctor', 'dept', 'appt_date', 'appt_time', 'notes'))} "
+                "WHERE id=?",
+                (pid, doctor, dept, appt_date, appt_time, notes, appt_id),
             )
-        return cur.fetchall()
+            if not cur.rowcount:
+                return []
+            row = self.conn.execute(f"SELECT {SELECT_COLUMNS['appointments']} FROM appointments WHERE id=?",
+                                    (appt_id,)).fetchone()
+        return self._changed([Change("appointments", "update", row[0], row)])
+
+    def delete_appointment(self, appt_id):
+        with self.transaction():
+            cur = self.conn.execute("DELETE FROM appointments WHERE id=?", (appt_id,))
+        return self._changed([Change("appointments", "delete", int(appt_id), None)] if cur.rowcount else [])
+
+    def list_appointments(self, pid_filter: str = "", limit: int = None, offset: int = 0,
+                          order_by: str = None, descending: bool = True, include_archived: bool = False):
+        order = _order_clause(APPOINTMENT_COLUMNS, order_by, descending, "ORDER BY appt_date DESC, appt_time DESC", "id")
+        return self._list_hot_and_cold("appointments", pid_filter, order, limit, offset, include_archived)
+
+    # -------- Bills --------
+    def add_bill(self, pid, consultation, medicine, room, other):
+        # The event carries the amounts as stored, rounded to cents
+        amounts = [_money(a) for a in (consultation, medicine, room, other)]
+        values = (pid, *amounts, bill_total(*amounts), datetime.now().isoformat(timespec="seconds"))
+        with self.transaction():
+            cur = self.conn.execute(INSERT_SQL["bills"], values)
+        return self._changed([Change("bills", "insert", cur.lastrowid, (cur.lastrowid,) + values)])
+
+    def get_bill(self, bill_id):
+        return self._lookup("bills", int(bill_id), f"SELECT {SELECT_COLUMNS['bills']} FROM bills WHERE id=?")
+
+    def update_bill(self, bill_id, consultation, medicine, room, other):
+        total = bill_total(consultation, medicine, room, other)
+        with self.transaction():
+            cur = self.conn.execute(
+                f"UPDATE bills SET {_write_set(_REVENUE_COLUMNS)} WHERE id=?",
+                (consultation, medicine, room, other, total, bill_id),
+            )
+            if not cur.rowcount:
+                return []
+            row = self.conn.execute(f"SELECT {SELECT_COLUMNS['bills']} FROM bills WHERE id=?", (bill_id,)).fetchone()
+        return self._changed([Change("bills", "update", row[0], row)])
+
+    def delete_bill(self, bill_id):
+        with self.transaction():
+            cur = self.conn.execute("DELETE FROM bills WHERE id=?", (bill_id,))
+        return self._changed([Change("bills", "delete", int(bill_id), None)] if cur.rowcount else [])
+
+    def list_bills(self, pid_filter: str = "", limit: int = None, offset: int = 0,
+                   order_by: str = None, descending: bool = True, include_archived: bool = False):
+        order = _order_clause(BILL_COLUMNS, order_by, descending, "ORDER BY created_at DESC", "id")
+        return self._list_hot_and_cold("bills", pid_filter, order, limit, offset, include_archived)
+
+    def _list_hot_and_cold(self, table, pid_filter, order, limit, offset, include_archived):
+        # One page of table, optionally UNIONed with its archived rows; the
+        # ORDER BY then sorts the combined result.
+        columns = ARCHIVE_TABLES[table][0]
+        where, params = "", ()
+        if pid_filter:
+            where, params = " WHERE pid=?", (pid_filter,)
+        with self._reading() as conn:
+            sql = f"SELECT {SELECT_COLUMNS[table]} FROM main.{table}{where}"
+            if include_archived and self._attach_archive(conn):
+                # The compound's ORDER BY can only name result columns, so it
+                # sorts the API values (which sort like the stored ones)
+                cols = _read_columns(columns, named=True)
+                sql = f"SELECT {cols} FROM main.{table}{where} UNION ALL SELECT {cols} FROM archive.{table}{where}"
+                params += params
+            return self._records(conn, table, f"{sql} {order} LIMIT ? OFFSET ?",
+                                 params + (-1 if limit is None else limit, offset),
+                                 many=limit is None or limit > PAGE_SIZE).fetchall()
+
+    # -------- Changes from other workstations --------
+    def _change_log_head(self):
+        row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+        return row[0] if row else 0
+
+    def poll_changes(self, limit=CHANGE_FETCH_LIMIT):
+        # Changes other connections (workstations, the service, imports)
+        # committed since the last poll, as Change events carrying the rows as
+        # they are now; one PRAGMA when nothing changed. None means more than
+        # `limit` log entries (or a pruned gap): reload rather than patch.
+        # Our own writes are skipped unless they are interleaved with foreign
+        # ones; applying those again is harmless.
+        if not self.has_change_log:
+            return []
+        with self._lock:
+            if self.conn.in_transaction:
+                return []  # our log entries may still roll back; next time
+            # The head is read before the version: if no one else committed by
+            # then, every entry up to it is ours
+            head = self._change_log_head()
+            version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self._data_version:
+                self.change_seq = head
+                return []
+            self._data_version = version
+            seen = self.change_seq
+            first = self.conn.execute("SELECT MIN(seq) FROM change_log").fetchone()[0]
+            log = self.conn.execute("SELECT seq, tbl, key, op FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?",
+                                    (seen, limit + 1)).fetchall()
+            if len(log) > limit or (first is not None and first > seen + 1):
+                self.change_seq = self._change_log_head()
+                self.cache.clear()
+                self.generation += 1
+                return None
+            if not log:
+                return []
+            self.change_seq = log[-1][0]
+            ops = {}  # (table, key) -> first op since the last poll
+            for _, table, key, op in log:
+                ops.setdefault((table, key), op)
+            rows = {}
+            for table, key_column in CHANGE_LOG_TABLES.items():
+                keys = [k for t, k in ops if t == table]
+                if keys:
+                    sql = (f"SELECT {SELECT_COLUMNS[table]} FROM {table} "
+                           f"WHERE {key_column} IN ({', '.join('?' * len(keys))})")
+                    rows.update(((table, r[0]), r) for r in self._records(self.conn, table, sql, keys))
+        changes = []
+        for (table, key), op in ops.items():
+            row = rows.get((table, key))
+            if row is None:
+                changes.append(Change(table, "delete", key, None))
+            else:
+                changes.append(Change(table, "insert" if op == "insert" else "update", key, row))
+        if any(c.table == "patients" for c in changes):
+            self.generation += 1
+        return self._changed(changes)
+
+    # -------- Backup --------
+    def backup(self, dest, pages=BACKUP_PAGES_PER_STEP, pause_ms=BACKUP_PAUSE_MS, verify=True, progress=None):
+        # Copy the database (and its archive file, to the matching
+        # dest.archive.db) with sqlite's online backup API while the app
+        # keeps working. The copy reads through its own connection. In WAL
+        # mode that connection pins one snapshot for the whole copy, so
+        # writers carry on and never force the backup to start over. With a
+        # rollback journal a pinned snapshot would lock writers out until the
+        # end, so there each step locks on its own and a write restarts it.
+        # Each file is written to <dest>.part, checked with integrity_check
+        # and only then renamed over dest. progress(stats) runs per step.
+        self.flush()  # include a pending group commit
+        src = self._connect()
+        src.execute("PRAGMA query_only = ON")
+        stats = {"dest": dest, "pages": 0, "bytes": 0, "steps": 0, "restarts": 0, "seconds": 0.0,
+                 "max_step_ms": 0.0, "mb_per_s": 0.0, "integrity": "ok" if verify else "not checked"}
+        started = time.perf_counter()
+        try:
+            targets = [("main", dest)]
+            if self._attach_archive(src):
+                targets.append(("archive", default_archive_name(dest)))
+            if self.wal:
+                src.execute("BEGIN")
+                for schema, _ in targets:
+                    src.execute(f"SELECT COUNT(*) FROM {schema}.sqlite_master").fetchone()
+            for schema, path in targets:
+                self._backup_file(src, schema, path, pages, pause_ms, verify, stats, progress)
+        finally:
+            src.close()
+        stats["seconds"] = time.perf_counter() - started
+        stats["mb_per_s"] = stats["bytes"] / 1e6 / stats["seconds"] if stats["seconds"] else 0.0
+        return stats
+
+    def _backup_file(self, src, schema, path, pages, pause_ms, verify, stats, progress):
+        page_size = src.execute(f"PRAGMA {schema}.page_size").fetchone()[0]
+        part = path + ".part"
+        state = {"remaining": None, "step_started": time.perf_counter()}
+
+        def step(status, remaining, total):
+            now = time.perf_counter()
+            stats["steps"] += 1
+            stats["max_step_ms"] = max(stats["max_step_ms"], (now - state["step_started"]) * 1000)
+            if state["remaining"] is not None and remaining > state["remaining"]:
+                stats["restarts"] += 1
+            state["remaining"] = remaining
+            if progress:
+                progress(dict(stats, file=path, remaining=remaining, total=total))
+            if remaining:
+                time.sleep(pause_ms / 1000)
+            state["step_started"] = time.perf_counter()
+
+        copy = sqlite3.connect(part)
+        try:
+            src.backup(copy, pages=pages, progress=step, name=schema)
+            total = copy.execute("PRAGMA page_count").fetchone()[0]
+            copy.execute("PRAGMA journal_mode = DELETE")  # a self-contained file
+            result = copy.execute("PRAGMA integrity_check").fetchone()[0] if verify else "ok"
+        finally:
+            copy.close()
+        if result != "ok":
+            os.remove(part)
+            raise sqlite3.DatabaseError(f"backup of {schema} failed integrity_check: {result}")
+        os.replace(part, path)
+        stats["pages"] += total
+        stats["bytes"] += total * page_size
+
+    # -------- Archive --------
+    def _attach_archive(self, conn, create=False):
+        # Attach the archive file to conn if it exists (or create=True) and
+        # return whether it is attached. The writer also gets the TEMP
+        # triggers that keep the summaries right when archived rows go.
+        if self.archive_name is None:
+            return False
+        if any(row[1] == "archive" for row in conn.execute("PRAGMA database_list")):
+            return True
+        if not create and not os.path.exists(self.archive_name):
+            return False
+        if conn is self.conn:
+            with self._lock:
+                self.flush()  # ATTACH is not allowed inside a transaction
+                if conn.in_transaction:
+                    return False  # inside a unit of work; attach next time
+                conn.execute("ATTACH DATABASE ? AS archive", (self.archive_name,))
+                if self.wal:
+                    conn.execute("PRAGMA archive.journal_mode = WAL")
+                    conn.execute("PRAGMA archive.synchronous = NORMAL")
+                with conn:
+                    _create_archive_schema(conn)
+                _archive_summary_triggers(conn)
+        elif conn.in_transaction:
+            return False
+        else:
+            conn.execute("ATTACH DATABASE ? AS archive", (self.archive_name,))
+        return True
+
+    def archive(self, before, batch_size=ARCHIVE_BATCH_SIZE, progress=None):
+        # Move appointments dated before `before` (YYYY-MM-DD) and bills
+        # created before it to the archive file, batch_size rows per
+        # transaction so the writer lock is never held for long. The
+        # summaries are left as they are; progress(stats) runs per batch.
+        # In WAL mode a commit is atomic per file only, so a crash can leave
+        # a batch in both files; the copy is an upsert, so archiving again
+        # finishes the move.
+        if self.archive_name is None:
+            raise ValueError("an in-memory database has no archive file")
+        before = _day(before)
+        if before > datetime.now().strftime("%Y-%m-%d"):
+            raise ValueError("the archive cutoff cannot be in the future")
+        stats = {"appointments": 0, "bills": 0, "batches": 0, "seconds": 0.0}
+        started = time.perf_counter()
+        self._attach_archive(self.conn, create=True)
+        for table, (columns, column) in ARCHIVE_TABLES.items():
+            cols = ", ".join(columns)
+            while True:
+                with self.transaction():
+                    cutoff = _stored(column, before)
+                    ids = self.conn.execute(f"SELECT id FROM main.{table} WHERE {column} < ? ORDER BY id LIMIT ?",
+                                            (cutoff, batch_size)).fetchall()
+                    if ids:
+                        batch = (cutoff, ids[-1][0])
+                        self.conn.execute(f"INSERT OR REPLACE INTO archive.{table}({cols}) "
+                                          f"SELECT {cols} FROM main.{table} WHERE {column} < ? AND id <= ?", batch)
+                        self.conn.execute("INSERT INTO summary_guard(reason) VALUES ('archive')")
+                        self.conn.execute(f"DELETE FROM main.{table} WHERE {column} < ? AND id <= ?", batch)
+                        self.conn.execute("DELETE FROM summary_guard")
+                if not ids:
+                    break
+                stats[table] += len(ids)
+                stats["batches"] += 1
+                stats["seconds"] = time.perf_counter() - started
+                if progress:
+                    progress(stats)
+        for table in ARCHIVE_TABLES:
+            self.cache.clear(table)  # get_* only reads the hot tables
+        stats["seconds"] = time.perf_counter() - started
+        return stats
+
+    def archived_counts(self):
+        # {table: rows in the archive file}; empty without an archive
+        with self._reading() as conn:
+            if not self._attach_archive(conn):
+                return {}
+            return {t: conn.execute(f"SELECT COUNT(*) FROM archive.{t}").fetchone()[0] for t in ARCHIVE_TABLES}
+
+# --------------------- Bill Statements ---------------------
+STATEMENT_WORKERS = 4
+
+def render_bill(bill, patient_name):
+    bill_id, pid, c, m, r, o, total, created = bill[:8]
+    return (
+        f"==== Medicare Bill ===\n"
+        f"Bill ID: {bill_id}\nDate: {created}\n\n"
+        f"Patient ID: {pid}\nName: {patient_name or 'Unknown'}\n\n"
+        f"Consultation: {c}\nMedicine: {m}\nRoom: {r}\nOther: {o}\n"
+        f"---------------------------\nTotal: {total}\n"
+    )
+
+def render_statement(pid, patient_name, bills):
+    lines = [
+        "==== Medicare Statement ===",
+        f"Patient ID: {pid}",
+        f"Name: {patient_name or 'Unknown'}",
+        "",
+        f"{'Bill':>8}  {'Date':<19}  {'Consult':>10}  {'Medicine':>10}  {'Room':>10}  {'Other':>10}  {'Total':>10}",
+    ]
+    grand = 0.0
+    for bill_id, _, c, m, r, o, total, created in (b[:8] for b in bills):
+        lines.append(f"{bill_id:>8}  {created:<19}  {c or 0:>10.2f}  {m or 0:>10.2f}  {r or 0:>10.2f}  "
+                     f"{o or 0:>10.2f}  {total:>10.2f}")
+        grand += total
+    lines += ["-" * 92, f"Bills: {len(bills)}    Amount due: {grand:.2f}", ""]
+    return "\n".join(lines)
+
+def _write_text(path, content):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+def generate_statements(db, out_dir=".", date_from=None, date_to=None, bill_ids=None,
+                        per_patient=False, workers=STATEMENT_WORKERS):
+    # Render TXT bills (one file per bill) or statements (one file per
+    # patient) on a thread pool while the rows stream from one joined query.
+    # Returns {"files", "bills", "seconds"}.
+    from concurrent.futures import ThreadPoolExecutor
+
+    os.makedirs(out_dir, exist_ok=True)
+    started = time.perf_counter()
+    stats = {"files": 0, "bills": 0, "seconds": 0.0}
+    pending = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit(fname, render, *args):
+            pending.append(pool.submit(lambda: _write_text(os.path.join(out_dir, fname), render(*args))))
+            stats["files"] += 1
+            if len(pending) >= workers * 64:  # bound the backlog of rendered text
+                for future in pending:
+                    future.result()
+                pending.clear()
+
+        rows = db.bill_statement_rows(date_from, date_to, bill_ids, by_patient=per_patient)
+        if per_patient:
+            group, current = [], None
+            for row in rows:
+                if group and row[1] != current:
+                    submit(f"statement_{_safe_name(current)}.txt", render_statement, current, group[0][8], group)
+                    group = []
+                current = row[1]
+                group.append(row)
+                stats["bills"] += 1
+            if group:
+                submit(f"statement_{_safe_name(current)}.txt", render_statement, current, group[0][8], group)
+        else:
+            for row in rows:
+                submit(f"bill_{row[0]}.txt", render_bill, row, row[8])
+                stats["bills"] += 1
+        for future in pending:
+            future.result()
+    stats["seconds"] = time.perf_counter() - started
+    return stats
+
+def _safe_name(value):
+    return re.sub(r"[^\w.-]", "_", str(value))
+
+# --------------------- Backups ---------------------
+BACKUP_KEEP = 7
+BACKUP_PROBE_INTERVAL_MS = 5
+
+def snapshot_path(folder, db_name, when=None):
+    # backups/medicare-20240601-093000.db
+    stem = os.path.splitext(os.path.basename(db_name))[0]
+    return os.path.join(folder, f"{stem}-{(when or datetime.now()).strftime('%Y%m%d-%H%M%S')}.db")
+
+def prune_backups(folder, db_name, keep=BACKUP_KEEP):
+    # Delete all but the newest `keep` snapshots of db_name in folder (with
+    # their archive files); returns the removed paths.
+    stem = os.path.splitext(os.path.basename(db_name))[0]
+    pattern = re.compile(re.escape(stem) + r"-\d{8}-\d{6}\.db$")
+    snapshots = sorted(f for f in os.listdir(folder) if pattern.match(f))
+    removed = []
+    for name in snapshots[:max(len(snapshots) - keep, 0)]:
+        for path in (os.path.join(folder, name), default_archive_name(os.path.join(folder, name))):
+            if os.path.exists(path):
+                os.remove(path)
+                removed.append(path)
+    return removed
+
+class BackupScheduler(threading.Thread):
+    # Snapshots the database into folder every interval_s seconds and keeps
+    # the newest `keep`. last holds the stats of the latest snapshot and
+    # error the exception of a failed one.
+    def __init__(self, db, folder, interval_s, keep=BACKUP_KEEP):
+        super().__init__(name="backup-scheduler", daemon=True)
+        self.db = db
+        self.folder = folder
+        self.interval_s = interval_s
+        self.keep = keep
+        self.last = None
+        self.error = None
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.wait(self.interval_s):
+            self.snapshot()
+
+    def snapshot(self):
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            self.last = self.db.backup(snapshot_path(self.folder, self.db.db_name))
+            self.error = None
+            prune_backups(self.folder, self.db.db_name, self.keep)
+        except (sqlite3.Error, OSError) as e:
+            self.error = e
+        return self.last
+
+    def stop(self):
+        self._stopping.set()
+
+def probe_writes(db_name, stop, interval_ms=BACKUP_PROBE_INTERVAL_MS):
+    # Latencies (ms) of small real commits made from another connection until
+    # stop is set; run it next to a backup to see how long writers stall.
+    # Each commit writes a page but leaves no trace: the row it adds to
+    # summary_guard is deleted again in the same transaction.
+    conn = sqlite3.connect(db_name, timeout=BUSY_TIMEOUT_MS / 1000)
+    latencies = []
+    try:
+        while not stop.is_set():
+            started = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO summary_guard(reason) VALUES ('probe')")
+            conn.execute("DELETE FROM summary_guard")
+            conn.commit()
+            latencies.append((time.perf_counter() - started) * 1000)
+            stop.wait(interval_ms / 1000)
+    finally:
+        conn.close()
+    return latencies
+
+# --------------------- Scheduling ---------------------
+# Each doctor sees one patient per slot. Occupancy is kept per
+# (doctor, date) as a sorted list of (start minute, appointment id), loaded
+# from idx_appointments_doctor_slot, so a clash check is one bisect. Bookings
+# reload the days they touch inside the write transaction, which makes the
+# check authoritative even if the cache is stale.
+DOCTORS = [
+    ("Dr. Roy", "General Medicine"),
+    ("Dr. Gupta", "Cardiologist"),
+    ("Dr. Singh", "Neurologist"),
+    ("Dr. Patel", "Orthopedic"),
+    ("Dr. Mehta", "Pediatrician"),
+    ("Dr. Sharma", "Dermatologist"),
+    ("Dr. Anushka", "Gynecologist"),
+    ("Dr. Iyer", "ENT Specialist"),
+    ("Dr. Das", "Psychiatrist"),
+    ("Dr. Rao", "Oncologist"),
+]
+SLOT_MINUTES = 15
+CLINIC_HOURS = ("09:00", "17:00")
+FREE_SLOT_DAYS = 60   # how far ahead next_free_slots looks
+SCHEDULE_LOAD_DAYS = 7
+
+def _minutes(time_):
+    h, m = time_.split(":")
+    return int(h) * 60 + int(m)
+
+def _hhmm(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+class ScheduleConflict(ValueError):
+    def __init__(self, conflicts):
+        # conflicts: (doctor, date, time, clashing appointment id or None for
+        # a clash inside the same booking)
+        self.conflicts = conflicts
+        first = ", ".join(f"{d} {day} {t}" for d, day, t, _ in conflicts[:3])
+        more = f" and {len(conflicts) - 3} more" if len(conflicts) > 3 else ""
+        super().__init__(f"Doctor already booked: {first}{more}")
+
+class Schedule:
+    def __init__(self, db, doctors=DOCTORS, slot_minutes=SLOT_MINUTES, hours=CLINIC_HOURS):
+        self.db = db
+        self.doctors = list(doctors)
+        self.depts = dict(self.doctors)
+        self.slot = slot_minutes
+        self.open, self.close = (_minutes(h) for h in hours)
+        self._days = {}   # (doctor, date) -> sorted [(minute, appt id)]
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._days.clear()
+
+    def _fetch(self, conn, doctor, date_from, date_to):
+        # Times are stored as minutes already
+        days = {}
+        for day, minute, appt_id in conn.execute(
+            f"SELECT {_read_day('appt_date')}, appt_time, id FROM appointments "
+            "WHERE doctor=? AND appt_date BETWEEN ? AND ?",
+            (doctor, _epoch_day(date_from), _epoch_day(date_to)),
+        ):
+            if minute != NO_TIME:  # no time given: not tied to a slot
+                days.setdefault(day, []).append((minute, appt_id))
+        for slots in days.values():
+            slots.sort()
+        return days
+
+    def _load(self, doctors, start, ndays):
+        # Fill the cache for doctors x [start, start + ndays), one range read per doctor
+        dates = [(start + timedelta(days=i)).isoformat() for i in range(ndays)]
+        with self._lock:
+            missing = [d for d in doctors if any((d, day) not in self._days for day in dates)]
+        if not missing:
+            return
+        with self.db._reading() as conn:
+            fetched = {d: self._fetch(conn, d, dates[0], dates[-1]) for d in missing}
+        with self._lock:
+            for d, days in fetched.items():
+                for day in dates:
+                    self._days.setdefault((d, day), days.get(day, []))
+
+    def _clash(self, slots, minute, exclude=None):
+        # Appointment id overlapping [minute, minute + slot), else None
+        i = bisect.bisect_left(slots, (minute - self.slot + 1,))
+        while i < len(slots) and slots[i][0] < minute + self.slot:
+            if slots[i][1] != exclude:
+                return slots[i][1]
+            i += 1
+        return None
+
+    def is_free(self, doctor, date, time_, exclude=None):
+        self._load([doctor], datetime.strptime(date, "%Y-%m-%d").date(), 1)
+        with self._lock:
+            return self._clash(self._days[(doctor, date)], _minutes(time_), exclude) is None
+
+    def apply(self, change):
+        # Keep the cache in step with a Change from anywhere in the app
+        if change.table != "appointments":
+            return
+        if change.op != "insert":
+            self.invalidate()  # the old slot is not in the event
+            return
+        _, _, doctor, _, day, time_ = change.row[:6]
+        with self._lock:
+            slots = self._days.get((doctor, day))
+            if slots is None or not time_:
+                return
+            entry = (_minutes(time_), change.key)
+            i = bisect.bisect_left(slots, entry)
+            if i == len(slots) or slots[i] != entry:
+                slots.insert(i, entry)
+
+    def next_free_slots(self, count=5, doctor=None, dept=None, after=None, days=FREE_SLOT_DAYS):
+        # [(date, time, doctor, dept)] in time order; ties go to DOCTORS order
+        doctors = [d for d, dp in self.doctors if doctor in (None, d) and dept in (None, dp)]
+        after = after or datetime.now()
+        found = []
+        for chunk in range(0, days, SCHEDULE_LOAD_DAYS):
+            start = after.date() + timedelta(days=chunk)
+            ndays = min(SCHEDULE_LOAD_DAYS, days - chunk)
+            self._load(doctors, start, ndays)
+            with self._lock:
+                for i in range(ndays):
+                    day = (start + timedelta(days=i)).isoformat()
+                    first = self.open
+                    if chunk + i == 0:
+                        # first slot on the grid at or after `after`
+                        late = after.hour * 60 + after.minute - self.open
+                        first += max(0, -(-late // self.slot)) * self.slot
+                    for minute in range(first, self.close - self.slot + 1, self.slot):
+                        for d in doctors:
+                            if self._clash(self._days[(d, day)], minute) is None:
+                                found.append((day, _hhmm(minute), d, self.depts[d]))
+                                if len(found) == count:
+                                    return found
+            if not doctors:
+                break
+        return found
+
+    # -------- booking --------
+    def _check(self, slots, exclude=None):
+        # Conflicts for [(doctor, date, minute)] against the cache and each other
+        conflicts, pending = [], {}
+        for doctor, day, minute in slots:
+            key = (doctor, day)
+            if key not in pending:
+                pending[key] = list(self._days[key])
+            clash = self._clash(pending[key], minute, exclude)
+            if clash is not None:
+                conflicts.append((doctor, day, _hhmm(minute), clash if clash > 0 else None))
+            bisect.insort(pending[key], (minute, 0))
+        return conflicts
+
+    def _reload(self, keys):
+        # Refresh the given (doctor, date) days from the writer inside its transaction
+        for doctor, day in set(keys):
+            self._days[(doctor, day)] = self._fetch(self.db.conn, doctor, day, day).get(day, [])
+
+    def book_many(self, rows, exclude=None):
+        # rows: (pid, doctor, dept, date, time, notes). All or nothing: raises
+        # ScheduleConflict listing every clash, else books them in one unit of work.
+        rows = [(pid, doctor, dept, *appointment_slot(day, t), notes) for pid, doctor, dept, day, t, notes in rows]
+        slots = [(r[1], r[3], _minutes(r[4])) for r in rows if r[4]]
+        with self.db.transaction():
+            with self._lock:
+                try:
+                    self._reload((d, day) for d, day, _ in slots)
+                    conflicts = self._check(slots, exclude)
+                    if conflicts:
+                        raise ScheduleConflict(conflicts)
+                    if exclude is not None:
+                        changes = self.db.update_appointment(exclude, *rows[0])
+                        self._days.clear()
+                    else:
+                        changes = self.db.add_appointments(rows)
+                        self._reload((d, day) for d, day, _ in slots)
+                except BaseException:
+                    self._days.clear()
+                    raise
+        return changes
+
+    def book(self, pid, doctor, dept, date, time_, notes=""):
+        return self.book_many([(pid, doctor, dept, date, time_, notes)])
+
+    def reschedule(self, appt_id, pid, doctor, dept, date, time_, notes=""):
+        return self.book_many([(pid, doctor, dept, date, time_, notes)], exclude=int(appt_id))
+
+    def book_recurring(self, pid, doctor, dept, date, time_, count, every_days=7, notes=""):
+        start = datetime.strptime(date, "%Y-%m-%d").date()
+        return self.book_many([
+            (pid, doctor, dept, (start + timedelta(days=i * every_days)).isoformat(), time_, notes)
+            for i in range(count)
+        ])
+
+# --------------------- JSON Service ---------------------
+# A small HTTP/1.1 JSON API over DB so kiosks and other terminals can share
+# one process that owns the database. sqlite work runs on a thread pool;
+# requests pipelined on one connection are processed concurrently and
+# answered in order.
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_PIPELINE_DEPTH = 32
+TABLE_COLUMNS = {"patients": PATIENT_COLUMNS, "appointments": APPOINTMENT_COLUMNS, "bills": BILL_COLUMNS}
+HTTP_REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found",
+                405: "Method Not Allowed", 409: "Conflict", 500: "Internal Server Error"}
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _rows_json(table, rows):
+    return [dict(zip(TABLE_COLUMNS[table], row)) for row in rows]
+
+def _changes_json(changes):
+    return {"changes": [
+        {"table": c.table, "op": c.op, "key": c.key,
+         "row": dict(zip(TABLE_COLUMNS[c.table], c.row)) if c.row is not None else None}
+        for c in changes
+    ]}
+
+def _int_param(query, name, default=None):
+    try:
+        return int(query[name][0]) if name in query else default
+    except ValueError:
+        raise HTTPError(400, f"{name} must be an integer") from None
+
+class MedicareService:
+    def __init__(self, db, workers=READ_POOL_SIZE + 1):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.db = db
+        self.schedule = Schedule(db)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="service")
+
+    # -------- routing (runs on the executor) --------
+    def dispatch(self, method, path, body):
+        from urllib.parse import parse_qs, unquote, urlsplit
+
+        url = urlsplit(path)
+        parts = [unquote(p) for p in url.path.strip("/").split("/") if p]
+        query = parse_qs(url.query)
+        if parts == ["metrics"] and method == "GET":
+            snapshot = self.db.metrics_snapshot()
+            if snapshot is None:
+                raise HTTPError(404, "metrics are off; start the service with --instrument")
+            return 200, snapshot
+        if not parts or parts[0] not in TABLE_COLUMNS or len(parts) > 2:
+            raise HTTPError(404, "unknown resource")
+        table, key = parts[0], (parts[1] if len(parts) == 2 else None)
+        handler = getattr(self, f"_{method.lower()}_{table}", None)
+        if handler is None:
+            raise HTTPError(405, f"{method} not supported on {table}")
+        try:
+            return handler(key, query, body)
+        except ScheduleConflict as e:
+            raise HTTPError(409, str(e)) from None
+        except ValueError as e:
+            raise HTTPError(400, str(e)) from None
+        except sqlite3.IntegrityError as e:
+            raise HTTPError(409, str(e)) from None
+
+    def _page(self, query):
+        return dict(limit=_int_param(query, "limit", SEARCH_LIMIT), offset=_int_param(query, "offset", 0))
+
+    @staticmethod
+    def _mutation(changes, status=200):
+        if not changes:
+            raise HTTPError(404, "not found")
+        return status, _changes_json(changes)
+
+    @staticmethod
+    def _get_one(table, get, key):
+        try:
+            row = get(key)
+        except ValueError:  # a non-numeric id
+            row = None
+        if row is None:
+            raise HTTPError(404, "not found")
+        return 200, _rows_json(table, [row])[0]
+
+    def _get_patients(self, key, query, body):
+        if key is not None:
+            return self._get_one("patients", self.db.get_patient, key)
+        rows = self.db.list_patients(query.get("search", [""])[0], **self._page(query))
+        return 200, _rows_json("patients", rows)
+
+    def _post_patients(self, key, query, body):
+        return self._mutation(self.db.add_patient(*_patient_values(body)[:7]), 201)
+
+    def _put_patients(self, key, query, body):
+        return self._mutation(self.db.update_patient(*_patient_values({**body, "pid": key})[:7]))
+
+    def _delete_patients(self, key, query, body):
+        changes = self.db.delete_patient(key)
+        for change in changes:
+            self.schedule.apply(change)  # cascaded appointment deletes
+        return self._mutation(changes)
+
+    def _get_appointments(self, key, query, body):
+        if key is not None:
+            return self._get_one("appointments", self.db.get_appointment, key)
+        rows = self.db.list_appointments(query.get("pid", [""])[0], **self._page(query))
+        return 200, _rows_json("appointments", rows)
+
+    def _post_appointments(self, key, query, body):
+        if self.db.get_patient(_field(body, "pid")) is None:
+            raise HTTPError(400, "Unknown patient ID")
+        return self._mutation(self.schedule.book(*_appointment_values(body)[:6]), 201)
+
+    def _put_appointments(self, key, query, body):
+        return self._mutation(self.schedule.reschedule(key, *_appointment_values(body)[:6]))
+
+    def _delete_appointments(self, key, query, body):
+        changes = self.db.delete_appointment(key)
+        for change in changes:
+            self.schedule.apply(change)
+        return self._mutation(changes)
+
+    def _get_bills(self, key, query, body):
+        if key is not None:
+            return self._get_one("bills", self.db.get_bill, key)
+        rows = self.db.list_bills(query.get("pid", [""])[0], **self._page(query))
+        return 200, _rows_json("bills", rows)
+
+    def _post_bills(self, key, query, body):
+        if self.db.get_patient(_field(body, "pid")) is None:
+            raise HTTPError(400, "Unknown patient ID")
+        return self._mutation(self.db.add_bill(*_bill_values(body)[:5]), 201)
+
+    def _put_bills(self, key, query, body):
+        return self._mutation(self.db.update_bill(key, *_bill_amounts(body)))
+
+    def _delete_bills(self, key, query, body):
+        return self._mutation(self.db.delete_bill(key))
+
+    def _respond(self, method, path, body):
+        try:
+            if body:
+                body = json.loads(body)
+                if not isinstance(body, dict):
+                    raise HTTPError(400, "expected a JSON object")
+            status, payload = self.dispatch(method, path, body or {})
+        except HTTPError as e:
+            status, payload = e.status, {"error": str(e)}
+        except ValueError as e:
+            status, payload = 400, {"error": f"invalid JSON: {e}"}
+        except Exception as e:
+            status, payload = 500, {"error": repr(e)}
+        return status, json.dumps(payload).encode()
+
+    # -------- HTTP (runs on the event loop) --------
+    async def handle_connection(self, reader, writer):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        # Responses are written in request order; each entry is a future
+        # already running on the executor, so pipelined requests overlap.
+        inflight = asyncio.Queue(SERVICE_PIPELINE_DEPTH)
+
+        async def write_responses():
+            while True:
+                item = await inflight.get()
+                if item is None:
+                    break
+                future, keep_alive = item
+                status, payload = await future
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+
+        responder = asyncio.ensure_future(write_responses())
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode("latin-1").split(None, 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+                keep_alive = headers.get("connection", "").lower() != "close" and "1.1" in version
+                future = loop.run_in_executor(self.executor, self._respond, method, path, body)
+                await inflight.put((future, keep_alive))
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            await inflight.put(None)
+            try:
+                await responder
+            except ConnectionError:
+                pass
+            writer.close()
+
+    async def serve(self, host=SERVICE_HOST, port=SERVICE_PORT):
+        import asyncio
+
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        async with server:
+            print(f"serving {self.db.db_name} on http://{host}:{port}", file=sys.stderr)
+            await server.serve_forever()
+
+# -------- load test client --------
+async def _load_connection(host, port, requests, pipeline, latencies, statuses):
+    import asyncio
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for i in range(0, len(requests), pipeline):
+            batch = requests[i:i + pipeline]
+            sent = time.perf_counter()
+            for method, path, body in batch:
+                data = json.dumps(body).encode() if body is not None else b""
+                writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n"
+                             f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+            await writer.drain()
+            for _ in batch:
+                status = int((await reader.readline()).split()[1])
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":")[1])
+                await reader.readexactly(length)
+                latencies.append(time.perf_counter() - sent)
+                statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+def run_load_test(host, port, pids, total=5000, connections=8, pipeline=8, write_ratio=0.1, seed=1):
+    # Drive the service with a read/write mix and report p50/p99 latency and
+    # requests per second. Latency is measured from sending a pipelined
+    # batch to receiving each of its responses.
+    import asyncio
+    import random
+
+    rnd = random.Random(seed)
+    per_conn = []
+    for c in range(connections):
+        reqs = []
+        for _ in range(total // connections):
+            pid = rnd.choice(pids)
+            r = rnd.random()
+            if r < write_ratio:
+                reqs.append(("POST", "/bills", {"pid": pid, "consultation": 100, "medicine": rnd.randrange(500)}))
+            elif r < 0.5:
+                reqs.append(("GET", f"/appointments?pid={pid}&limit=20", None))
+            elif r < 0.8:
+                reqs.append(("GET", f"/bills?pid={pid}&limit=20", None))
+            else:
+                reqs.append(("GET", f"/patients/{pid}", None))
+        per_conn.append(reqs)
+    latencies, statuses = [], {}
+
+    async def run():
+        await asyncio.gather(*(_load_connection(host, port, reqs, pipeline, latencies, statuses)
+                               for reqs in per_conn))
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else 0.0
+    return {"requests": len(latencies), "seconds": elapsed, "rps": len(latencies) / elapsed,
+            "p50_ms": pct(0.50), "p99_ms": pct(0.99), "statuses": statuses}
+
+# --------------------- Background Patient Search ---------------------
+SEARCH_LIMIT = 200
+SEARCH_DEBOUNCE_MS = 200
+SEARCH_POLL_MS = 30
+# Row positions of the searchable patient columns (pid, name, phone, disease, address)
+_SEARCH_FIELDS = (0, 1, 4, 5, 6)
+
+def patient_matches(row, search: str, prefix: bool = True) -> bool:
+    # In-memory twin of list_patients(search): prefix terms for the FTS
+    # index, substring of pid/name/phone for the LIKE fallback.
+    if not prefix:
+        needle = search.lower()
+        return any(needle in str(row[i] or "").lower() for i in (0, 1, 4))
+    tokens = set()
+    for i in _SEARCH_FIELDS:
+        tokens.update(search_terms(str(row[i] or "")))
+    return all(any(tok.startswith(term) for tok in tokens) for term in search_terms(search))
+
+class PatientSearch:
+    # Runs patient searches on a worker thread with its own connection so
+    # typing never waits on sqlite. Only the newest query matters: older ones
+    # are dropped before they start or interrupted while running, and a query
+    # that extends the previous one is answered by filtering the previous
+    # (complete) result in memory.
+    def __init__(self, db_name: str = DB_NAME, limit: int = SEARCH_LIMIT):
+        self.db_name = db_name
+        self.limit = limit
+        self._generation = 0
+        self._last = None  # (search, rows) of the last complete result
+        self._prefix = True
+        self._lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._results = queue.Queue()
+        threading.Thread(target=self._run, name="patient-search", daemon=True).start()
+
+    def submit(self, search: str) -> int:
+        search = search.strip()
+        with self._lock:
+            self._generation += 1
+            gen = self._generation
+            last = self._last
+        if last is not None and search and self._extends(search, last[0]):
+            rows = [r for r in last[1] if patient_matches(r, search, self._prefix)]
+            self._publish(gen, search, rows)
+        else:
+            self._requests.put((gen, search))
+        return gen
+
+    def invalidate(self):
+        # Data changed: the cached result can no longer be narrowed
+        with self._lock:
+            self._last = None
+
+    def poll(self):
+        # Newest finished result as (generation, search, rows), or None
+        latest = None
+        while True:
+            try:
+                item = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if item[0] == self._generation:
+                latest = item
+        return latest
+
+    def _extends(self, search, previous):
+        if not previous or not search.lower().startswith(previous.lower()):
+            return False
+        # The LIKE fallback matches the whole string, so a new term is not a narrowing
+        return self._prefix or len(search_terms(search)) == len(search_terms(previous))
+
+    def _publish(self, gen, search, rows):
+        with self._lock:
+            if gen != self._generation:
+                return
+            # A result cut off at the limit cannot be narrowed safely
+            self._last = (search, rows) if len(rows) < self.limit else None
+        self._results.put((gen, search, rows))
+
+    def close(self):
+        self._requests.put(None)
+
+    def _run(self):
+        # A plain query-only connection: the search never writes, and a full
+        # DB would set up the schema, journal mode and archive from here too
+        conn = sqlite3.connect(self.db_name, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        try:
+            conn.execute("PRAGMA query_only = ON")
+            self._prefix = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'patients_fts'").fetchone() is not None
+            while True:
+                request = self._requests.get()
+                if request is None:
+                    return
+                gen, search = request
+                if gen != self._generation:
+                    continue  # superseded while queued
+                conn.set_progress_handler(lambda: gen != self._generation, 1000)
+                try:
+                    rows = _patient_rows(conn, search, self.limit, 0, None, True, self._prefix)
+                except sqlite3.OperationalError:
+                    continue  # interrupted by a newer query
+                finally:
+                    conn.set_progress_handler(None, 0)
+                self._publish(gen, search, rows)
+        finally:
+            conn.close()
+
+# --------------------- Patient Directory ---------------------
+COMPLETE_LIMIT = 50
+
+class PatientDirectory:
+    # In-memory "PID - Name" labels for the patient pickers, indexed by a
+    # sorted list of lowercase keys (the pid and each word of the name) so a
+    # prefix lookup is a bisect. It is stale whenever DB.generation moved
+    # past the generation it was built at; apply() patches it for changes
+    # made through this process so only foreign changes force a rebuild.
+    # With a DBWorker the rebuild runs on its thread (see refresh()), and
+    # lookups answer from the labels already loaded meanwhile.
+    def __init__(self, db, worker=None):
+        self.db = db
+        self.worker = worker
+        self._generation = None
+        self._keys = []
+        self._labels = []
+        self._by_pid = {}
+        self._loading = False
+        self._waiters = []
+
+    def invalidate(self):
+        self._generation = None
+
+    def _entries(self, pid, label):
+        name = label[len(pid) + 3:]
+        return [(pid.lower(), label)] + [(t, label) for t in set(search_terms(name))]
 
-    # -------- Appointments --------
-    def add_appointment(self, pid, doctor, dept, appt_date, appt_time,notes):
-        self.conn.execute(
-            "INSERT INTO appointments(pid, doctor, dept, appt_date, appt_time, notes, created_at) VALUES (?,?,?,?,?,?,?)",
-            (pid, doctor, dept, appt_date, appt_time, notes, datetime.now().isoformat(timespec="seconds")),
-        )
-        self.conn.commit()
+    def stale(self):
+        return self._generation != self.db.generation
 
-    def delete_appointment(self, appt_id):
-        self.conn.execute("DELETE FROM appointments WHERE id=?", (appt_id,))
-        self.conn.commit()
+    def refresh(self, done=None):
+        # Rebuild if stale; done() runs once the labels are current (at once
+        # if they already are, else when the worker's rebuild lands)
+        if not self.stale():
+            if done is not None:
+                done()
+            return
+        if done is not None:
+            self._waiters.append(done)
+        if self.worker is None:
+            self._install(self._load())
+        elif not self._loading:
+            self._loading = True
+            self.worker.call(self._load, done=self._install, failed=self._failed)
 
-    def list_appointments(self, pid_filter: str = ""):
-        cur = self.conn.cursor()
-        if pid_filter:
-            cur.execute(
-                "SELECT id, pid, doctor, dept, appt_date, appt_time, notes, created_at FROM appointments WHERE pid=? ORDER BY appt_date DESC, appt_time DESC",
-                (pid_filter,),
-            )
-        else:
-            cur.execute(
-                "SELECT id, pid, doctor, dept, appt_date, appt_time, notes, created_at FROM appointments ORDER BY appt_date DESC, appt_time DESC"
-            )
-        return cur.fetchall()
+    def _load(self):
+        generation = self.db.generation
+        entries, by_pid = [], {}
+        for pid, name in self.db.iter_rows("SELECT pid, name FROM patients", chunk_size=10000):
+            label = f"{pid} - {name}"
+            by_pid[pid] = label
+            entries.extend(self._entries(pid, label))
+        entries.sort()
+        return generation, [k for k, _ in entries], [label for _, label in entries], by_pid
 
-    # -------- Bills --------
-    def add_bill(self, pid, consultation, medicine, room, other):
-        total = float(consultation or 0) + float(medicine or 0) + float(room or 0) + float(other or 0)
-        self.conn.execute(
-            "INSERT INTO bills(pid, consultation, medicine, room, other, total, created_at) VALUES (?,?,?,?,?,?,?)",
-            (pid, consultation, medicine, room, other, total, datetime.now().isoformat(timespec="seconds")),
-        )
-        self.conn.commit()
+    def _install(self, loaded):
+        self._generation, self._keys, self._labels, self._by_pid = loaded
+        self._loading = False
+        waiters, self._waiters = self._waiters, []
+        for done in waiters:
+            done()
 
-    def list_bills(self, pid_filter: str = ""):
-        cur = self.conn.cursor()
-        if pid_filter:
-            cur.execute(
-                "SELECT id, pid, consultation, medicine, room, other, total, created_at FROM bills WHERE pid=? ORDER BY created_at DESC",
-                (pid_filter,),
-            )
-        else:
-            cur.execute(
-                "SELECT id, pid, consultation, medicine, room, other, total, created_at FROM bills ORDER BY created_at DESC"
-            )
-        return cur.fetchall()
+    def _failed(self, error):
+        self._loading = False
+        self._waiters = []
+        self.worker.on_error(error)
+
+    def apply(self, change):
+        # Patch for one patient Change; falls back to a rebuild if anything
+        # else touched the patients table in between.
+        if change.table != "patients":
+            return
+        if self._generation is None or self._generation + 1 != self.db.generation:
+            self.invalidate()
+            return
+        old = self._by_pid.pop(change.key, None)
+        if old is not None:
+            for key, label in self._entries(change.key, old):
+                i = bisect.bisect_left(self._keys, key)
+                while self._labels[i] != label:
+                    i += 1
+                del self._keys[i], self._labels[i]
+        if change.op != "delete":
+            label = f"{change.key} - {change.row[1]}"
+            self._by_pid[change.key] = label
+            for key, label in self._entries(change.key, label):
+                i = bisect.bisect_left(self._keys, key)
+                self._keys.insert(i, key)
+                self._labels.insert(i, label)
+        self._generation = self.db.generation
+
+    def label(self, pid):
+        return self._by_pid.get(pid)
+
+    def complete(self, text, limit=COMPLETE_LIMIT):
+        # Labels whose pid or a name word starts with text; call refresh()
+        # first for current ones
+        prefix = (text or "").split(" - ")[0].strip().lower()
+        out, seen = [], set()
+        i = bisect.bisect_left(self._keys, prefix)
+        while i < len(self._keys) and self._keys[i].startswith(prefix) and len(out) < limit:
+            if self._labels[i] not in seen:
+                seen.add(self._labels[i])
+                out.append(self._labels[i])
+            i += 1
+        return out
 
 # --------------------- UI Helpers ---------------------
 PAD = 8
@@ -168,28 +3084,290 @@ class MoneyEntry(LabeledEntry):
         except ValueError:
             return 0.0
 
+class PatientPicker(ttk.Combobox):
+    # Editable type-ahead patient field: the dropdown only ever holds the
+    # directory's completions for what has been typed.
+    NAV_KEYS = {"Up", "Down", "Return", "Escape", "Tab", "KP_Enter"}
+
+    def __init__(self, master, directory, **kwargs):
+        super().__init__(master, postcommand=self._complete, **kwargs)
+        self.directory = directory
+        self.bind("<KeyRelease>", self._on_key)
+
+    def _on_key(self, event):
+        if event.keysym not in self.NAV_KEYS:
+            self._complete()
+
+    def _complete(self):
+        self.directory.refresh(done=self._fill)
+        if self.directory.stale():  # rebuilding: offer what is loaded meanwhile
+            self._fill()
+
+    def _fill(self):
+        self["values"] = self.directory.complete(self.get())
+
+WORKER_POLL_MS = 15
+
+class DBWorker:
+    # Runs DB work off the Tk thread so a slow disk or a big query never
+    # freezes the window. call(fn, *args) queues fn on the worker thread and
+    # returns its Future; done(result) or failed(exception) then runs on the
+    # Tk thread, picked up by after() polling. Calls run one at a time in the
+    # order they were made, so a refresh queued after a save sees the save.
+    # on_busy(pending) runs whenever the number of unfinished calls changes
+    # (quiet calls, e.g. background polls, are not counted); on_error(exception)
+    # handles failures that have no failed callback.
+    def __init__(self, widget, on_busy=None, on_error=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.widget = widget
+        self.on_busy = on_busy or (lambda pending: None)
+        self.on_error = on_error or (lambda e: widget.report_callback_exception(type(e), e, e.__traceback__))
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-worker")
+        self._waiting = []  # (future, done, failed, quiet), oldest first
+        self._polling = False
+
+    def call(self, fn, *args, done=None, failed=None, quiet=False, **kwargs):
+        future = self._executor.submit(fn, *args, **kwargs)
+        self._waiting.append((future, done, failed, quiet))
+        if not quiet:
+            self._busy(1)
+        if not self._polling:
+            self._polling = True
+            self.widget.after(WORKER_POLL_MS, self._poll)
+        return future
+
+    def _busy(self, delta):
+        self.pending += delta
+        self.on_busy(self.pending)
+
+    def _poll(self):
+        finished = [w for w in self._waiting if w[0].done()]
+        self._waiting = [w for w in self._waiting if not w[0].done()]
+        for future, done, failed, quiet in finished:
+            if not quiet:
+                self._busy(-1)
+            if future.cancelled():
+                continue
+            error = future.exception()
+            if error is not None:
+                (failed or self.on_error)(error)
+            elif done is not None:
+                done(future.result())
+        if self._waiting:
+            self.widget.after(WORKER_POLL_MS, self._poll)
+        else:
+            self._polling = False
+
+    def drain(self):
+        # Wait for every queued call and run its callbacks now, including
+        # calls those callbacks queue (benchmarks, tests)
+        while self._waiting:
+            for future, *_ in list(self._waiting):
+                future.exception()
+            self._poll()
+
+    def close(self):
+        # Let queued writes finish; their callbacks are dropped
+        self._executor.shutdown(wait=True)
+
+PREFETCH_ROWS = 50
+
+class PagedTreeview(ttk.Frame):
+    # Treeview that only loads what is on screen plus a prefetch margin and
+    # pages in more rows as the user scrolls towards the end. Pages come from
+    # fetch(order_by, descending, limit, cursor) -> (rows, next cursor or
+    # None), i.e. the DB.query_* keyset pages; clicking a heading re-sorts in
+    # the database. set_rows() shows a fixed result set instead (e.g. search
+    # hits), which is then sorted in memory. With a DBWorker, pages are
+    # fetched on its thread and a page that arrives after a reload is dropped.
+    def __init__(self, master, columns, widths, fetch, height=12, default_order=(), accepts=None, worker=None):
+        super().__init__(master)
+        self.columns = columns
+        self.fetch = fetch
+        self.worker = worker
+        self.height = height
+        # Columns (descending) of the query's default order, used to place
+        # rows inserted by apply(); accepts(row) says whether a row belongs
+        # in the current filter.
+        self.default_order = default_order
+        self.accepts = accepts or (lambda row: True)
+        self.order_by = None  # None: the query's default order
+        self.descending = True
+        self._cursor = None
+        self._loaded = 0
+        self._exhausted = True
+        self._paged = True
+        self._loading = False
+        self._check_pending = False
+        self.reloads = 0  # bumped by reload(); pages fetched before it are stale
+
+        self.tv = ttk.Treeview(self, columns=columns, show="headings", height=height)
+        vsb = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.tv.yview)
+        self._vsb = vsb
+        self.tv.configure(yscrollcommand=self._on_scroll)
+        for c, w in zip(columns, widths):
+            self.tv.heading(c, text=c.upper(), command=lambda c=c: self.sort_by(c))
+            self.tv.column(c, width=w, anchor=tk.W)
+        self.tv.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        vsb.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tv.bind("<Configure>", lambda e: self.after_idle(self._maybe_load_more))
+
+    def reload(self):
+        self.reloads += 1
+        self._paged = True
+        self._clear()
+        self._cursor = None
+        self._loaded = 0
+        self._exhausted = False
+        self._loading = False  # a page still in flight is stale now
+        self._load(self.height + PREFETCH_ROWS)
+
+    def set_rows(self, rows):
+        self._paged = False
+        self._exhausted = True
+        self._clear()
+        for r in self._sorted(rows):
+            self.tv.insert("", tk.END, iid=str(r[0]), values=r)
+
+    def sort_by(self, column):
+        if column == self.order_by:
+            self.descending = not self.descending
+        else:
+            self.order_by, self.descending = column, False
+        for c in self.columns:
+            arrow = (" \u25bc" if self.descending else " \u25b2") if c == column else ""
+            self.tv.heading(c, text=c.upper() + arrow)
+        if self._paged:
+            self.reload()
+        else:
+            self.set_rows([self.tv.item(i, "values") for i in self.tv.get_children()])
+
+    def _sort_key(self, row):
+        if self.order_by is None:
+            columns = self.default_order
+        else:
+            columns = (self.order_by,)
+        key = []
+        for c in columns:
+            value = row[self.columns.index(c)]
+            try:
+                key.append((0, float(value), ""))
+            except (TypeError, ValueError):
+                key.append((1, 0.0, str(value or "")))
+        return key
+
+    def _sorted(self, rows):
+        if self.order_by is None:
+            return rows
+        return sorted(rows, key=self._sort_key, reverse=self.descending)
+
+    def apply(self, change):
+        # Patch one row in place; costs a binary search over the loaded rows
+        # instead of a reload.
+        iid = str(change.key)
+        present = self.tv.exists(iid)
+        if present and (change.op == "delete" or not self.accepts(change.row)):
+            self.tv.delete(iid)
+            if self._paged:
+                self._loaded -= 1
+            return
+        if change.op == "delete" or not self.accepts(change.row):
+            return
+        if present:
+            if self._sort_key(change.row) == self._sort_key(self.tv.item(iid, "values")):
+                self.tv.item(iid, values=change.row)
+                return
+            self.tv.delete(iid)
+            if self._paged:
+                self._loaded -= 1
+        index = self._insert_position(change.row)
+        if index is None:
+            return  # sorts after the loaded rows; it will be paged in later
+        self.tv.insert("", index, iid=iid, values=change.row)
+        if self._paged:
+            self._loaded += 1
+
+    def _insert_position(self, row):
+        children = self.tv.get_children()
+        descending = self.descending if self.order_by is not None else True
+        if self.order_by is None and not self.default_order:
+            return 0
+        key = self._sort_key(row)
+        lo, hi = 0, len(children)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            other = self._sort_key(self.tv.item(children[mid], "values"))
+            before = other > key if descending else other < key
+            if before or other == key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(children) and not self._exhausted:
+            return None
+        return lo
+
+    def _clear(self):
+        children = self.tv.get_children()
+        if children:
+            self.tv.delete(*children)
+
+    def _load(self, count):
+        if self._exhausted or self._loading:
+            return
+        self._loading = True
+        args = (self.order_by, self.descending, count, self._cursor)
+        if self.worker is None:
+            try:
+                page = self.fetch(*args)
+            finally:
+                self._loading = False
+            self._show_page(page)
+            return
+        stamp = self.reloads
+
+        def done(page):
+            if stamp == self.reloads:
+                self._loading = False
+                self._show_page(page)
+                self.after_idle(self._maybe_load_more)  # the view may have room for more
+
+        def failed(error):
+            if stamp == self.reloads:
+                self._loading = False
+            self.worker.on_error(error)
+        self.worker.call(self.fetch, *args, done=done, failed=failed)
+
+    def _show_page(self, page):
+        rows, self._cursor = page
+        for r in rows:
+            if not self.tv.exists(str(r[0])):  # already placed by apply()
+                self.tv.insert("", tk.END, iid=str(r[0]), values=r)
+                self._loaded += 1
+        self._exhausted = self._cursor is None
+
+    def _on_scroll(self, first, last):
+        self._vsb.set(first, last)
+        if self._paged and not self._exhausted and not self._check_pending:
+            self._check_pending = True
+            self.after_idle(self._maybe_load_more)
+
+    def _maybe_load_more(self):
+        self._check_pending = False
+        if not self._paged or self._exhausted:
+            return
+        _, last = self.tv.yview()
+        rows_below = (1.0 - last) * self._loaded
+        if rows_below < PREFETCH_ROWS:
+            self._load(PAGE_SIZE)
+
 # --------------------- Main Application ---------------------
 class MedicareApp(tk.Tk):
-    DOCTORS = [
-        ("Dr. Roy", "General Medicine"),
-        ("Dr. Gupta", "Cardiologist"),
-        ("Dr. Singh", "Neurologist"),
-        ("Dr. Patel", "Orthopedic"),
-        ("Dr. Mehta", "Pediatrician"),
-        ("Dr. Sharma", "Dermatologist"),
-        ("Dr. Anushka", "Gynecologist"),
-        ("Dr. Iyer", "ENT Specialist"),
-        ("Dr. Das", "Psychiatrist"),
-        ("Dr. Rao", "Oncologist"),
-        
-        
-        
-        
-        
-
-    ]
+    DOCTORS = DOCTORS
 
-    def __init__(self):
+    def __init__(self, db_name: str = DB_NAME, group_commit_ms: int = None, backup_dir: str = None,
+                 backup_every_min: float = None):
         super().__init__()
         self.title("Medicare Management System")
         self.geometry("1000x650")
@@ -197,20 +3375,135 @@ class MedicareApp(tk.Tk):
         self.style = ttk.Style(self)
         if "clam" in self.style.theme_names():
             self.style.theme_use("clam")
-        self.db = DB()
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.startup = {}  # first_paint_ms / first_data_ms, for the startup benchmark
+        self.db_name = db_name
+        self.db = DB(db_name, group_commit_ms=group_commit_ms)
+        self.schedule = Schedule(self.db, self.DOCTORS)
+        self.patient_search = PatientSearch(self.db_name)
+        self.appt_patient_var = tk.StringVar()
+        self.bill_patient_var = tk.StringVar()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.backups = None
+        if backup_dir and backup_every_min:
+            self.backups = BackupScheduler(self.db, backup_dir, backup_every_min * 60)
+            self.backups.start()
+        menubar = tk.Menu(self)
+        file_menu = tk.Menu(menubar, tearoff=False)
+        file_menu.add_command(label="Back Up Now...", command=self.backup_now)
+        file_menu.add_separator()
+        file_menu.add_command(label="Exit", command=self.on_close)
+        menubar.add_cascade(label="File", menu=file_menu)
+        self.config(menu=menubar)
 
+        # Status bar: a busy indicator while the DB worker has calls pending
+        status = ttk.Frame(self, padding=(PAD, 2))
+        status.pack(side=tk.BOTTOM, fill=tk.X)
+        self.status_var = tk.StringVar(value="Ready")
+        ttk.Label(status, textvariable=self.status_var).pack(side=tk.LEFT)
+        self.busy_bar = ttk.Progressbar(status, mode="indeterminate", length=120)
+        self.busy_bar.pack(side=tk.RIGHT)
+        self.worker = DBWorker(self, on_busy=self._on_busy, on_error=self._on_db_error)
+        self.patient_directory = PatientDirectory(self.db, self.worker)
+
+        # Tabs are empty frames until first shown; then they are built and
+        # their data is fetched off the Tk thread. Views of built tabs are
+        # registered in self.views (table -> PagedTreeview) for
+        # apply_changes(); the report tables, re-read whole, in
+        # self.report_tables.
         self.notebook = ttk.Notebook(self)
         self.notebook.pack(fill=tk.BOTH, expand=True)
+        self.views = {}
+        self.report_tables = {}
+        self._unbuilt = {}
+        for text, build in (("Patients", self._build_patients_tab), ("Appointments", self._build_appointments_tab),
+                            ("Billing", self._build_billing_tab), ("Reports", self._build_reports_tab),
+                            ("Diagnostics", self._build_diagnostics_tab)):
+            tab = ttk.Frame(self.notebook, padding=PAD)
+            self.notebook.add(tab, text=text)
+            self._unbuilt[str(tab)] = (tab, build)
+        self.notebook.bind("<<NotebookTabChanged>>", lambda e: self._build_selected_tab())
+        self.after_idle(self._on_first_idle)
+        # Rows other workstations write show up without pressing Refresh
+        self._change_poll = None
+        self.after(CHANGE_POLL_MS, self._poll_changes)
 
-        self._build_patients_tab()
-        self._build_appointments_tab()
-        self._build_billing_tab()
+    def build_all_tabs(self):
+        for tab, build in list(self._unbuilt.values()):
+            build(tab)
+        self._unbuilt.clear()
 
-    # ---------------- Patients Tab ----------------
-    def _build_patients_tab(self):
-        tab = ttk.Frame(self.notebook, padding=PAD)
-        self.notebook.add(tab, text="Patients")
+    def probe_startup(self):
+        # --startup-probe: report the startup timings as JSON once the first
+        # page of data is on screen (or after a timeout), then exit
+        deadline = self.started + STARTUP_PROBE_TIMEOUT_S
+
+        def check():
+            if "first_data_ms" not in self.startup and time.perf_counter() < deadline:
+                self.after(SEARCH_POLL_MS, check)
+                return
+            print(json.dumps(dict(self.startup, started_at=self.started_at)), flush=True)
+            self.on_close()
+        self.after(SEARCH_POLL_MS, check)
+
+    def _on_first_idle(self):
+        # The window has been drawn once by the time idle callbacks run
+        self.startup.setdefault("first_paint_ms", (time.perf_counter() - self.started) * 1000)
+        self._build_selected_tab()
 
+    def _build_selected_tab(self):
+        entry = self._unbuilt.pop(self.notebook.select(), None)
+        if entry is not None:
+            tab, build = entry
+            build(tab)
+
+    def _on_busy(self, pending):
+        if pending:
+            if self.status_var.get() == "Ready":
+                self.busy_bar.start(10)
+                self.config(cursor="watch")
+            self.status_var.set(f"Working... ({pending} pending)")
+            return
+        self.busy_bar.stop()
+        self.config(cursor="")
+        self.status_var.set("Ready")
+        if self.views:
+            # the first tab's first page is on screen
+            self.startup.setdefault("first_data_ms", (time.perf_counter() - self.started) * 1000)
+
+    def _on_db_error(self, error):
+        if isinstance(error, (sqlite3.Error, OSError, ValueError)):
+            messagebox.showerror("Database", str(error))
+        else:
+            self.report_callback_exception(type(error), error, error.__traceback__)
+
+    def backup_now(self):
+        # The copy runs on the DB worker; the UI stays live meanwhile
+        from tkinter import filedialog
+
+        path = filedialog.asksaveasfilename(defaultextension=".db", initialfile=os.path.basename(
+            snapshot_path(".", self.db_name)), filetypes=[("SQLite database", "*.db")])
+        if not path:
+            return
+
+        def done(stats):
+            messagebox.showinfo("Backup", f"Saved {path}\n{stats['bytes'] / 1e6:.1f} MB in {stats['seconds']:.1f} s "
+                                          f"({stats['mb_per_s']:.0f} MB/s), longest step {stats['max_step_ms']:.1f} ms, "
+                                          f"integrity {stats['integrity']}")
+        self.worker.call(self.db.backup, path, done=done,
+                         failed=lambda e: messagebox.showerror("Backup", f"Backup failed: {e}"))
+
+    def on_close(self):
+        if self.backups is not None:
+            self.backups.stop()
+        self.worker.close()
+        self.patient_search.close()
+        self.db.close()  # flushes a pending group commit
+        self.destroy()
+
+    # ---------------- Patients Tab ----------------
+    def _build_patients_tab(self, tab):
         form = ttk.LabelFrame(tab, text="Register / Update Patient", padding=PAD)
         form.pack(fill=tk.X, padx=PAD, pady=PAD)
 
@@ -252,72 +3545,72 @@ class MedicareApp(tk.Tk):
         self.search_var = tk.StringVar()
         search_entry = ttk.Entry(search_row, textvariable=self.search_var)
         search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(6, 0))
-        search_entry.bind("<KeyRelease>", lambda e: self.refresh_patients())
+        self._search_after = None
+        self._search_polling = False
+        self.search_var.trace_add("write", lambda *_: self._on_search_changed())
 
         # Table
-        cols = ("pid", "name", "age", "gender", "phone", "disease", "address", "created_at")
-        self.patients_tv = ttk.Treeview(tab, columns=cols, show="headings", height=12)
-        for c, w in zip(cols, (100, 160, 50, 70, 100, 160, 220, 140)):
-            self.patients_tv.heading(c, text=c.upper())
-            self.patients_tv.column(c, width=w, anchor=tk.W)
-        self.patients_tv.pack(fill=tk.BOTH, expand=True, padx=PAD, pady=(4, PAD))
+        self.patients_view = PagedTreeview(
+            tab, PATIENT_COLUMNS, (100, 160, 50, 70, 100, 160, 220, 140),
+            lambda order_by, desc, limit, cursor: self.db.query_patients(
+                order_by=order_by, descending=desc, limit=limit, cursor=cursor),
+            height=12,
+            default_order=("created_at",),
+            accepts=lambda row: patient_matches(row, self.search_var.get().strip(), self.db.has_search_index),
+            worker=self.worker,
+        )
+        self.patients_view.pack(fill=tk.BOTH, expand=True, padx=PAD, pady=(4, PAD))
+        self.patients_tv = self.patients_view.tv
         self.patients_tv.bind("<<TreeviewSelect>>", self.on_patient_select)
+        self.views["patients"] = self.patients_view
 
-        self.refresh_patients()
+        self.patients_view.reload()
 
     def _validate_patient(self):
-        if not self.pid.get():
-            messagebox.showerror("Validation", "Patient ID is required")
-            return False
-        if not self.name.get():
-            messagebox.showerror("Validation", "Name is required")
-            return False
-        try:
-            if self.age.get():
-                int(self.age.get())
-        except ValueError:
-            messagebox.showerror("Validation", "Age must be a number")
-            return False
-        if self.gender_var.get() not in ("M", "F", "O"):
-            messagebox.showerror("Validation", "Invalid gender")
+        error = patient_error(self.pid.get(), self.name.get(), self.age.get(), self.gender_var.get())
+        if error:
+            messagebox.showerror("Validation", error)
             return False
         return True
 
+    def _patient_form(self):
+        return (
+            self.pid.get(),
+            self.name.get(),
+            int(self.age.get() or 0),
+            self.gender_var.get(),
+            self.phone.get(),
+            self.disease.get(),
+            self.address.get(),
+        )
+
     def save_patient(self):
         if not self._validate_patient():
             return
-        try:
-            self.db.add_patient(
-                self.pid.get(),
-                self.name.get(),
-                int(self.age.get() or 0),
-                self.gender_var.get(),
-                self.phone.get(),
-                self.disease.get(),
-                self.address.get(),
-            )
+
+        def done(changes):
             messagebox.showinfo("Success", "Patient added")
-            self.refresh_patients()
+            self.apply_changes(changes)
             self.clear_patient_form()
-            self.refresh_patient_comboboxes()
-        except sqlite3.IntegrityError:
-            messagebox.showerror("Error", "Patient ID already exists. Use Update instead.")
+
+        def failed(error):
+            if isinstance(error, sqlite3.IntegrityError):
+                messagebox.showerror("Error", "Patient ID already exists. Use Update instead.")
+            else:
+                self._on_db_error(error)
+        self.worker.call(self.db.add_patient, *self._patient_form(), done=done, failed=failed)
 
     def update_patient(self):
         if not self._validate_patient():
             return
-        self.db.update_patient(
-            self.pid.get(),
-            self.name.get(),
-            int(self.age.get() or 0),
-            self.gender_var.get(),
-            self.phone.get(),
-            self.disease.get(),
-            self.address.get(),
-        )
-        messagebox.showinfo("Success", "Patient updated")
-        self.refresh_patients()
-        self.refresh_patient_comboboxes()
+
+        def done(changes):
+            if not changes:
+                messagebox.showerror("Error", "No patient with this ID. Use Save / Add instead.")
+                return
+            messagebox.showinfo("Success", "Patient updated")
+            self.apply_changes(changes)
+        self.worker.call(self.db.update_patient, *self._patient_form(), done=done)
 
     def delete_patient(self):
         pid = self.pid.get()
@@ -325,10 +3618,10 @@ class MedicareApp(tk.Tk):
             messagebox.showerror("Error", "Enter Patient ID to delete")
             return
         if messagebox.askyesno("Confirm", f"Delete patient {pid}? This will also remove appointments and bills."):
-            self.db.delete_patient(pid)
-            self.refresh_patients()
-            self.clear_patient_form()
-            self.refresh_patient_comboboxes()
+            def done(changes):
+                self.apply_changes(changes)
+                self.clear_patient_form()
+            self.worker.call(self.db.delete_patient, pid, done=done)
 
     def clear_patient_form(self):
         for w in (self.pid, self.name, self.age, self.phone, self.disease, self.address):
@@ -337,31 +3630,59 @@ class MedicareApp(tk.Tk):
         self.patients_tv.selection_remove(*self.patients_tv.selection())
 
     def refresh_patients(self):
-        for i in self.patients_tv.get_children():
-            self.patients_tv.delete(i)
-        rows = self.db.list_patients(self.search_var.get().strip())
-        for r in rows:
-            self.patients_tv.insert("", tk.END, values=r)
-        self.refresh_patient_comboboxes()
+        self.patient_search.invalidate()
+        search = self.search_var.get().strip()
+        if search:
+            self.worker.call(self.db.list_patients, search, limit=SEARCH_LIMIT, done=self.patients_view.set_rows)
+        else:
+            self.patients_view.reload()
+
+    def _on_search_changed(self):
+        # Debounce: only search once typing pauses
+        if self._search_after is not None:
+            self.after_cancel(self._search_after)
+        self._search_after = self.after(SEARCH_DEBOUNCE_MS, self._submit_search)
+
+    def _submit_search(self):
+        self._search_after = None
+        if not self.search_var.get().strip():
+            self.patient_search.submit("")  # supersede anything in flight
+            self.patients_view.reload()
+            return
+        self.patient_search.submit(self.search_var.get())
+        if not self._search_polling:
+            self._search_polling = True
+            self.after(SEARCH_POLL_MS, self._poll_search)
+
+    def _poll_search(self):
+        result = self.patient_search.poll()
+        if result is None:
+            self.after(SEARCH_POLL_MS, self._poll_search)
+            return
+        self._search_polling = False
+        if result[1]:
+            self.patients_view.set_rows(result[2])
 
     def on_patient_select(self, _):
         sel = self.patients_tv.selection()
         if not sel:
             return
-        vals = self.patients_tv.item(sel[0], "values")
-        self.pid.set(vals[0])
-        self.name.set(vals[1])
-        self.age.set(vals[2])
-        self.gender_var.set(vals[3])
-        self.phone.set(vals[4])
-        self.disease.set(vals[5])
-        self.address.set(vals[6])
+        # From the database rather than the Treeview, whose values come back
+        # converted (a phone number like 0123 would lose its leading zero)
+        def done(patient):
+            if patient is None or self.patients_tv.selection()[:1] != (patient.pid,):
+                return  # gone, or the user has moved on to another row
+            self.pid.set(patient.pid)
+            self.name.set(patient.name)
+            self.age.set(patient.age)
+            self.gender_var.set(patient.gender)
+            self.phone.set(patient.phone)
+            self.disease.set(patient.disease)
+            self.address.set(patient.address)
+        self.worker.call(self.db.get_patient, sel[0], done=done)
 
     # ---------------- Appointments Tab ----------------
-    def _build_appointments_tab(self):
-        tab = ttk.Frame(self.notebook, padding=PAD)
-        self.notebook.add(tab, text="Appointments")
-
+    def _build_appointments_tab(self, tab):
         form = ttk.LabelFrame(tab, text="Book Appointment", padding=PAD)
         form.pack(fill=tk.X, padx=PAD, pady=PAD)
 
@@ -369,8 +3690,7 @@ class MedicareApp(tk.Tk):
         row.pack(fill=tk.X, pady=4)
 
         ttk.Label(row, text="Patient").pack(side=tk.LEFT)
-        self.appt_patient_var = tk.StringVar()
-        self.appt_patient_cb = ttk.Combobox(row, textvariable=self.appt_patient_var, width=28, state="readonly")
+        self.appt_patient_cb = PatientPicker(row, self.patient_directory, textvariable=self.appt_patient_var, width=28)
         self.appt_patient_cb.pack(side=tk.LEFT, padx=(6, PAD))
 
         ttk.Label(row, text="Doctor").pack(side=tk.LEFT)
@@ -393,73 +3713,174 @@ class MedicareApp(tk.Tk):
         self.appt_date.pack(side=tk.LEFT, padx=(0, PAD))
         self.appt_time = LabeledEntry(row2, "Time (HH:MM)")
         self.appt_time.pack(side=tk.LEFT, padx=(0, PAD))
+        self.appt_repeat = LabeledEntry(row2, "Weeks", width=4)
+        self.appt_repeat.set("1")
+        self.appt_repeat.pack(side=tk.LEFT, padx=(0, PAD))
         self.appt_notes = LabeledEntry(row2, "Notes")
         self.appt_notes.pack(side=tk.LEFT, fill=tk.X, expand=True)
 
         btns = ttk.Frame(form)
         btns.pack(fill=tk.X, pady=4)
         ttk.Button(btns, text="Book", command=self.book_appointment).pack(side=tk.LEFT)
+        ttk.Button(btns, text="Next Free Slot", command=self.next_free_slot).pack(side=tk.LEFT, padx=(6, 0))
         ttk.Button(btns, text="Delete Selected", command=self.delete_selected_appointment).pack(side=tk.LEFT, padx=6)
         ttk.Button(btns, text="Refresh", command=self.refresh_appointments).pack(side=tk.LEFT)
 
         # Table
-        cols = ("id", "pid", "doctor", "dept", "appt_date", "appt_time", "notes", "created_at")
-        self.appt_tv = ttk.Treeview(tab, columns=cols, show="headings", height=13)
-        for c, w in zip(cols, (60, 100, 140, 120, 100, 80, 220, 140)):
-            self.appt_tv.heading(c, text=c.upper())
-            self.appt_tv.column(c, width=w, anchor=tk.W)
-        self.appt_tv.pack(fill=tk.BOTH, expand=True, padx=PAD, pady=(4, PAD))
+        self.appt_view = PagedTreeview(
+            tab, APPOINTMENT_COLUMNS, (60, 100, 140, 120, 100, 80, 220, 140),
+            lambda order_by, desc, limit, cursor: self.db.query_appointments(
+                self.appt_filters, order_by=order_by, descending=desc, limit=limit, cursor=cursor),
+            height=13,
+            default_order=("appt_date", "appt_time"),
+            accepts=lambda row: filter_matches("appointments", self.appt_filters, row),
+            worker=self.worker,
+        )
+        self.appt_view.pack(fill=tk.BOTH, expand=True, padx=PAD, pady=(4, PAD))
+        self.appt_tv = self.appt_view.tv
 
         filter_row = ttk.Frame(tab)
         filter_row.pack(fill=tk.X, padx=PAD, pady=(0, PAD))
-        ttk.Label(filter_row, text="Filter by Patient ID:").pack(side=tk.LEFT)
-        self.appt_filter_var = tk.StringVar()
-        ttk.Entry(filter_row, textvariable=self.appt_filter_var, width=20).pack(side=tk.LEFT, padx=(6, 6))
+        self.appt_filters = {}
+        self.appt_filter_vars = {name: tk.StringVar() for name in ("pid", "doctor", "dept", "date_from", "date_to")}
+        ttk.Label(filter_row, text="Patient ID").pack(side=tk.LEFT)
+        ttk.Entry(filter_row, textvariable=self.appt_filter_vars["pid"], width=10).pack(side=tk.LEFT, padx=(4, 6))
+        ttk.Label(filter_row, text="Doctor").pack(side=tk.LEFT)
+        ttk.Combobox(filter_row, textvariable=self.appt_filter_vars["doctor"], state="readonly", width=12,
+                     values=[""] + [d[0] for d in self.DOCTORS]).pack(side=tk.LEFT, padx=(4, 6))
+        ttk.Label(filter_row, text="Dept").pack(side=tk.LEFT)
+        ttk.Combobox(filter_row, textvariable=self.appt_filter_vars["dept"], state="readonly", width=14,
+                     values=[""] + sorted({d[1] for d in self.DOCTORS})).pack(side=tk.LEFT, padx=(4, 6))
+        ttk.Label(filter_row, text="From").pack(side=tk.LEFT)
+        ttk.Entry(filter_row, textvariable=self.appt_filter_vars["date_from"], width=11).pack(side=tk.LEFT, padx=(4, 6))
+        ttk.Label(filter_row, text="To").pack(side=tk.LEFT)
+        ttk.Entry(filter_row, textvariable=self.appt_filter_vars["date_to"], width=11).pack(side=tk.LEFT, padx=(4, 6))
         ttk.Button(filter_row, text="Apply", command=self.refresh_appointments).pack(side=tk.LEFT)
+        ttk.Button(filter_row, text="Clear", command=lambda: self._clear_filters(
+            self.appt_filter_vars, self.refresh_appointments)).pack(side=tk.LEFT, padx=6)
+        self.views["appointments"] = self.appt_view
+
+        self.appt_view.reload()
+
+    def _apply_patient_choice(self, change):
+        # Keep the pickers' current text in step with the patient it names
+        self.patient_directory.apply(change)
+        for var in (self.appt_patient_var, self.bill_patient_var):
+            if self._extract_pid(var.get()) == change.key:
+                var.set("" if change.op == "delete" else f"{change.key} - {change.row[1]}")
+
+    def apply_changes(self, changes):
+        # Patch the affected views row by row instead of reloading them. Tabs
+        # not built yet have nothing to patch; they load fresh when shown.
+        for change in changes:
+            if change.table in self.views:
+                self.views[change.table].apply(change)
+            self.schedule.apply(change)
+            if change.table == "patients":
+                self._apply_patient_choice(change)
+        if any(c.table == "patients" for c in changes):
+            self.patient_search.invalidate()
+        # Summary tables are trigger-maintained, so re-reading them is cheap
+        if self.report_tables and any(c.table in ("appointments", "bills") for c in changes):
+            self.refresh_reports()
+
+    def _poll_changes(self):
+        # Skipped while the user's own calls are queued, or the last poll is
+        # still out; those finish first and the next tick catches up.
+        if not self.worker.pending and (self._change_poll is None or self._change_poll.done()):
+            self._change_poll = self.worker.call(self.db.poll_changes, done=self._apply_polled, quiet=True)
+        self.after(CHANGE_POLL_MS, self._poll_changes)
+
+    def _apply_polled(self, changes):
+        if changes is None:
+            self.reload_views()
+        elif changes:
+            self.apply_changes(changes)
 
-        self.refresh_patient_comboboxes()
-        self.refresh_appointments()
-
-    def refresh_patient_comboboxes(self):
-        # For appointment & billing dropdowns
-        patients = [f"{r[0]} - {r[1]}" for r in self.db.list_patients()]
-        if hasattr(self, 'appt_patient_cb'):
-            self.appt_patient_cb['values'] = patients
-            if patients and not self.appt_patient_var.get():
-                self.appt_patient_cb.current(0)
-        if hasattr(self, 'bill_patient_cb'):
-            self.bill_patient_cb['values'] = patients
-            if patients and not self.bill_patient_var.get():
-                self.bill_patient_cb.current(0)
+    def reload_views(self):
+        # Too much changed elsewhere to patch in; reload the built views with
+        # their current filters and drop the in-memory caches
+        self.schedule.invalidate()
+        self.patient_directory.invalidate()
+        for table, view in self.views.items():
+            if table == "patients":
+                self.refresh_patients()
+            else:
+                view.reload()
+        if self.report_tables:
+            self.refresh_reports()
 
     def _extract_pid(self, combo_value: str) -> str:
         # combo format: "PID - Name"
         return (combo_value or "").split(" - ")[0]
 
-    def book_appointment(self):
-        pid = self._extract_pid(self.appt_patient_var.get())
+    def _pick_patient(self, var, then):
+        # The picker is free text, so only accept a pid that exists: then(pid)
+        # runs once it is known to. A pid the directory has not loaded yet is
+        # looked up on the worker.
+        pid = self._extract_pid(var.get()).strip()
         if not pid:
             messagebox.showerror("Validation", "Select a patient")
-            return
+        elif self.patient_directory.label(pid) is not None:
+            then(pid)
+        else:
+            self.worker.call(self.db.get_patient, pid, done=lambda patient: then(pid) if patient is not None
+                             else messagebox.showerror("Validation", "Select a patient"))
+
+    def book_appointment(self):
+        self._pick_patient(self.appt_patient_var, self._book_appointment)
+
+    def _book_appointment(self, pid):
         date = self.appt_date.get()
         time_ = self.appt_time.get()
         doctor = self.doctor_var.get()
         dept = self.dept_var.get()
-        if not date:
-            messagebox.showerror("Validation", "Date is required (YYYY-MM-DD)")
+        error = appointment_error(date, time_)
+        if error:
+            messagebox.showerror("Validation", error)
             return
         try:
-            # light validation
-            datetime.strptime(date, "%Y-%m-%d")
-            if time_:
-                datetime.strptime(time_, "%H:%M")
+            weeks = int(self.appt_repeat.get() or 1)
         except ValueError:
-            messagebox.showerror("Validation", "Invalid date/time format")
+            weeks = 0
+        if weeks < 1:
+            messagebox.showerror("Validation", "Weeks must be a whole number of at least 1")
             return
-        self.db.add_appointment(pid, doctor, dept, date, time_, self.appt_notes.get())
-        messagebox.showinfo("Success", "Appointment booked")
-        self.refresh_appointments()
-        self.appt_notes.set("")
+
+        def done(changes):
+            messagebox.showinfo("Success", "Appointment booked" if weeks == 1 else f"{weeks} weekly appointments booked")
+            self.apply_changes(changes)
+            self.appt_notes.set("")
+
+        def failed(error):
+            if not isinstance(error, ScheduleConflict):
+                self.worker.on_error(error)
+                return
+            # Suggest the doctor's next free slots, also found on the worker
+            def suggest(free):
+                hint = "\n".join(f"{d} {t}" for d, t, _, _ in free)
+                messagebox.showerror("Double booking", f"{error}\n\nNext free for {doctor}:\n{hint or 'none'}")
+            self.worker.call(self.schedule.next_free_slots, 3, doctor=doctor,
+                             after=datetime.strptime(date, "%Y-%m-%d"), done=suggest)
+        self.worker.call(self.schedule.book_recurring, pid, doctor, dept, date, time_, weeks,
+                         notes=self.appt_notes.get(), done=done, failed=failed)
+
+    def next_free_slot(self):
+        # Fill date/time with the selected doctor's first free slot from the entered date (or now)
+        after = datetime.now()
+        date = self.appt_date.get()
+        if date and not appointment_error(date, ""):
+            after = max(after, datetime.strptime(date, "%Y-%m-%d"))
+
+        def done(free):
+            if not free:
+                messagebox.showinfo("Schedule", f"No free slot in the next {FREE_SLOT_DAYS} days")
+                return
+            day, time_, _, dept = free[0]
+            self.appt_date.set(day)
+            self.appt_time.set(time_)
+            self.dept_var.set(dept)
+        self.worker.call(self.schedule.next_free_slots, 1, doctor=self.doctor_var.get(), after=after, done=done)
 
     def delete_selected_appointment(self):
         sel = self.appt_tv.selection()
@@ -468,29 +3889,37 @@ class MedicareApp(tk.Tk):
             return
         appt_id = self.appt_tv.item(sel[0], "values")[0]
         if messagebox.askyesno("Confirm", f"Delete appointment #{appt_id}?"):
-            self.db.delete_appointment(appt_id)
-            self.refresh_appointments()
+            self.worker.call(self.db.delete_appointment, appt_id, done=self.apply_changes)
+
+    def _read_filters(self, table, variables):
+        # Filters from a filter row, or None (after telling the user) if one is invalid
+        try:
+            return normalize_filters(table, {name: var.get() for name, var in variables.items()})
+        except ValueError as e:
+            messagebox.showerror("Filter", str(e))
+            return None
+
+    def _clear_filters(self, variables, refresh):
+        for var in variables.values():
+            var.set("")
+        refresh()
 
     def refresh_appointments(self):
-        for i in self.appt_tv.get_children():
-            self.appt_tv.delete(i)
-        pid_filter = self.appt_filter_var.get().strip()
-        for r in self.db.list_appointments(pid_filter):
-            self.appt_tv.insert("", tk.END, values=r)
+        filters = self._read_filters("appointments", self.appt_filter_vars)
+        if filters is None:
+            return
+        self.appt_filters = filters
+        self.appt_view.reload()
 
     # ---------------- Billing Tab ----------------
-    def _build_billing_tab(self):
-        tab = ttk.Frame(self.notebook, padding=PAD)
-        self.notebook.add(tab, text="Billing")
-
+    def _build_billing_tab(self, tab):
         form = ttk.LabelFrame(tab, text="Generate Bill", padding=PAD)
         form.pack(fill=tk.X, padx=PAD, pady=PAD)
 
         top = ttk.Frame(form)
         top.pack(fill=tk.X, pady=4)
         ttk.Label(top, text="Patient").pack(side=tk.LEFT)
-        self.bill_patient_var = tk.StringVar()
-        self.bill_patient_cb = ttk.Combobox(top, textvariable=self.bill_patient_var, width=28, state="readonly")
+        self.bill_patient_cb = PatientPicker(top, self.patient_directory, textvariable=self.bill_patient_var, width=28)
         self.bill_patient_cb.pack(side=tk.LEFT, padx=(6, PAD))
 
         charges = ttk.Frame(form)
@@ -513,82 +3942,1036 @@ class MedicareApp(tk.Tk):
         self.total_var = tk.StringVar(value="Total: 0.00")
         ttk.Label(form, textvariable=self.total_var, font=("Segoe UI", 12, "bold")).pack(anchor=tk.W, pady=(4, 0))
 
-        cols = ("id", "pid", "consultation", "medicine", "room", "other", "total", "created_at")
-        self.bills_tv = ttk.Treeview(tab, columns=cols, show="headings", height=13)
-        for c, w in zip(cols, (60, 100, 110, 110, 90, 90, 100, 140)):
-            self.bills_tv.heading(c, text=c.upper())
-            self.bills_tv.column(c, width=w, anchor=tk.W)
-        self.bills_tv.pack(fill=tk.BOTH, expand=True, padx=PAD, pady=(4, PAD))
+        self.bills_view = PagedTreeview(
+            tab, BILL_COLUMNS, (60, 100, 110, 110, 90, 90, 100, 140),
+            lambda order_by, desc, limit, cursor: self.db.query_bills(
+                self.bill_filters, order_by=order_by, descending=desc, limit=limit, cursor=cursor),
+            height=13,
+            default_order=("created_at",),
+            accepts=lambda row: filter_matches("bills", self.bill_filters, row),
+            worker=self.worker,
+        )
+        self.bills_view.pack(fill=tk.BOTH, expand=True, padx=PAD, pady=(4, PAD))
+        self.bills_tv = self.bills_view.tv
 
         filter_row = ttk.Frame(tab)
         filter_row.pack(fill=tk.X, padx=PAD, pady=(0, PAD))
-        ttk.Label(filter_row, text="Filter by Patient ID:").pack(side=tk.LEFT)
-        self.bill_filter_var = tk.StringVar()
-        ttk.Entry(filter_row, textvariable=self.bill_filter_var, width=20).pack(side=tk.LEFT, padx=(6, 6))
+        self.bill_filters = {}
+        self.bill_filter_vars = {name: tk.StringVar()
+                                 for name in ("pid", "date_from", "date_to", "amount_min", "amount_max")}
+        for name, label, width in (("pid", "Patient ID", 10), ("date_from", "From", 11), ("date_to", "To", 11),
+                                   ("amount_min", "Total \u2265", 9), ("amount_max", "\u2264", 9)):
+            ttk.Label(filter_row, text=label).pack(side=tk.LEFT)
+            ttk.Entry(filter_row, textvariable=self.bill_filter_vars[name], width=width).pack(side=tk.LEFT, padx=(4, 6))
         ttk.Button(filter_row, text="Apply", command=self.refresh_bills).pack(side=tk.LEFT)
+        ttk.Button(filter_row, text="Clear", command=lambda: self._clear_filters(
+            self.bill_filter_vars, self.refresh_bills)).pack(side=tk.LEFT, padx=6)
+        self.views["bills"] = self.bills_view
 
-        self.refresh_patient_comboboxes()
-        self.refresh_bills()
+        self.bills_view.reload()
 
     def calc_total(self):
-        total = sum([
+        total = bill_total(
             self.consult.get_float(),
             self.medicine.get_float(),
             self.room.get_float(),
             self.other.get_float(),
-        ])
+        )
         self.total_var.set(f"Total: {total:.2f}")
         return total
 
     def save_bill(self):
-        pid = self._extract_pid(self.bill_patient_var.get())
-        if not pid:
-            messagebox.showerror("Validation", "Select a patient")
-            return
-        c, m, r, o = (
-            self.consult.get_float(),
-            self.medicine.get_float(),
-            self.room.get_float(),
-            self.other.get_float(),
-        )
-        total = c + m + r + o
-        self.db.add_bill(pid, c, m, r, o)
-        messagebox.showinfo("Success", f"Bill saved. Total = {total:.2f}")
-        self.refresh_bills()
-        self.total_var.set("Total: 0.00")
-        for w in (self.consult, self.medicine, self.room, self.other):
-            w.set("")
+        self._pick_patient(self.bill_patient_var, self._save_bill)
+
+    def _save_bill(self, pid):
+        # Rounded to cents as they will be stored, and totalled in cents
+        c, m, r, o = (_money(w.get_float()) for w in (self.consult, self.medicine, self.room, self.other))
+        total = bill_total(c, m, r, o)
+
+        def done(changes):
+            messagebox.showinfo("Success", f"Bill saved. Total = {total:.2f}")
+            self.apply_changes(changes)
+            self.total_var.set("Total: 0.00")
+            for w in (self.consult, self.medicine, self.room, self.other):
+                w.set("")
+        self.worker.call(self.db.add_bill, pid, c, m, r, o, done=done)
 
     def refresh_bills(self):
-        for i in self.bills_tv.get_children():
-            self.bills_tv.delete(i)
-        pid_filter = self.bill_filter_var.get().strip()
-        for r in self.db.list_bills(pid_filter):
-            self.bills_tv.insert("", tk.END, values=r)
+        filters = self._read_filters("bills", self.bill_filter_vars)
+        if filters is None:
+            return
+        self.bill_filters = filters
+        self.bills_view.reload()
 
     def export_selected_bill(self):
         sel = self.bills_tv.selection()
         if not sel:
             messagebox.showerror("Error", "Select a bill to export")
             return
-        vals = self.bills_tv.item(sel[0], "values")
-        bill_id, pid, c, m, r, o, total, created = vals
-        # Fetch patient name
-        rows = self.db.list_patients(pid)
-        pname = rows[0][1] if rows else "Unknown"
-        content = (
-            f"==== Medicare Bill ===\n"
-            f"Bill ID: {bill_id}\nDate: {created}\n\n"
-            f"Patient ID: {pid}\nName: {pname}\n\n"
-            f"Consultation: {c}\nMedicine: {m}\nRoom: {r}\nOther: {o}\n"
-            f"---------------------------\nTotal: {total}\n"
+        if len(sel) > 1:
+            self.worker.call(generate_statements, self.db, ".", bill_ids=sel, done=lambda stats: messagebox.showinfo(
+                "Exported", f"Saved {stats['files']} bills in current folder"))
+            return
+
+        def export(bill_id):
+            bill = self.db.get_bill(bill_id)
+            if bill is None:
+                return None
+            patient = self.db.get_patient(bill.pid)
+            fname = f"bill_{bill.id}.txt"
+            _write_text(fname, render_bill(bill, patient.name if patient else None))
+            return fname
+
+        def done(fname):
+            if fname is None:
+                messagebox.showerror("Error", "That bill no longer exists")
+            else:
+                messagebox.showinfo("Exported", f"Saved {fname} in current folder")
+        self.worker.call(export, int(sel[0]), done=done)
+
+    # ---------------- Reports Tab ----------------
+    def _build_reports_tab(self, tab):
+        row = ttk.Frame(tab)
+        row.pack(fill=tk.X, padx=PAD, pady=PAD)
+        self.report_from = LabeledEntry(row, "From (YYYY-MM-DD)", width=12)
+        self.report_from.pack(side=tk.LEFT, padx=(0, PAD))
+        self.report_to = LabeledEntry(row, "To", width=12)
+        self.report_to.pack(side=tk.LEFT, padx=(0, PAD))
+        ttk.Button(row, text="Show", command=self.refresh_reports).pack(side=tk.LEFT)
+        ttk.Button(row, text="Rebuild Summaries", command=self.rebuild_summaries).pack(side=tk.LEFT, padx=6)
+
+        def table(parent, title, cols, widths, height):
+            frame = ttk.LabelFrame(parent, text=title, padding=4)
+            tv = ttk.Treeview(frame, columns=cols, show="headings", height=height)
+            for c, w in zip(cols, widths):
+                tv.heading(c, text=c.upper())
+                tv.column(c, width=w, anchor=tk.W)
+            tv.pack(fill=tk.BOTH, expand=True)
+            return frame, tv
+
+        frame, self.revenue_tv = table(tab, "Daily Revenue",
+                                       ("day", "bills", "consultation", "medicine", "room", "other", "total"),
+                                       (100, 60, 110, 110, 90, 90, 110), 8)
+        frame.pack(fill=tk.BOTH, expand=True, padx=PAD, pady=(0, PAD))
+        bottom = ttk.Frame(tab)
+        bottom.pack(fill=tk.BOTH, expand=True, padx=PAD)
+        frame, self.visits_tv = table(bottom, "Visits by Doctor", ("doctor", "dept", "visits"), (140, 140, 70), 8)
+        frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=(0, PAD))
+        frame, self.spend_tv = table(bottom, "Top Patients (lifetime)", ("pid", "name", "bills", "total"),
+                                     (100, 160, 60, 110), 8)
+        frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.report_tables.update(revenue=self.revenue_tv, visits=self.visits_tv, spend=self.spend_tv)
+
+        self.refresh_reports()
+
+    def _report_rows(self, date_from, date_to):
+        return (self.db.revenue_by_day(date_from, date_to), self.db.visits_by_doctor(date_from, date_to),
+                self.db.top_patients())
+
+    def _show_reports(self, reports):
+        money = lambda v: f"{v:.2f}"
+        fill = (
+            (self.revenue_tv, lambda r: (r[0], r[1]) + tuple(money(v) for v in r[2:])),
+            (self.visits_tv, lambda r: r),
+            (self.spend_tv, lambda r: (r[0], r[1] or "", r[2], money(r[3]))),
         )
-        fname = f"bill_{bill_id}.txt"
-        with open(fname, "w", encoding="utf-8") as f:
-            f.write(content)
-        messagebox.showinfo("Exported", f"Saved {fname} in current folder")
+        for (tv, fmt), rows in zip(fill, reports):
+            tv.delete(*tv.get_children())
+            for r in rows:
+                tv.insert("", tk.END, values=fmt(r))
+
+    def refresh_reports(self):
+        date_from, date_to = self.report_from.get(), self.report_to.get()
+        for d in (date_from, date_to):
+            if d and appointment_error(d, ""):
+                messagebox.showerror("Validation", "Dates must be YYYY-MM-DD")
+                return
+        self.worker.call(self._report_rows, date_from, date_to, done=self._show_reports)
+
+    def rebuild_summaries(self):
+        def done(_):
+            self.refresh_reports()
+            messagebox.showinfo("Reports", "Summary tables rebuilt")
+        self.worker.call(self.db.rebuild_summaries, done=done)
+
+    # ---------------- Diagnostics Tab ----------------
+    def _build_diagnostics_tab(self, tab):
+        if self.db.metrics is None:
+            ttk.Label(tab, text="Query metrics are off. Start the app with --instrument to collect them.").pack(
+                padx=PAD, pady=PAD, anchor=tk.W)
+            return
+
+        row = ttk.Frame(tab)
+        row.pack(fill=tk.X, padx=PAD, pady=PAD)
+        ttk.Button(row, text="Refresh", command=self.refresh_diagnostics).pack(side=tk.LEFT)
+        ttk.Button(row, text="Reset", command=self.reset_diagnostics).pack(side=tk.LEFT, padx=6)
+        ttk.Button(row, text="Save JSON", command=self.save_diagnostics).pack(side=tk.LEFT)
+        self.diag_summary = ttk.Label(row)
+        self.diag_summary.pack(side=tk.LEFT, padx=PAD)
+
+        cols = ("method", "calls", "p50_ms", "p95_ms", "max_ms", "total_ms", "rows")
+        self.diag_methods_tv = ttk.Treeview(tab, columns=cols, show="headings", height=8)
+        for c, w in zip(cols, (220, 70, 80, 80, 80, 90, 80)):
+            self.diag_methods_tv.heading(c, text=c.upper())
+            self.diag_methods_tv.column(c, width=w, anchor=tk.W)
+        self.diag_methods_tv.pack(fill=tk.BOTH, expand=True, padx=PAD)
+
+        cols = ("at", "ms", "method", "sql")
+        slow = ttk.LabelFrame(tab, text="Slow statements", padding=4)
+        slow.pack(fill=tk.BOTH, expand=True, padx=PAD, pady=PAD)
+        self.diag_slow_tv = ttk.Treeview(slow, columns=cols, show="headings", height=6)
+        for c, w in zip(cols, (170, 70, 150, 500)):
+            self.diag_slow_tv.heading(c, text=c.upper())
+            self.diag_slow_tv.column(c, width=w, anchor=tk.W)
+        self.diag_slow_tv.pack(fill=tk.BOTH, expand=True)
+        self.diag_slow_tv.bind("<<TreeviewSelect>>", lambda e: self._show_slow_plan())
+        self.diag_plan = tk.Text(slow, height=5, wrap="word")
+        self.diag_plan.pack(fill=tk.X, pady=(4, 0))
+        self._diag_slow = []
+
+        def on_tab_changed(event):
+            if self.notebook.select() == str(tab):
+                self.refresh_diagnostics()
+        self.notebook.bind("<<NotebookTabChanged>>", on_tab_changed, add="+")
+        self.refresh_diagnostics()
+
+    def refresh_diagnostics(self):
+        # The snapshot EXPLAINs the slow statements, so it runs on the worker
+        self.worker.call(self.db.metrics_snapshot, done=self._show_diagnostics)
+
+    def _show_diagnostics(self, snap):
+        cache = snap["record_cache"]
+        self.diag_summary.config(text=f"since {snap['since']}   commits {snap['commits']}   "
+                                      f"rollbacks {snap['rollbacks']}   journal {snap['journal_mode']}   "
+                                      f"record cache {cache['size']}/{cache['capacity']}, "
+                                      f"hit ratio {cache['hit_ratio'] if cache['hit_ratio'] is not None else '-'}")
+        tv = self.diag_methods_tv
+        tv.delete(*tv.get_children())
+        for name, m in sorted(snap["methods"].items(), key=lambda kv: kv[1]["total_ms"], reverse=True):
+            tv.insert("", tk.END, values=(name, m["calls"], m["p50_ms"], m["p95_ms"], m["max_ms"],
+                                          m["total_ms"], m["rows"]))
+        tv = self.diag_slow_tv
+        tv.delete(*tv.get_children())
+        self._diag_slow = list(reversed(snap["slow"]))
+        for i, entry in enumerate(self._diag_slow):
+            tv.insert("", tk.END, iid=str(i), values=(entry["at"], entry["ms"], entry["method"],
+                                                      " ".join(entry["sql"].split())[:300]))
+        self.diag_plan.delete("1.0", tk.END)
+
+    def _show_slow_plan(self):
+        sel = self.diag_slow_tv.selection()
+        if not sel:
+            return
+        entry = self._diag_slow[int(sel[0])]
+        self.diag_plan.delete("1.0", tk.END)
+        self.diag_plan.insert(tk.END, entry["sql"] + "\n\n" + "\n".join(entry["plan"] or ["(no plan)"]))
+
+    def reset_diagnostics(self):
+        self.db.metrics.reset()
+        self.db.cache.reset_stats()
+        self.refresh_diagnostics()
+
+    def save_diagnostics(self):
+        from tkinter import filedialog
+
+        path = filedialog.asksaveasfilename(defaultextension=".json", initialfile="medicare-metrics.json",
+                                            filetypes=[("JSON", "*.json")])
+        if path:
+            self.worker.call(self.db.metrics.dump, path, self.db,
+                             done=lambda _: messagebox.showinfo("Diagnostics", f"Metrics saved to {path}"))
+
+# --------------------- Synthetic Data & Benchmarks ---------------------
+# generate_data() fills a database with reproducible fake records;
+# run_benchmarks() times the DB methods and the view refresh paths against it
+# and returns plain JSON so runs from different commits can be compared.
+BENCH_REPEAT = 5
+BENCH_TOLERANCE = 0.25   # slower by more than this fraction is a regression
+BENCH_NOISE_MS = 0.5     # ...unless the difference is below this
+STARTUP_PROBE_TIMEOUT_S = 30
+_FIRST_NAMES = ("Aarav", "Vivaan", "Aditya", "Ishaan", "Riya", "Ananya", "Diya", "Saanvi", "Kabir", "Meera",
+                "Rohan", "Priya", "Arjun", "Neha", "Karan", "Pooja", "Vikram", "Sneha", "Rahul", "Kavya")
+_LAST_NAMES = ("Sharma", "Verma", "Gupta", "Singh", "Patel", "Mehta", "Iyer", "Rao", "Das", "Nair",
+               "Reddy", "Joshi", "Kapoor", "Malhotra", "Bose", "Yadav", "Chopra", "Menon", "Pillai", "Shah")
+_DISEASES = ("Fever", "Diabetes", "Hypertension", "Asthma", "Migraine", "Fracture", "Allergy",
+             "Arthritis", "Anxiety", "Bronchitis", "", "")
+_CITIES = ("Delhi", "Mumbai", "Pune", "Lucknow", "Jaipur", "Chennai", "Kolkata", "Bhopal")
+_SYNTH_EPOCH = datetime(2024, 1, 1)
+_SYNTH_DAYS = 730
+
+def _synth_time(rnd):
+    return _SYNTH_EPOCH + timedelta(seconds=rnd.randrange(_SYNTH_DAYS * 86400))
+
+def _synth_patient(rnd, n):
+    name = f"{rnd.choice(_FIRST_NAMES)} {rnd.choice(_LAST_NAMES)}"
+    return (f"S{n:07d}", name, rnd.randrange(96), rnd.choice("MFO"),
+            f"9{rnd.randrange(10**9):09d}", rnd.choice(_DISEASES),
+            f"{rnd.randrange(1, 500)} MG Road, {rnd.choice(_CITIES)}",
+            _synth_time(rnd).isoformat(timespec="seconds"))
+
+def _synth_appointment(rnd, pid):
+    doctor, dept = rnd.choice(DOCTORS)
+    day = _synth_time(rnd)
+    slot = rnd.randrange((_minutes(CLINIC_HOURS[1]) - _minutes(CLINIC_HOURS[0])) // SLOT_MINUTES)
+    return (pid, doctor, dept, day.date().isoformat(), _hhmm(_minutes(CLINIC_HOURS[0]) + slot * SLOT_MINUTES),
+            rnd.choice(("", "", "Follow-up", "First visit")), day.isoformat(timespec="seconds"))
+
+def _synth_bill(rnd, pid):
+    amounts = [float(rnd.choice((300, 500, 800))), float(rnd.randrange(0, 3000, 10)),
+               float(rnd.choice((0, 0, 1500, 3000))), float(rnd.randrange(0, 500, 50))]
+    return (pid, *amounts, bill_total(*amounts), _synth_time(rnd).isoformat(timespec="seconds"))
+
+def generate_data(db, patients=1000, appointments=None, bills=None, seed=1,
+                  chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    # The same seed and counts give the same rows. Patient ids are S0000000
+    # upwards, continuing after earlier synthetic patients. The generator
+    # writes directly and does not go through Schedule, so doctors can be
+    # double-booked. appointments/bills default to 3x and 2x the patients.
+    import random
+
+    appointments = patients * 3 if appointments is None else appointments
+    bills = patients * 2 if bills is None else bills
+    rnd = random.Random(seed)
+    first = db.conn.execute("SELECT COUNT(*) FROM patients WHERE pid GLOB 'S[0-9]*'").fetchone()[0]
+    pids = [f"S{n:07d}" for n in range(first, first + patients)]
+    if not pids and (appointments or bills):
+        pids = [r[0] for r in db.conn.execute("SELECT pid FROM patients WHERE pid GLOB 'S[0-9]*'")]
+        if not pids:
+            raise ValueError("no synthetic patients to attach appointments and bills to")
+    plan = (
+        ("patients", patients, lambda i: _synth_patient(rnd, first + i)),
+        ("appointments", appointments, lambda i: _synth_appointment(rnd, rnd.choice(pids))),
+        ("bills", bills, lambda i: _synth_bill(rnd, rnd.choice(pids))),
+    )
+    stats = {"patients": 0, "appointments": 0, "bills": 0, "seconds": 0.0}
+    started = time.perf_counter()
+    cache_size = db.conn.execute("PRAGMA cache_size").fetchone()[0]
+    db.conn.execute(f"PRAGMA cache_size = {-IMPORT_CACHE_KIB}")
+    try:
+        for table, count, make in plan:
+            for start in range(0, count, chunk_size):
+                db.insert_rows(table, [make(i) for i in range(start, min(count, start + chunk_size))])
+                stats[table] = min(count, start + chunk_size)
+                stats["seconds"] = time.perf_counter() - started
+                if progress:
+                    progress(stats)
+    finally:
+        db.conn.execute(f"PRAGMA cache_size = {int(cache_size)}")
+    stats["seconds"] = time.perf_counter() - started
+    return stats
+
+class _Rollback(Exception):
+    pass
+
+def _time_calls(fn, args_list):
+    times = []
+    for args in args_list:
+        started = time.perf_counter()
+        fn(*args)
+        times.append((time.perf_counter() - started) * 1000)
+    return _stats(times)
+
+def _stats(times):
+    times = sorted(times)
+    return {"runs": len(times), "min_ms": round(times[0], 3),
+            "median_ms": round(times[len(times) // 2], 3), "max_ms": round(times[-1], 3)}
+
+def _rolled_back(db, fn):
+    # Time a mutation without keeping it: the unit of work is rolled back
+    def run(*args):
+        try:
+            with db.transaction():
+                fn(*args)
+                raise _Rollback
+        except _Rollback:
+            pass
+    return run
+
+def _bench_meta(db, repeat):
+    import platform
+    import subprocess
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    with db._reading() as conn:
+        rows = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+                for t in ("patients", "appointments", "bills")}
+    return {"created": datetime.now().isoformat(timespec="seconds"), "commit": commit,
+            "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+            "db": os.path.abspath(db.db_name), "rows": rows, "repeat": repeat}
+
+def _db_benchmarks(db, repeat, seed):
+    import random
+
+    rnd = random.Random(seed)
+    with db._reading() as conn:
+        top = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM patients").fetchone()[0]
+        rows = []
+        for _ in range(repeat * 4):
+            row = conn.execute("SELECT pid, name FROM patients WHERE rowid >= ? LIMIT 1",
+                               (rnd.randint(1, top),)).fetchone()
+            if row:
+                rows.append(row)
+    if not rows:
+        raise ValueError("the database has no patients; run 'generate' first")
+    pids = [pid for pid, _ in rows]
+    pick = [(pid,) for pid in pids[:repeat]]
+    # Read directly, not through get_patient, which would warm the record cache
+    names = [(name.split()[0][:3],) for _, name in rows[:repeat]]
+    deep = top // 2  # rowids are roughly the patient count
+    # The cursor query_patients would return after `deep` rows, read as one
+    # key off the (created_at, pid) index rather than by fetching the rows
+    with db._reading() as conn:
+        key = conn.execute("SELECT created_at, pid FROM patients ORDER BY created_at DESC, pid DESC "
+                           "LIMIT 1 OFFSET ?", (deep - 1,)).fetchone()
+    deep_cursor = _encode_cursor(None, True, list(key))
+    schedule = Schedule(db)
+    after = [(datetime(2025, 1, 1) + timedelta(days=7 * i),) for i in range(repeat)]
+    nothing = [()] * repeat
+    cases = {
+        "list_patients(page)": (lambda: db.list_patients(limit=PAGE_SIZE), nothing),
+        "list_patients(page, order=name)": (lambda: db.list_patients(limit=PAGE_SIZE, order_by="name", descending=False), nothing),
+        "list_patients(deep offset)": (lambda: db.list_patients(limit=PAGE_SIZE, offset=deep), nothing),
+        "query_patients(deep cursor)": (lambda: db.query_patients(limit=PAGE_SIZE, cursor=deep_cursor), nothing),
+        "list_patients(search prefix)": (lambda s: db.list_patients(s, limit=SEARCH_LIMIT), names),
+        "list_patients(search 2 chars)": (lambda s: db.list_patients(s[:2], limit=SEARCH_LIMIT), names),
+        "get_patient": (db.get_patient, pick),
+        "get_patient(cached)": (db.get_patient, pick[:1] * repeat),
+        "poll_changes(idle)": (db.poll_changes, nothing),
+        "list_appointments(page)": (lambda: db.list_appointments(limit=PAGE_SIZE), nothing),
+        "list_appointments(pid)": (lambda pid: db.list_appointments(pid, limit=PAGE_SIZE), pick),
+        "list_appointments(all)": (lambda: db.list_appointments(), nothing),
+        "query_appointments(dept, week)": (lambda a: db.query_appointments(
+            {"dept": "Cardiologist", "date_from": a.strftime("%Y-%m-%d"),
+             "date_to": (a + timedelta(days=6)).strftime("%Y-%m-%d")}), after),
+        "list_bills(page)": (lambda: db.list_bills(limit=PAGE_SIZE), nothing),
+        "list_bills(pid)": (lambda pid: db.list_bills(pid, limit=PAGE_SIZE), pick),
+        "query_bills(amount range)": (lambda: db.query_bills({"amount_min": 2000, "amount_max": 3000}), nothing),
+        "add_patient (rolled back)": (_rolled_back(db, lambda i: db.add_patient(
+            f"BENCH{i}", "Bench Patient", 30, "M", "", "", "")), [(i,) for i in range(repeat)]),
+        "add_bill (rolled back)": (_rolled_back(db, lambda pid: db.add_bill(pid, 100, 0, 0, 0)), pick),
+        "delete_patient cascade (rolled back)": (_rolled_back(db, db.delete_patient), [(p,) for p in pids[repeat:2 * repeat]]),
+        "revenue_by_day(year)": (lambda: db.revenue_by_day("2024-01-01", "2024-12-31"), nothing),
+        "visits_by_doctor(all)": (lambda: db.visits_by_doctor(), nothing),
+        "top_patients": (lambda: db.top_patients(), nothing),
+        "next_free_slots(dept)": (lambda a: schedule.next_free_slots(5, dept="Cardiologist", after=a), after),
+        "bill_statement_rows(month)": (lambda: sum(1 for _ in db.bill_statement_rows("2024-03-01", "2024-03-31")), nothing),
+    }
+    results = {}
+    for name, (fn, args_list) in cases.items():
+        if name == "get_patient":
+            db.cache.clear()  # the uncached case must miss
+        results[name] = _time_calls(fn, args_list)
+    return results
+
+def _memory_benchmarks(db):
+    # Bytes held per row when a whole table is read, as the plain tuples
+    # fetchall() returns and as the DB's record types
+    import tracemalloc
+
+    results = {}
+    for table, (columns, _) in EXPORT_TABLES.items():
+        sql = f"SELECT {_read_columns(columns)} FROM {table}"
+        sizes = {}
+        with db._reading() as conn:
+            for kind, fetch in (("tuple", lambda: conn.execute(sql).fetchall()),
+                                ("record", lambda: db._records(conn, table, sql, many=True).fetchall())):
+                tracemalloc.start()
+                rows = fetch()
+                sizes[kind] = tracemalloc.get_traced_memory()[0] / max(len(rows), 1)
+                tracemalloc.stop()
+                count = len(rows)
+                del rows
+        results[table] = {"rows": count, "tuple_bytes_per_row": round(sizes["tuple"]),
+                          "record_bytes_per_row": round(sizes["record"])}
+    return results
+
+def _storage_benchmarks(db, repeat):
+    # The bills and appointments copied into scratch files twice: as stored
+    # (integer cents, days, minutes and seconds) and in the old layout of ISO
+    # text and float amounts, each with its date index. Range scans read one
+    # month in the API form, so the typed copy pays for converting back.
+    import shutil
+    import tempfile
+
+    with db._reading() as conn:
+        middle = conn.execute("SELECT created_at FROM bills ORDER BY created_at "
+                              "LIMIT 1 OFFSET (SELECT COUNT(*) / 2 FROM bills)").fetchone()
+    if middle is None:
+        return {}
+    start = datetime(1970, 1, 1) + timedelta(seconds=middle[0])
+    month = [start.replace(day=1, hour=0, minute=0, second=0)]
+    month.append((month[0] + timedelta(days=32)).replace(day=1))
+    month = [m.isoformat(timespec="seconds") for m in month]
+    tables = {"bills": (BILL_COLUMNS, "created_at"), "appointments": (APPOINTMENT_COLUMNS, "appt_date, appt_time")}
+    day = {"typed": "created_at / 86400", "legacy": "substr(created_at, 1, 10)"}
+    results = {}
+    folder = tempfile.mkdtemp(prefix="hc-storage-")
+    try:
+        for layout in ("legacy", "typed"):
+            path = os.path.join(folder, f"{layout}.db")
+            conn = sqlite3.connect(path)
+            conn.execute("ATTACH DATABASE ? AS src", (db.db_name,))
+            for table, (columns, order) in tables.items():
+                cols = ", ".join(columns) if layout == "typed" else _read_columns(columns, named=True)
+                conn.execute(f"CREATE TABLE {table} AS SELECT {cols} FROM src.{table} ORDER BY id")
+                conn.execute(f"CREATE INDEX idx_{table}_date ON {table}({order})")
+            conn.commit()
+            conn.execute("DETACH DATABASE src")
+            conn.execute("VACUUM")
+            size = conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+            if layout == "typed":
+                bills = _read_columns(BILL_COLUMNS)
+                appointments = _read_columns(APPOINTMENT_COLUMNS)
+                bounds = [_epoch_seconds(m) for m in month]
+                days = [_epoch_day(m) for m in month]
+            else:
+                bills, appointments = ", ".join(BILL_COLUMNS), ", ".join(APPOINTMENT_COLUMNS)
+                bounds = days = [m[:10] for m in month]
+            cases = {
+                "bills(month)": (f"SELECT {bills} FROM bills WHERE created_at >= ? AND created_at < ? "
+                                 "ORDER BY created_at", bounds),
+                "appointments(month)": (f"SELECT {appointments} FROM appointments WHERE appt_date >= ? "
+                                        "AND appt_date < ? ORDER BY appt_date, appt_time", days),
+                "sum(total)": ("SELECT SUM(total) FROM bills", ()),
+                "revenue by day": (f"SELECT {day[layout]}, COUNT(*), SUM(total) FROM bills GROUP BY 1", ()),
+            }
+            results[layout] = {"bytes": size}
+            for name, (sql, params) in cases.items():
+                results[layout][name] = _time_calls(lambda: conn.execute(sql, params).fetchall(), [()] * repeat)
+            conn.close()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+def _startup_benchmarks(db_name, repeat):
+    # Cold start of a fresh interpreter, measured from spawn to the first
+    # painted window and to the first page of patients on screen.
+    import subprocess
+
+    paint, data = [], []
+    for _ in range(repeat):
+        spawned = time.time()
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--db", db_name, "--startup-probe"],
+                              capture_output=True, text=True, timeout=STARTUP_PROBE_TIMEOUT_S * 2)
+        if proc.returncode != 0:
+            lines = proc.stderr.strip().splitlines() or ["startup probe failed"]
+            return {}, f"skipped: {lines[-1]}"
+        probe = json.loads(proc.stdout)
+        launch_ms = (probe["started_at"] - spawned) * 1000
+        paint.append(launch_ms + probe["first_paint_ms"])
+        if "first_data_ms" in probe:
+            data.append(launch_ms + probe["first_data_ms"])
+    results = {"startup to first paint": _stats(paint)}
+    if data:
+        results["startup to first data"] = _stats(data)
+    return results, None
+
+def _gui_benchmarks(db_name, repeat):
+    # Needs a display; under CI run through xvfb-run. The window is withdrawn.
+    results, skipped = _startup_benchmarks(db_name, repeat)
+    if skipped:
+        return {}, skipped
+    try:
+        app = MedicareApp(db_name)
+    except tk.TclError as e:
+        return {}, f"skipped: {e}"
+    try:
+        app.withdraw()
+        app.build_all_tabs()
+        app.worker.drain()
+        app.update_idletasks()
+
+        def refresh(fn):
+            # until the rows are on screen, not just until the work is queued
+            def run():
+                fn()
+                app.worker.drain()
+                app.update_idletasks()
+            return run
+
+        def search(text):
+            app.search_var.set(text)
+            app.refresh_patients()
+            app.worker.drain()
+            app.update_idletasks()
+
+        nothing = [()] * repeat
+        cases = {
+            "refresh_patients": (refresh(app.refresh_patients), nothing),
+            "refresh_patients(search)": (search, [("ra",)] * repeat),
+            "refresh_appointments": (refresh(app.refresh_appointments), nothing),
+            "refresh_bills": (refresh(app.refresh_bills), nothing),
+            "refresh_reports": (refresh(app.refresh_reports), nothing),
+            "patients_view.sort_by(name)": (refresh(lambda: app.patients_view.sort_by("name")), nothing),
+        }
+        for name, (fn, args_list) in cases.items():
+            results[name] = _time_calls(fn, args_list)
+        app.search_var.set("")
+        return results, None
+    finally:
+        app.on_close()
+
+def run_benchmarks(db_name=DB_NAME, repeat=BENCH_REPEAT, gui=True, seed=1):
+    db = DB(db_name)
+    try:
+        report = {"meta": _bench_meta(db, repeat), "db": _db_benchmarks(db, repeat, seed),
+                  "memory": _memory_benchmarks(db), "storage": _storage_benchmarks(db, repeat)}
+    finally:
+        db.close()
+    if gui:
+        report["gui"], skipped = _gui_benchmarks(db_name, repeat)
+        if skipped:
+            report["meta"]["gui"] = skipped
+    return report
+
+def compare_benchmarks(base, new, tolerance=BENCH_TOLERANCE, noise_ms=BENCH_NOISE_MS):
+    # [(group/name, base median, new median, ratio, regressed)] for cases in both runs
+    rows = []
+    for group in ("db", "gui"):
+        for name, stats in new.get(group, {}).items():
+            old = base.get(group, {}).get(name)
+            if old is None:
+                continue
+            a, b = old["median_ms"], stats["median_ms"]
+            ratio = b / a if a else float("inf") if b else 1.0
+            rows.append((f"{group}/{name}", a, b, ratio, ratio > 1 + tolerance and b - a > noise_ms))
+    return rows
+
+# --------------------- Command Line ---------------------
+def _plan_uses_index(plan):
+    # A plan is acceptable when no step scans a table without an index and no
+    # temporary B-tree is needed for sorting.
+    return not any(
+        (step.startswith("SCAN") and "USING" not in step and "VIRTUAL TABLE" not in step)
+        or "TEMP B-TREE" in step or step.startswith("n/a")
+        for step in plan
+    )
+
+def cmd_migrate(args):
+    db = DB(args.db, migrate=False)
+    before = dict(db.query_plans())
+    start = db.schema_version()
+    applied = db.migrate()
+    after = db.query_plans()
+    print(f"schema version {start} -> {db.schema_version()}")
+    for version, description in applied:
+        print(f"  applied {version}: {description}")
+    for label, plan in after:
+        status = "ok" if _plan_uses_index(plan) else "SCAN"
+        print(f"\n[{status}] {label}")
+        print("  before: " + " | ".join(before[label]))
+        print("  after:  " + " | ".join(plan))
+    return 0
+
+def cmd_import(args):
+    db = DB(args.db)
+
+    def progress(stats):
+        rate = stats["read"] / stats["seconds"] if stats["seconds"] else 0.0
+        print(f"\r{stats['read']:,} read, {stats['imported']:,} imported, "
+              f"{stats['rejected']:,} rejected ({rate:,.0f} rows/s)", end="", file=sys.stderr, flush=True)
+
+    stats = db.import_file(args.table, args.file, fmt=args.format, rejects=args.rejects,
+                           chunk_size=args.chunk_size, progress=progress)
+    print(file=sys.stderr)
+    if stats["rejected"] and args.rejects:
+        print(f"rejected rows written to {args.rejects}", file=sys.stderr)
+    return 1 if stats["rejected"] else 0
+
+def cmd_export(args):
+    db = DB(args.db)
+    filters = dict(pid=args.pid, date_from=args.date_from, date_to=args.date_to, doctor=args.doctor)
+    if args.output in (None, "-"):
+        count = db.export(args.table, sys.stdout, args.format or "csv", **filters)
+    else:
+        fmt = args.format or _file_format(args.output)
+        with open(args.output, "w", newline="", encoding="utf-8") as out:
+            count = db.export(args.table, out, fmt, **filters)
+    print(f"exported {count:,} {args.table}", file=sys.stderr)
+    return 0
+
+def cmd_statements(args):
+    db = DB(args.db)
+    bill_ids = [int(i) for i in args.ids.split(",") if i.strip()] if args.ids else None
+    stats = generate_statements(db, args.output, args.date_from, args.date_to, bill_ids,
+                                per_patient=args.per_patient, workers=args.workers)
+    rate = stats["bills"] / stats["seconds"] if stats["seconds"] else 0.0
+    print(f"wrote {stats['files']:,} files for {stats['bills']:,} bills to {args.output} "
+          f"in {stats['seconds']:.2f}s ({rate:,.0f} bills/s)")
+    return 0
+
+def cmd_stress(args):
+    # Readers hammer indexed list queries while one writer adds bills, first
+    # with the default rollback journal and no pool, then WAL plus the pool.
+    # It runs on a scratch copy: the writer adds bills and the baseline
+    # switches journal modes, neither of which belongs in the live file.
+    import shutil
+    import tempfile
+
+    db = DB(args.db)
+    try:
+        pids = [r[0] for r in db.list_patients(limit=1000)]
+        if not pids:
+            print("no patients to query; import or seed some first", file=sys.stderr)
+            return 1
+        folder = tempfile.mkdtemp(prefix="hc-stress-")
+        scratch = os.path.join(folder, "stress.db")
+        db.backup(scratch, pages=-1, pause_ms=0, verify=False)
+    finally:
+        db.close()
+    try:
+        threads = [int(n) for n in args.threads.split(",")]
+        print(f"{'mode':<10} {'readers':>7} {'reads/s':>10} {'writes/s':>9} {'errors':>7}")
+        for mode, wal, pool in (("rollback", False, 0), ("wal+pool", True, READ_POOL_SIZE)):
+            for n in threads:
+                if not wal:
+                    # switch the copy back to a rollback journal for the baseline
+                    conn = sqlite3.connect(scratch)
+                    conn.execute("PRAGMA journal_mode = DELETE")
+                    conn.close()
+                reads, writes, errors = _stress_run(scratch, n, args.seconds, pids, wal, max(pool, n) if pool else 0)
+                print(f"{mode:<10} {n:>7} {reads / args.seconds:>10,.0f} {writes / args.seconds:>9,.0f} {errors:>7}")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return 0
+
+def _stress_run(db_name, n_readers, seconds, pids, wal, readers):
+    import random
+
+    db = DB(db_name, wal=wal, readers=readers, busy_timeout_ms=200)
+    stop = time.perf_counter() + seconds
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def reader(seed):
+        rnd, n, err = random.Random(seed), 0, 0
+        # without a pool every thread needs its own connection
+        own = db if readers else DB(db_name, migrate=False, wal=wal, readers=0, busy_timeout_ms=200)
+        while time.perf_counter() < stop:
+            try:
+                own.list_appointments(rnd.choice(pids), limit=20)
+                own.list_bills(rnd.choice(pids), limit=20)
+                n += 2
+            except sqlite3.OperationalError:
+                err += 1
+        if own is not db:
+            own.close()
+        with lock:
+            counts["reads"] += n
+            counts["errors"] += err
+
+    def writer():
+        rnd, n, err = random.Random(0), 0, 0
+        while time.perf_counter() < stop:
+            try:
+                db.add_bill(rnd.choice(pids), 1, 0, 0, 0)
+                n += 1
+            except sqlite3.OperationalError:
+                err += 1
+        with lock:
+            counts["writes"] += n
+            counts["errors"] += err
+
+    workers = [threading.Thread(target=reader, args=(i,)) for i in range(n_readers)]
+    workers.append(threading.Thread(target=writer))
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    db.close()
+    return counts["reads"], counts["writes"], counts["errors"]
+
+def cmd_serve(args):
+    import asyncio
+
+    db = DB(args.db, group_commit_ms=args.group_commit_ms)
+    try:
+        asyncio.run(MedicareService(db).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db.close()
+    return 0
+
+def cmd_loadtest(args):
+    db = DB(args.db)
+    pids = [r[0] for r in db.list_patients(limit=1000)]
+    db.close()
+    if not pids:
+        print("no patients to query; import or seed some first", file=sys.stderr)
+        return 1
+    result = run_load_test(args.host, args.port, pids, args.requests, args.connections,
+                           args.pipeline, args.write_ratio)
+    print(f"{result['requests']:,} requests in {result['seconds']:.2f}s: {result['rps']:,.0f} req/s, "
+          f"p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, statuses {result['statuses']}")
+    return 0
+
+def cmd_generate(args):
+    db = DB(args.db)
+
+    def progress(stats):
+        print(f"\r{stats['patients']:,} patients  {stats['appointments']:,} appointments  "
+              f"{stats['bills']:,} bills  {stats['seconds']:.1f}s", end="", file=sys.stderr, flush=True)
+
+    stats = generate_data(db, args.patients, args.appointments, args.bills, seed=args.seed,
+                          progress=None if args.quiet else progress)
+    db.close()
+    if not args.quiet:
+        print(file=sys.stderr)
+    print(json.dumps(stats))
+    return 0
+
+def cmd_bench(args):
+    report = run_benchmarks(args.db, repeat=args.repeat, gui=not args.no_gui)
+    for group in ("db", "gui"):
+        for name, stats in report.get(group, {}).items():
+            print(f"{group:<3} {name:<40} {stats['median_ms']:>10.3f} ms")
+    for table, m in report.get("memory", {}).items():
+        print(f"mem {table:<40} {m['record_bytes_per_row']:>6} B/row as records, "
+              f"{m['tuple_bytes_per_row']} as tuples ({m['rows']:,} rows)")
+    storage = report.get("storage", {})
+    if storage:
+        legacy, typed = storage["legacy"], storage["typed"]
+        print(f"storage bills+appointments {legacy['bytes'] / 1e6:.1f} MB as text/real, "
+              f"{typed['bytes'] / 1e6:.1f} MB typed")
+        for name in legacy:
+            if name != "bytes":
+                print(f"storage {name:<36} {legacy[name]['median_ms']:>10.3f} -> {typed[name]['median_ms']:.3f} ms")
+    if report["meta"].get("gui"):
+        print(f"gui {report['meta']['gui']}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if not args.compare:
+        return 0
+    with open(args.compare, encoding="utf-8") as f:
+        base = json.load(f)
+    rows = compare_benchmarks(base, report, tolerance=args.tolerance)
+    print(f"\ncompared with {base['meta'].get('commit') or args.compare}:")
+    for name, a, b, ratio, regressed in rows:
+        print(f"{'REGRESSION' if regressed else '':<10} {name:<44} {a:>9.3f} -> {b:>9.3f} ms  x{ratio:.2f}")
+    return 1 if any(r[-1] for r in rows) else 0
+
+def cmd_archive(args):
+    db = DB(args.db, archive_name=args.archive)
+    if args.before:
+        before = args.before
+    else:
+        before = (datetime.now() - timedelta(days=args.days)).strftime("%Y-%m-%d")
+
+    def progress(stats):
+        print(f"\r{stats['appointments']:,} appointments, {stats['bills']:,} bills moved "
+              f"in {stats['batches']:,} batches", end="", file=sys.stderr, flush=True)
+
+    stats = db.archive(before, batch_size=args.batch_size, progress=progress)
+    print(file=sys.stderr)
+    counts = db.archived_counts()
+    print(f"archived before {before} into {db.archive_name} ({stats['seconds']:.1f}s); archive now holds "
+          f"{counts.get('appointments', 0):,} appointments, {counts.get('bills', 0):,} bills", file=sys.stderr)
+    return 0
+
+def _backup_probed(db, dest, args):
+    # Backup while probe_writes() commits from another connection; the
+    # stall is the slowest commit during the copy over the median idle one
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        stop = threading.Event()
+        idle = pool.submit(probe_writes, db.db_name, stop)
+        time.sleep(0.5)
+        stop.set()
+        idle = sorted(idle.result())
+        stop = threading.Event()
+        busy = pool.submit(probe_writes, db.db_name, stop)
+        try:
+            stats = db.backup(dest, pages=args.pages, pause_ms=args.pause_ms, verify=not args.no_verify)
+        finally:
+            stop.set()
+        busy = sorted(busy.result())
+    if idle and busy:
+        stats["commits"] = len(busy)
+        stats["commit_idle_p50_ms"] = idle[len(idle) // 2]
+        stats["commit_p50_ms"] = busy[len(busy) // 2]
+        stats["max_stall_ms"] = max(busy[-1] - stats["commit_idle_p50_ms"], 0.0)
+    return stats
+
+def cmd_backup(args):
+    db = DB(args.db)
+    if args.dest and args.every:
+        raise ValueError("--every writes timestamped snapshots to --dir; drop the destination")
+    try:
+        while True:
+            dest = args.dest
+            if not dest:
+                os.makedirs(args.dir, exist_ok=True)
+                dest = snapshot_path(args.dir, args.db)
+            if args.probe_writes:
+                stats = _backup_probed(db, dest, args)
+            else:
+                stats = db.backup(dest, pages=args.pages, pause_ms=args.pause_ms, verify=not args.no_verify)
+            print(f"{dest}: {stats['bytes'] / 1e6:.1f} MB in {stats['seconds']:.2f} s ({stats['mb_per_s']:.0f} MB/s), "
+                  f"{stats['steps']} steps, longest {stats['max_step_ms']:.1f} ms, {stats['restarts']} restarts, "
+                  f"integrity {stats['integrity']}")
+            if "max_stall_ms" in stats:
+                print(f"  {stats['commits']} concurrent commits: p50 {stats['commit_p50_ms']:.2f} ms "
+                      f"(idle {stats['commit_idle_p50_ms']:.2f} ms), max stall {stats['max_stall_ms']:.1f} ms")
+            if not args.dest:
+                for path in prune_backups(args.dir, args.db, args.keep):
+                    print(f"  removed {path}")
+            if not args.every:
+                return 0
+            time.sleep(args.every * 60)
+    except KeyboardInterrupt:
+        return 0
+
+def cmd_slots(args):
+    after = datetime.strptime(args.after, "%Y-%m-%d") if args.after else None
+    schedule = Schedule(DB(args.db))
+    for row in schedule.next_free_slots(args.count, doctor=args.doctor, dept=args.dept, after=after):
+        print("  ".join(row))
+    return 0
+
+def cmd_report(args):
+    import csv
+
+    db = DB(args.db)
+    if args.rebuild:
+        db.rebuild_summaries()
+    if args.kind == "revenue":
+        header = ("day", "bills") + _REVENUE_COLUMNS
+        rows = db.revenue_by_day(args.date_from, args.date_to)
+    elif args.kind == "visits":
+        header, rows = ("doctor", "dept", "visits"), db.visits_by_doctor(args.date_from, args.date_to)
+    else:
+        header, rows = ("pid", "name", "bills", "total"), db.top_patients(args.limit)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return 0
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Medicare Management System")
+    parser.add_argument("--db", default=DB_NAME, help="database file (default: %(default)s)")
+    parser.add_argument("--group-commit-ms", type=int, metavar="MS",
+                        help="GUI: coalesce commits of write bursts within this window")
+    parser.add_argument("--instrument", action="store_true", help="time DB calls and statements")
+    parser.add_argument("--slow-ms", type=float, default=SLOW_QUERY_MS,
+                        help="with --instrument: log statements slower than this (default: %(default)s)")
+    parser.add_argument("--metrics-out", metavar="FILE", help="with --instrument: write the metrics as JSON on exit")
+    parser.add_argument("--backup-dir", default="backups", help="GUI: folder for scheduled snapshots (default: %(default)s)")
+    parser.add_argument("--backup-every", type=float, metavar="MIN", help="GUI: snapshot the database every MIN minutes")
+    parser.add_argument("--startup-probe", action="store_true", help=argparse.SUPPRESS)
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("migrate", help="upgrade the schema and report query plans")
+    p.set_defaults(func=cmd_migrate)
+    p = sub.add_parser("import", help="bulk import records from a CSV or JSONL file")
+    p.add_argument("table", choices=sorted(IMPORT_TABLES))
+    p.add_argument("file")
+    p.add_argument("--format", choices=("csv", "jsonl"), help="default: from the file extension")
+    p.add_argument("--rejects", help="write rejected records here")
+    p.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    p.set_defaults(func=cmd_import)
+    p = sub.add_parser("export", help="stream a table to CSV or JSONL")
+    p.add_argument("table", choices=sorted(EXPORT_TABLES))
+    p.add_argument("-o", "--output", help="output file (default: stdout)")
+    p.add_argument("--format", choices=("csv", "jsonl"), help="default: from the file extension, csv for stdout")
+    p.add_argument("--pid")
+    p.add_argument("--from", dest="date_from", metavar="YYYY-MM-DD")
+    p.add_argument("--to", dest="date_to", metavar="YYYY-MM-DD", help="inclusive")
+    p.add_argument("--doctor", help="appointments only")
+    p.set_defaults(func=cmd_export)
+    p = sub.add_parser("statements", help="generate TXT bills or per-patient statements")
+    p.add_argument("-o", "--output", default="statements", help="output folder (default: %(default)s)")
+    p.add_argument("--from", dest="date_from", metavar="YYYY-MM-DD")
+    p.add_argument("--to", dest="date_to", metavar="YYYY-MM-DD", help="inclusive")
+    p.add_argument("--ids", help="comma-separated bill IDs")
+    p.add_argument("--per-patient", action="store_true", help="one statement per patient instead of one file per bill")
+    p.add_argument("--workers", type=int, default=STATEMENT_WORKERS)
+    p.set_defaults(func=cmd_statements)
+    p = sub.add_parser("archive", help="move old appointments and bills to the archive database")
+    when = p.add_mutually_exclusive_group()
+    when.add_argument("--before", metavar="YYYY-MM-DD", help="archive rows dated before this day")
+    when.add_argument("--days", type=int, default=365, help="...or older than this many days (default: %(default)s)")
+    p.add_argument("--archive", metavar="FILE", help="archive file (default: <db>.archive.db)")
+    p.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    p.set_defaults(func=cmd_archive)
+    p = sub.add_parser("backup", help="online backup or scheduled snapshots, with integrity check")
+    p.add_argument("dest", nargs="?", help="backup file (default: a timestamped snapshot in --dir)")
+    p.add_argument("--dir", default="backups", help="snapshot folder (default: %(default)s)")
+    p.add_argument("--keep", type=int, default=BACKUP_KEEP, help="snapshots to keep in --dir (default: %(default)s)")
+    p.add_argument("--every", type=float, metavar="MIN", help="keep running, one snapshot every MIN minutes")
+    p.add_argument("--pages", type=int, default=BACKUP_PAGES_PER_STEP, help="pages per step (default: %(default)s)")
+    p.add_argument("--pause-ms", type=float, default=BACKUP_PAUSE_MS, help="pause between steps (default: %(default)s)")
+    p.add_argument("--no-verify", action="store_true", help="skip integrity_check on the copy")
+    p.add_argument("--probe-writes", action="store_true", help="commit from another connection meanwhile and report the stall")
+    p.set_defaults(func=cmd_backup)
+    p = sub.add_parser("stress", help="concurrent reader/writer throughput, rollback journal vs WAL")
+    p.add_argument("--threads", default="1,2,4,8", help="reader thread counts (default: %(default)s)")
+    p.add_argument("--seconds", type=float, default=3.0)
+    p.set_defaults(func=cmd_stress)
+    p = sub.add_parser("generate", help="add seeded synthetic patients, appointments and bills")
+    p.add_argument("--patients", type=int, default=1000)
+    p.add_argument("--appointments", type=int, help="default: 3 per patient")
+    p.add_argument("--bills", type=int, help="default: 2 per patient")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("-q", "--quiet", action="store_true")
+    p.set_defaults(func=cmd_generate)
+    p = sub.add_parser("bench", help="time DB methods and view refreshes; optionally compare with a saved run")
+    p.add_argument("--repeat", type=int, default=BENCH_REPEAT)
+    p.add_argument("--out", help="write the results as JSON")
+    p.add_argument("--compare", metavar="BASE.json", help="exit 1 if a case regressed against this run")
+    p.add_argument("--tolerance", type=float, default=BENCH_TOLERANCE)
+    p.add_argument("--no-gui", action="store_true", help="skip the Tk refresh timings")
+    p.set_defaults(func=cmd_bench)
+    p = sub.add_parser("slots", help="list the next free appointment slots")
+    p.add_argument("--doctor")
+    p.add_argument("--dept")
+    p.add_argument("--after", metavar="YYYY-MM-DD", help="default: now")
+    p.add_argument("-n", "--count", type=int, default=5)
+    p.set_defaults(func=cmd_slots)
+    p = sub.add_parser("report", help="print a summary report as CSV")
+    p.add_argument("kind", choices=("revenue", "visits", "top-patients"))
+    p.add_argument("--from", dest="date_from", metavar="YYYY-MM-DD")
+    p.add_argument("--to", dest="date_to", metavar="YYYY-MM-DD")
+    p.add_argument("--limit", type=int, default=20, help="top-patients only")
+    p.add_argument("--rebuild", action="store_true", help="recompute the summary tables first")
+    p.set_defaults(func=cmd_report)
+    p = sub.add_parser("serve", help="run the headless HTTP/JSON service")
+    p.add_argument("--host", default=SERVICE_HOST)
+    p.add_argument("--port", type=int, default=SERVICE_PORT)
+    p.set_defaults(func=cmd_serve)
+    p = sub.add_parser("loadtest", help="load-test a running service (p50/p99, req/s)")
+    p.add_argument("--host", default=SERVICE_HOST)
+    p.add_argument("--port", type=int, default=SERVICE_PORT)
+    p.add_argument("--requests", type=int, default=5000)
+    p.add_argument("--connections", type=int, default=8)
+    p.add_argument("--pipeline", type=int, default=8, help="requests in flight per connection")
+    p.add_argument("--write-ratio", type=float, default=0.1)
+    p.set_defaults(func=cmd_loadtest)
+    args = parser.parse_args(argv)
+
+    metrics = instrument(args.slow_ms) if args.instrument else None
+    try:
+        if args.command is None:
+            app = MedicareApp(args.db, group_commit_ms=args.group_commit_ms, backup_dir=args.backup_dir,
+                              backup_every_min=args.backup_every)
+            if args.startup_probe:
+                app.probe_startup()
+            app.mainloop()
+            return 0
+        try:
+            return args.func(args)
+        except (ValueError, OSError) as e:
+            parser.error(str(e))
+    finally:
+        if metrics is not None and args.metrics_out:
+            metrics.dump(args.metrics_out)
 
 # --------------------- Run ---------------------
 if __name__ == "__main__":
-    app = MedicareApp()
-    app.mainloop()
+    sys.exit(main())